@@ -5,6 +5,7 @@ import * as iam from 'aws-cdk-lib/aws-iam';
 import * as apigateway from 'aws-cdk-lib/aws-apigateway';
 import * as logs from 'aws-cdk-lib/aws-logs';
 import * as ssm from 'aws-cdk-lib/aws-ssm';
+import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as path from 'path';
 import { PythonFunction } from '@aws-cdk/aws-lambda-python-alpha';
 
@@ -44,6 +45,17 @@ export class ResearchStack extends cdk.Stack {
             description: 'API Key for OpenAI API',
             tier: ssm.ParameterTier.STANDARD,
         });
+        // Bucket for asynchronous research jobs (status, progress and results), polled by job id,
+        // and for the result cache of repeated questions
+        const jobsBucket = new s3.Bucket(this, 'ResearchJobsBucket', {
+            blockPublicAccess: s3.BlockPublicAccess.BLOCK_ALL,
+            encryption: s3.BucketEncryption.S3_MANAGED,
+            enforceSSL: true,
+            lifecycleRules: [{ expiration: cdk.Duration.days(7) }],
+            removalPolicy: cdk.RemovalPolicy.DESTROY,
+            autoDeleteObjects: true,
+        });
+
         // Create a Lambda function for the research generator
         const researchGenerator = new PythonFunction(this, 'ResearchGenerator', {
             entry: path.join(__dirname, '../../lambda/research-generator'),
@@ -52,11 +64,17 @@ export class ResearchStack extends cdk.Stack {
             timeout: cdk.Duration.minutes(10),
             runtime: lambda.Runtime.PYTHON_3_9,
             memorySize: 3008,
+            // Research jobs record their own failures; a retried invocation would rebuild the tree
+            retryAttempts: 0,
             environment: {
                 ANTHROPIC_API_KEY_SECRET_NAME: anthropicApiParam.parameterName,
                 BRAVE_API_KEY_SECRET_NAME: braveApiParam.parameterName,
                 OPENAI_API_KEY_SECRET_NAME: openaiApiParam.parameterName,
                 ENVIRONMENT: props.environmentName,
+                JOB_STORE_URL: `s3://${jobsBucket.bucketName}/jobs`,
+                JOB_WORKER_MODE: 'lambda',
+                // Shared by all containers, so a popular question is researched once per TTL
+                RESULT_CACHE_URL: `s3://${jobsBucket.bucketName}/result-cache`,
             },
             logRetention: logs.RetentionDays.ONE_WEEK,
             bundling: {
@@ -64,6 +82,7 @@ export class ResearchStack extends cdk.Stack {
                     'venv',
                     '__pycache__',
                     'vector_db',
+                    'data',
                     'output',
                     'test_locally.py',
                     'test_setup.py',
@@ -80,6 +99,18 @@ export class ResearchStack extends cdk.Stack {
             resources: [anthropicApiParam.parameterArn, braveApiParam.parameterArn, openaiApiParam.parameterArn],
         }));
 
+        // Jobs are stored in S3 and built by an asynchronous invocation of the function itself
+        jobsBucket.grantReadWrite(researchGenerator);
+        // A separate policy, so the function's own policy doesn't depend on its ARN
+        new iam.Policy(this, 'ResearchGeneratorSelfInvoke', {
+            roles: [researchGenerator.role!],
+            statements: [new iam.PolicyStatement({
+                effect: iam.Effect.ALLOW,
+                actions: ['lambda:InvokeFunction'],
+                resources: [researchGenerator.functionArn],
+            })],
+        });
+
         // Add a Lambda Function URL with CORS enabled
         const functionUrl = researchGenerator.addFunctionUrl({
             authType: lambda.FunctionUrlAuthType.NONE, // No authentication required
@@ -99,7 +130,13 @@ export class ResearchStack extends cdk.Stack {
                 allowOrigins: apigateway.Cors.ALL_ORIGINS, // Or specify domains: ['https://deep-research-assistant.dev.jake-moses.com']
                 allowMethods: apigateway.Cors.ALL_METHODS,
                 allowHeaders: ['Content-Type'],
-            }
+            },
+            // Compressed (base64-encoded) responses are JSON. API Gateway decodes them for requests whose
+            // first Accept type is listed here, and the function only compresses for those (see
+            // API_GATEWAY_BINARY_MEDIA_TYPES). JSON request bodies arrive base64-encoded, which the handler
+            // decodes. The OPTIONS preflight carries no JSON body, so its mock integration still answers
+            // with the CORS headers as text.
+            binaryMediaTypes: ['application/json'],
         });
 
         // Create a resource and method for the API
@@ -107,6 +144,10 @@ export class ResearchStack extends cdk.Stack {
         researchResource.addMethod('POST', new apigateway.LambdaIntegration(researchGenerator), {
             apiKeyRequired: false, // Set to true if you want to require an API key
         });
+        // Poll an asynchronous research job: GET /research?job_id=...
+        researchResource.addMethod('GET', new apigateway.LambdaIntegration(researchGenerator), {
+            apiKeyRequired: false,
+        });
 
         // Output the API endpoint URL
         new cdk.CfnOutput(this, 'ResearchAPIEndpoint', {
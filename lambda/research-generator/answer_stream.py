@@ -0,0 +1,83 @@
+"""
+Streaming iterators over a research answer as it is generated.
+
+generate_answer_with_tree blocks until the whole tree is built, passing the
+root answer's text deltas to an on_token callback. These helpers run it in
+the background and expose the deltas as a plain or async iterator instead,
+for transports that can send them to the client as they arrive.
+
+Events are dictionaries:
+    {'type': 'token', 'text': '...'}   a delta of the root answer
+    {'type': 'tree', 'tree': {...}}    the finished question tree (always last)
+"""
+import queue
+import asyncio
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator
+
+# Marks the end of the token stream
+_DONE = object()
+
+
+def stream_answer_with_tree(rag_engine, question: str, client, brave_api_key: str) -> Iterator[Dict[str, Any]]:
+    """
+    Build the question tree in a background thread, yielding root answer deltas as they arrive.
+
+    Raises:
+        Exception: Any error raised by generate_answer_with_tree, after the
+            tokens streamed before it
+    """
+    events = queue.Queue()
+    result = {}
+
+    def build_tree():
+        try:
+            result['tree'] = rag_engine.generate_answer_with_tree(
+                question, client, brave_api_key, on_token=lambda text: events.put(text)
+            )
+        except Exception as e:
+            result['error'] = e
+        finally:
+            events.put(_DONE)
+
+    threading.Thread(target=build_tree, name='answer-stream', daemon=True).start()
+
+    while True:
+        text = events.get()
+        if text is _DONE:
+            break
+        yield {'type': 'token', 'text': text}
+
+    if 'error' in result:
+        raise result['error']
+    yield {'type': 'tree', 'tree': result['tree'].to_dict()}
+
+
+async def astream_answer_with_tree(rag_engine, question: str, client,
+                                   brave_api_key: str) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Async version of stream_answer_with_tree for ASGI-style servers.
+
+    The tree is built in the event loop's default executor, so the loop is
+    never blocked by Claude, Brave or embedding calls.
+    """
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_token(text: str):
+        loop.call_soon_threadsafe(events.put_nowait, text)
+
+    future = loop.run_in_executor(
+        None, lambda: rag_engine.generate_answer_with_tree(question, client, brave_api_key, on_token=on_token)
+    )
+    # Done callbacks run on the loop after any tokens already scheduled
+    future.add_done_callback(lambda _: events.put_nowait(_DONE))
+
+    while True:
+        text = await events.get()
+        if text is _DONE:
+            break
+        yield {'type': 'token', 'text': text}
+
+    tree = await future
+    yield {'type': 'tree', 'tree': tree.to_dict()}
@@ -0,0 +1,137 @@
+"""
+Read-only, memory-mapped base index for the research generator.
+
+The base index is a large prebuilt artifact (see ingest_corpus.py) shipped in
+the deployment package or a Lambda layer. It is opened with FAISS mmap so a
+cold start only pages in the parts of the index a query touches, and its
+documents are stored as JSON lines addressed through a memory-mapped offsets
+array so they are read one at a time on demand.
+
+Artifact layout:
+    index.faiss            IVF index (flat for small corpora)
+    documents.jsonl        one chunk dict per line, in index order
+    documents.offsets.npy  int64 byte offsets, ntotal + 1 entries
+"""
+import os
+import json
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from config import BASE_INDEX_NPROBE, BASE_INDEX_IVF_MIN_VECTORS
+from log import get_logger
+
+logger = get_logger(__name__)
+
+INDEX_FILE = "index.faiss"
+DOCUMENTS_FILE = "documents.jsonl"
+OFFSETS_FILE = "documents.offsets.npy"
+
+# Base indexes are immutable, so every RAGEngine in the process shares one mapping per path
+_open_indexes = {}
+_open_indexes_lock = threading.Lock()
+
+
+class ReadOnlyBaseIndex:
+    """A memory-mapped FAISS index with lazily loaded documents."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = faiss.read_index(
+            os.path.join(path, INDEX_FILE),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+        if hasattr(self.index, 'nprobe'):
+            self.index.nprobe = BASE_INDEX_NPROBE
+        self._offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+        self._documents_fd = os.open(os.path.join(path, DOCUMENTS_FILE), os.O_RDONLY)
+
+        if len(self._offsets) != self.index.ntotal + 1:
+            raise ValueError(
+                f"Base index at {path} is inconsistent: {self.index.ntotal} vectors, "
+                f"{len(self._offsets) - 1} documents"
+            )
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def search(self, query_embedding: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search the base index. Same contract as faiss.Index.search."""
+        return self.index.search(query_embedding, top_k)
+
+    def get_document(self, idx: int) -> Dict[str, Any]:
+        """Read a single document by its position in the index."""
+        start = int(self._offsets[idx])
+        end = int(self._offsets[idx + 1])
+        # pread keeps concurrent reads safe without sharing a file position
+        return json.loads(os.pread(self._documents_fd, end - start, start))
+
+
+def open_base_index(path: str) -> Optional[ReadOnlyBaseIndex]:
+    """
+    Open the base index at path, reusing an existing mapping if there is one.
+
+    Returns:
+        The base index, or None if there is no complete artifact at path
+    """
+    if not path or not os.path.exists(os.path.join(path, OFFSETS_FILE)):
+        return None
+
+    with _open_indexes_lock:
+        if path not in _open_indexes:
+            try:
+                _open_indexes[path] = ReadOnlyBaseIndex(path)
+                logger.info("Opened base index (mmap)", path=path, vectors=_open_indexes[path].ntotal)
+            except Exception as e:
+                logger.error("Error opening base index", path=path, error=str(e))
+                return None
+        return _open_indexes[path]
+
+
+def write_base_index(index, documents: Iterable[Dict[str, Any]], output_dir: str):
+    """
+    Write an index and its documents as a base index artifact.
+
+    Large indexes are converted to IVF, whose inverted lists FAISS can
+    memory-map; smaller ones stay flat since they are cheap to read anyway.
+
+    Args:
+        index: A flat FAISS index holding one vector per document
+        documents: Chunk dicts in index order, e.g. streamed from a file
+        output_dir: Directory to write the artifact to
+
+    Raises:
+        ValueError: If the number of documents doesn't match the index. The
+            offsets file is written last, so the artifact is then not opened.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    offsets_path = os.path.join(output_dir, OFFSETS_FILE)
+    if os.path.exists(offsets_path):
+        os.remove(offsets_path)
+
+    if index.ntotal >= BASE_INDEX_IVF_MIN_VECTORS:
+        vectors = index.reconstruct_n(0, index.ntotal)
+        nlist = int(np.sqrt(index.ntotal)) * 4
+        quantizer = faiss.IndexFlatL2(index.d)
+        base = faiss.IndexIVFFlat(quantizer, index.d, nlist)
+        logger.info("Training IVF base index", lists=nlist, vectors=index.ntotal)
+        base.train(vectors)
+        base.add(vectors)
+    else:
+        base = index
+    faiss.write_index(base, os.path.join(output_dir, INDEX_FILE))
+
+    offsets = np.zeros(index.ntotal + 1, dtype=np.int64)
+    count = 0
+    with open(os.path.join(output_dir, DOCUMENTS_FILE), 'wb') as f:
+        for count, document in enumerate(documents, 1):
+            if count > index.ntotal:
+                raise ValueError(f"There are more documents than the index's {index.ntotal} vectors")
+            f.write(json.dumps(document, default=str).encode('utf-8') + b'\n')
+            offsets[count] = f.tell()
+    if count != index.ntotal:
+        raise ValueError(f"Index has {index.ntotal} vectors but there are {count} documents")
+    np.save(offsets_path, offsets)
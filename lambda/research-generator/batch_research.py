@@ -0,0 +1,480 @@
+#!/usr/bin/env python3
+"""
+Offline batch research over many questions.
+
+Each question's tree is built on its own thread, exactly as in a live
+request, but its Claude client is a BatchingClient: messages.create queues
+the request and blocks. Once every running tree is waiting on Claude (one
+tree level across all questions), the queued requests are submitted as a
+single batch, polled until it ends, and each tree resumes with its result.
+Throughput comes from batching instead of hundreds of open connections.
+
+Usage:
+    python batch_research.py questions.txt --output results.jsonl
+    python batch_research.py questions.jsonl --backend local   # Messages API stand-in
+
+The questions file holds one question per line, or JSONL records with an
+'expression' (or 'question') field. Finished trees are appended to the
+output file as they complete, and questions already answered in it (their
+last record has no error) are skipped, so an interrupted run can simply be
+restarted and failed questions are retried.
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+import requests
+
+from config import (
+    BATCH_API_URL, BATCH_API_BETA, BATCH_POLL_SECONDS, BATCH_HTTP_TIMEOUT_SECONDS, BATCH_COLLECT_SECONDS,
+    BATCH_MAX_REQUESTS, BATCH_MAX_TREES, BATCH_RATE_LIMITS
+)
+from rag_engine import RAGEngine
+from budget import ResearchBudget
+from llm_gateway import LLMGateway
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Batch result error types mapped to the HTTP status the live API would have returned,
+# so the gateway retries (in the next batch) exactly what it would retry live
+ERROR_STATUS_CODES = {
+    'invalid_request_error': 400,
+    'authentication_error': 401,
+    'permission_error': 403,
+    'not_found_error': 404,
+    'rate_limit_error': 429,
+    'api_error': 500,
+    'overloaded_error': 529,
+}
+
+
+class BatchRequestError(Exception):
+    """A request in a batch did not succeed."""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def to_message(data: Dict[str, Any]) -> SimpleNamespace:
+    """Convert a Messages API response dictionary to an object like the SDK returns."""
+    return SimpleNamespace(
+        id=data.get('id'),
+        model=data.get('model'),
+        role=data.get('role', 'assistant'),
+        stop_reason=data.get('stop_reason'),
+        content=[SimpleNamespace(**block) for block in data.get('content', [])],
+        usage=SimpleNamespace(**data.get('usage', {}))
+    )
+
+
+def result_to_outcome(result: Dict[str, Any]) -> Any:
+    """Turn a batch result into a message, or a BatchRequestError for failed requests."""
+    if result.get('type') == 'succeeded':
+        return to_message(result['message'])
+    if result.get('type') == 'errored':
+        error = result.get('error', {})
+        error_type = error.get('error', {}).get('type') or error.get('type', 'api_error')
+        return BatchRequestError(error.get('error', {}).get('message', str(error)),
+                                 ERROR_STATUS_CODES.get(error_type, 500))
+    # Canceled or expired requests can be resubmitted
+    return BatchRequestError(f"Batch request {result.get('type', 'failed')}", 503)
+
+
+class AnthropicBatchBackend:
+    """Submits batches to the Anthropic Message Batches API."""
+
+    def __init__(self, api_key: str, base_url: str = BATCH_API_URL):
+        self.base_url = base_url
+        self.headers = {
+            'x-api-key': api_key,
+            'anthropic-version': '2023-06-01',
+            'anthropic-beta': BATCH_API_BETA,
+            'content-type': 'application/json'
+        }
+
+    def submit(self, batch_requests: List[Dict[str, Any]]) -> str:
+        # Batch requests cannot carry per-request headers, so any betas they need go on the batch
+        betas = {BATCH_API_BETA}
+        body = []
+        for request in batch_requests:
+            params = dict(request['params'])
+            beta = (params.pop('extra_headers', None) or {}).get('anthropic-beta')
+            if beta:
+                betas.update(beta.split(','))
+            body.append({'custom_id': request['custom_id'], 'params': params})
+
+        response = requests.post(self.base_url, headers={**self.headers, 'anthropic-beta': ','.join(sorted(betas))},
+                                 json={'requests': body}, timeout=BATCH_HTTP_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        return response.json()['id']
+
+    def is_done(self, batch_id: str) -> bool:
+        response = requests.get(f"{self.base_url}/{batch_id}", headers=self.headers,
+                                timeout=BATCH_HTTP_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        batch = response.json()
+        logger.info("Batch status", batch_id=batch_id, status=batch['processing_status'],
+                    request_counts=batch.get('request_counts', {}))
+        return batch['processing_status'] == 'ended'
+
+    def results(self, batch_id: str) -> Dict[str, Any]:
+        response = requests.get(f"{self.base_url}/{batch_id}/results", headers=self.headers,
+                                timeout=BATCH_HTTP_TIMEOUT_SECONDS)
+        response.raise_for_status()
+        results = {}
+        for line in response.text.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                results[entry['custom_id']] = entry['result']
+        return results
+
+
+class LocalBatchBackend:
+    """
+    Stand-in for the Batches API that sends each request through a Messages API client.
+
+    Requests run in the background on a small thread pool, so the collector
+    polls it like a real batch. Use it with messages_stub.StubAnthropic to
+    test batch research offline.
+    """
+
+    def __init__(self, client, max_workers: int = 8):
+        self.client = client
+        self.max_workers = max_workers
+        self._batches = {}
+        self._batch_count = 0
+
+    def submit(self, batch_requests: List[Dict[str, Any]]) -> str:
+        self._batch_count += 1
+        batch_id = f"local_batch_{self._batch_count}"
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = {
+            request['custom_id']: executor.submit(self._run, request['params'])
+            for request in batch_requests
+        }
+        executor.shutdown(wait=False)
+        self._batches[batch_id] = futures
+        return batch_id
+
+    def _run(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            message = self.client.messages.create(**params)
+        except Exception as e:
+            error_type = next((name for name, code in ERROR_STATUS_CODES.items()
+                               if code == getattr(e, 'status_code', 500)), 'api_error')
+            return {'type': 'errored', 'error': {'type': 'error', 'error': {'type': error_type, 'message': str(e)}}}
+        return {'type': 'succeeded', 'message': {
+            'id': message.id,
+            'model': message.model,
+            'stop_reason': message.stop_reason,
+            'content': [{'type': block.type, 'text': block.text} for block in message.content],
+            'usage': {
+                field: getattr(message.usage, field, None) or 0
+                for field in ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+            }
+        }}
+
+    def is_done(self, batch_id: str) -> bool:
+        return all(future.done() for future in self._batches[batch_id].values())
+
+    def results(self, batch_id: str) -> Dict[str, Any]:
+        futures = self._batches.pop(batch_id)
+        return {custom_id: future.result() for custom_id, future in futures.items()}
+
+
+class BatchCollector:
+    """
+    Gathers the Claude requests of concurrently running trees into batches.
+
+    A batch is sent once every running tree is blocked on a request, or after
+    collect_seconds if some tree is still busy (e.g. searching the web).
+
+    A tree whose request is identical to another tree's is coalesced by the
+    gateway and never reaches the collector, so shared_waiters (e.g.
+    LLMGateway.waiting_callers) reports how many trees are blocked that way;
+    they count as blocked too. The count is checked at least once a second.
+    """
+
+    def __init__(self, backend, poll_seconds: float = BATCH_POLL_SECONDS,
+                 collect_seconds: float = BATCH_COLLECT_SECONDS, max_requests: int = BATCH_MAX_REQUESTS,
+                 shared_waiters: Callable[[], int] = lambda: 0):
+        self.backend = backend
+        self.shared_waiters = shared_waiters
+        self.poll_seconds = poll_seconds
+        self.collect_seconds = collect_seconds
+        self.max_requests = max_requests
+        self.batches_submitted = 0
+        self.requests_submitted = 0
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._running_trees = 0
+        self._finished = False
+        self._next_id = 0
+
+    def tree_started(self):
+        with self._condition:
+            self._running_trees += 1
+
+    def tree_finished(self):
+        with self._condition:
+            self._running_trees -= 1
+            self._condition.notify_all()
+
+    def finish(self):
+        """Stop the collector once the pending requests have been sent."""
+        with self._condition:
+            self._finished = True
+            self._condition.notify_all()
+
+    def request(self, params: Dict[str, Any]) -> Future:
+        """Queue a messages.create request and return a future for its response."""
+        future = Future()
+        with self._condition:
+            self._next_id += 1
+            self._pending.append((f"req_{self._next_id}", params, future))
+            self._condition.notify_all()
+        return future
+
+    def run(self):
+        """Send batches until finish() is called and nothing is pending. Runs on the calling thread."""
+        while True:
+            with self._condition:
+                deadline = time.time() + self.collect_seconds
+                while not self._pending or (len(self._pending) < self._running_trees - self.shared_waiters()
+                                            and time.time() < deadline):
+                    if self._finished and not self._pending:
+                        return
+                    self._condition.wait(timeout=max(0.1, min(1.0, deadline - time.time())))
+                    if not self._pending:
+                        deadline = time.time() + self.collect_seconds
+                pending = self._pending[:self.max_requests]
+                self._pending = self._pending[self.max_requests:]
+
+            self._send(pending)
+
+    def _send(self, pending: List[Any]):
+        futures = {custom_id: future for custom_id, _, future in pending}
+        try:
+            batch_id = self.backend.submit([
+                {'custom_id': custom_id, 'params': params} for custom_id, params, _ in pending
+            ])
+            self.batches_submitted += 1
+            self.requests_submitted += len(pending)
+            logger.info("Submitted batch", batch_id=batch_id, requests=len(pending))
+
+            while not self.backend.is_done(batch_id):
+                time.sleep(self.poll_seconds)
+            results = self.backend.results(batch_id)
+        except Exception as e:
+            logger.error("Error running batch", requests=len(pending), error=str(e))
+            for future in futures.values():
+                future.set_exception(e)
+            return
+
+        for custom_id, future in futures.items():
+            outcome = result_to_outcome(results.get(custom_id, {'type': 'expired'}))
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+
+class BatchMessageStream:
+    """
+    Context manager mimicking the SDK's MessageStream for a batched response.
+
+    Batches cannot stream, so the whole text arrives as a single delta once
+    the batch has ended.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        text = ''.join(getattr(block, 'text', '') for block in message.content)
+        self.text_stream = iter([text] if text else [])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def get_final_message(self):
+        return self.message
+
+
+class BatchingClient:
+    """Anthropic client stand-in whose messages.create (and .stream) waits on the next batch."""
+
+    def __init__(self, collector: BatchCollector):
+        self.messages = SimpleNamespace(create=self._create, stream=self._stream)
+        self._collector = collector
+
+    def with_options(self, **options):
+        return self
+
+    def _create(self, **kwargs):
+        return self._collector.request(kwargs).result()
+
+    def _stream(self, **kwargs):
+        return BatchMessageStream(self._create(**kwargs))
+
+
+def load_questions(path: str) -> List[str]:
+    """Read questions from a text file (one per line) or JSONL records."""
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                line = record.get('expression') or record.get('question') or ''
+            if line:
+                questions.append(line)
+    return questions
+
+
+def completed_questions(output_path: str) -> set:
+    """
+    Return the questions answered in the output file.
+
+    A retried question is appended again, so its last record counts; questions
+    whose last record has an error are researched again.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    errors = {}
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                errors[record['question']] = record.get('error')
+    return {question for question, error in errors.items() if not error}
+
+
+def run_batch_research(questions: List[str], backend, brave_api_key: str, openai_api_key: str,
+                       output_path: str, max_trees: int = BATCH_MAX_TREES,
+                       poll_seconds: float = BATCH_POLL_SECONDS) -> Dict[str, Any]:
+    """
+    Research every question, batching the Claude requests of concurrently running trees.
+
+    Args:
+        questions: Questions to research
+        backend: AnthropicBatchBackend or LocalBatchBackend
+        brave_api_key: Brave Search API key
+        openai_api_key: OpenAI API key for embeddings
+        output_path: JSONL file that finished trees are appended to
+        max_trees: Maximum number of trees built at once
+        poll_seconds: Seconds between batch status checks
+
+    Returns:
+        Summary statistics for the run
+    """
+    done = completed_questions(output_path)
+    remaining = [q for q in questions if q not in done]
+    print(f"{len(remaining)} questions to research ({len(done)} already in {output_path})")
+
+    rag = RAGEngine(concurrent_trees=max_trees)
+    rag.set_openai_key(openai_api_key)
+    # Batches are not subject to the live rate limits
+    rag.gateway = LLMGateway(rate_limits=BATCH_RATE_LIMITS)
+
+    collector = BatchCollector(backend, poll_seconds=poll_seconds, shared_waiters=rag.gateway.waiting_callers)
+    client = BatchingClient(collector)
+    output_lock = threading.Lock()
+    start_time = time.time()
+    stats = {'completed': 0, 'failed': 0}
+
+    def research(question: str):
+        collector.tree_started()
+        try:
+            # A tree waits on one batch per level, so only its tokens and cost are limited, not its wall time
+            tree = rag.generate_answer_with_tree(question, client, brave_api_key,
+                                                 budget=ResearchBudget(max_seconds=None))
+            record = {'question': question, 'tree': tree.to_dict(), 'error': tree.error or tree.answer_error}
+        except Exception as e:
+            record = {'question': question, 'tree': None, 'error': str(e)}
+        finally:
+            collector.tree_finished()
+
+        with output_lock:
+            stats['failed' if record['error'] else 'completed'] += 1
+            with open(output_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        print(f"[{stats['completed'] + stats['failed']}/{len(remaining)}] Finished: {question[:60]}")
+
+    executor = ThreadPoolExecutor(max_workers=max_trees, thread_name_prefix='batch-tree')
+    futures = [executor.submit(research, question) for question in remaining]
+
+    def finish_when_done():
+        for future in futures:
+            future.result()
+        collector.finish()
+
+    threading.Thread(target=finish_when_done, daemon=True).start()
+    collector.run()
+    executor.shutdown(wait=True)
+    rag.kb_manager.flush()
+
+    return {
+        **stats,
+        'batches': collector.batches_submitted,
+        'requests': collector.requests_submitted,
+        'llm_gateway': rag.gateway.metrics.snapshot(),
+        'elapsed_seconds': round(time.time() - start_time, 2)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Research many questions with batched Claude requests.')
+    parser.add_argument('questions', type=str, help='Text file (one question per line) or JSONL file')
+    parser.add_argument('--output', '-o', type=str, default='output/batch_results.jsonl',
+                        help='JSONL file that finished trees are appended to')
+    parser.add_argument('--backend', choices=['anthropic', 'local'], default='anthropic',
+                        help="'anthropic' for the Message Batches API, 'local' to send each request "
+                             "through the Messages API")
+    parser.add_argument('--stub', action='store_true',
+                        help='With --backend local, answer from messages_stub instead of the API')
+    parser.add_argument('--max-trees', type=int, default=BATCH_MAX_TREES,
+                        help='Questions researched concurrently')
+    parser.add_argument('--poll-seconds', type=float, default=BATCH_POLL_SECONDS,
+                        help='Seconds between batch status checks')
+    args = parser.parse_args()
+
+    for key in ('OPENAI_API_KEY', 'BRAVE_API_KEY') + (() if args.stub else ('ANTHROPIC_API_KEY',)):
+        if key not in os.environ:
+            raise ValueError(f"Please set {key} environment variable")
+
+    if args.backend == 'anthropic':
+        backend = AnthropicBatchBackend(os.environ['ANTHROPIC_API_KEY'])
+    elif args.stub:
+        from messages_stub import StubAnthropic
+        backend = LocalBatchBackend(StubAnthropic())
+    else:
+        from anthropic import Anthropic
+        backend = LocalBatchBackend(Anthropic(api_key=os.environ['ANTHROPIC_API_KEY']))
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    stats = run_batch_research(
+        load_questions(args.questions), backend, os.environ['BRAVE_API_KEY'], os.environ['OPENAI_API_KEY'],
+        args.output, max_trees=args.max_trees, poll_seconds=args.poll_seconds
+    )
+    print(f"Batch research completed: {stats['completed']} completed, {stats['failed']} failed, "
+          f"{stats['requests']} requests in {stats['batches']} batches, {stats['elapsed_seconds']:.2f} seconds")
+
+
+if __name__ == '__main__':
+    main()
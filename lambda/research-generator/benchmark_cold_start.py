@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark of the Lambda handler.
+
+Starts fresh interpreters and measures what a new Lambda container pays
+before it can serve its first request:
+
+- process_ms: the whole process, interpreter start-up included
+- import_ms: importing lambda_function (and everything it imports)
+- init_ms: creating the warm RAG engine and Anthropic client (what preload
+  does after reading the API keys; SSM itself is not called)
+
+Each run's medians are appended to a JSONL history with the git commit, so
+cold starts can be tracked over time, and compared with the previous run.
+
+Usage:
+    python benchmark_cold_start.py
+    python benchmark_cold_start.py --runs 10 --history benchmarks/cold_start_history.jsonl
+    python benchmark_cold_start.py --no-history   # print only
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from profile_imports import HERE, import_report
+
+DEFAULT_HISTORY_PATH = os.path.join(HERE, 'benchmarks', 'cold_start_history.jsonl')
+
+# Run in each fresh interpreter; the last line of its output is the measurement
+BENCHMARK_SNIPPET = """
+import json, time
+start = time.perf_counter()
+import lambda_function
+imported = time.perf_counter()
+lambda_function.get_rag_engine('cold-start-benchmark')
+lambda_function.get_anthropic_client('cold-start-benchmark')
+ready = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'init_ms': (ready - imported) * 1000}))
+"""
+
+METRICS = ('process_ms', 'import_ms', 'init_ms')
+
+
+def measure_cold_start() -> Dict[str, float]:
+    """Measure one cold start in a fresh interpreter."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', BENCHMARK_SNIPPET],
+        cwd=HERE, env={**os.environ, 'PRELOAD_ON_INIT': 'false'},
+        capture_output=True, text=True
+    )
+    process_ms = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"Cold start failed:\n{result.stderr[-2000:]}")
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    measurement['process_ms'] = process_ms
+    return measurement
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        'median': round(statistics.median(values), 1),
+        'min': round(min(values), 1),
+        'max': round(max(values), 1)
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(runs: int = 5, warmup: int = 1, top_imports: int = 10) -> Dict[str, Any]:
+    """
+    Measure several cold starts and return the history record.
+
+    Args:
+        runs: Cold starts measured
+        warmup: Cold starts run first and discarded (they write bytecode caches
+            and warm the page cache, which a deployed package already has)
+        top_imports: Slowest packages recorded from the import profile
+    """
+    for _ in range(warmup):
+        measure_cold_start()
+
+    measurements = []
+    for i in range(runs):
+        measurement = measure_cold_start()
+        print(f"Run {i + 1}/{runs}: " + ', '.join(f"{name} {measurement[name]:.1f}" for name in METRICS))
+        measurements.append(measurement)
+
+    report = import_report('lambda_function', top=top_imports)
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': runs,
+        **{name: summarize([m[name] for m in measurements]) for name in METRICS},
+        'import_modules': report['modules'],
+        'slowest_packages': report['packages']
+    }
+
+
+def read_last_record(history_path: str) -> Optional[Dict[str, Any]]:
+    """Return the most recent record of a history file, or None."""
+    if not os.path.exists(history_path):
+        return None
+    last = None
+    with open(history_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                last = json.loads(line)
+    return last
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cold start of the Lambda handler.')
+    parser.add_argument('--runs', type=int, default=5, help='Cold starts to measure')
+    parser.add_argument('--warmup', type=int, default=1, help='Cold starts to run first and discard')
+    parser.add_argument('--history', type=str, default=DEFAULT_HISTORY_PATH,
+                        help='JSONL file the results are appended to')
+    parser.add_argument('--no-history', action='store_true', help="Don't read or append to the history")
+    args = parser.parse_args()
+
+    record = run_benchmark(args.runs, args.warmup)
+    previous = None if args.no_history else read_last_record(args.history)
+
+    print(f"\nCold start over {record['runs']} runs (median, min-max):")
+    for name in METRICS:
+        stats = record[name]
+        line = f"  {name:<11} {stats['median']:>8.1f} ms  ({stats['min']:.1f}-{stats['max']:.1f})"
+        if previous and name in previous:
+            change = stats['median'] - previous[name]['median']
+            line += f"  {change:+.1f} ms vs {previous.get('git_commit') or previous['timestamp']}"
+        print(line)
+    print("Slowest packages to import (ms): " +
+          ', '.join(f"{name} {ms:.1f}" for name, ms in record['slowest_packages'].items()))
+
+    if not args.no_history:
+        history_dir = os.path.dirname(args.history)
+        if history_dir:
+            os.makedirs(history_dir, exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print(f"Appended to {args.history}")
+
+
+if __name__ == '__main__':
+    main()
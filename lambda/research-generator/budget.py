@@ -0,0 +1,270 @@
+"""
+Per-request token, cost and time budget for research trees.
+
+A ResearchBudget is created for each research request and passed down
+generate_answer_with_tree. While a node is being built it is the active
+budget (a context variable), and every Claude call the gateway completes
+is charged to it and to that node. The tree consults the budget before
+expanding a node and when choosing max_tokens for an answer, so a request
+degrades into shallower trees and shorter answers instead of running
+without bound.
+"""
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from config import (
+    RESEARCH_BUDGET, BUDGET_LOW_FRACTION, BUDGET_MIN_ANSWER_TOKENS, BUDGET_NODE_ESTIMATE, MODEL_PRICING,
+    DEADLINE_SYNTHESIS_SECONDS, DEADLINE_NODE_SECONDS
+)
+from deadline import Deadline
+
+# (budget, node_id) of the tree node currently being built on this thread
+_active = contextvars.ContextVar('research_budget', default=None)
+
+
+def call_cost(model: str, input_tokens: int, output_tokens: int,
+              cache_write_tokens: int = 0, cache_read_tokens: int = 0) -> float:
+    """Estimate the USD cost of a Claude call from its usage."""
+    prices = MODEL_PRICING.get(model)
+    if not prices:
+        return 0.0
+    input_cost = (input_tokens + cache_write_tokens * 1.25 + cache_read_tokens * 0.1) * prices['input']
+    return (input_cost + output_tokens * prices['output']) / 1e6
+
+
+def current_budget() -> Optional['ResearchBudget']:
+    """Return the budget of the tree node being built on this thread, if any."""
+    active = _active.get()
+    return active[0] if active else None
+
+
+def record_usage(model: str, usage: Any):
+    """Charge a completed Claude call's usage to the active budget and node, if any."""
+    active = _active.get()
+    if active is None:
+        return
+    budget, node_id = active
+    budget.record(
+        node_id, model,
+        input_tokens=getattr(usage, 'input_tokens', None) or 0,
+        output_tokens=getattr(usage, 'output_tokens', None) or 0,
+        cache_write_tokens=getattr(usage, 'cache_creation_input_tokens', None) or 0,
+        cache_read_tokens=getattr(usage, 'cache_read_input_tokens', None) or 0
+    )
+
+
+class ResearchBudget:
+    """
+    Input token, output token, cost and wall time limits for one research request.
+
+    Args:
+        max_input_tokens: Input tokens (including cache writes and reads) allowed
+        max_output_tokens: Output tokens allowed
+        max_seconds: Wall time allowed, measured from creation; None for no
+            wall time limit (batch research, where Claude calls wait on batches)
+        max_cost_usd: Estimated cost allowed (see MODEL_PRICING)
+        deadline: Hard deadline of the request, if any. The seconds limit is
+            capped by it, and the tree stops starting work that cannot finish
+            before it.
+    """
+
+    def __init__(self, max_input_tokens: int = RESEARCH_BUDGET['max_input_tokens'],
+                 max_output_tokens: int = RESEARCH_BUDGET['max_output_tokens'],
+                 max_seconds: Optional[float] = RESEARCH_BUDGET['max_seconds'],
+                 max_cost_usd: float = RESEARCH_BUDGET['max_cost_usd'],
+                 deadline: Optional[Deadline] = None):
+        if deadline is not None:
+            max_seconds = deadline.remaining() if max_seconds is None else min(max_seconds, deadline.remaining())
+        self.limits = {
+            'input_tokens': max_input_tokens,
+            'output_tokens': max_output_tokens,
+            'seconds': max_seconds,
+            'cost_usd': max_cost_usd
+        }
+        self.deadline = deadline
+        self.timed_out = False
+        self.start_time = time.time()
+        self.spent = {'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0}
+        self.calls = 0
+        self.nodes_collapsed = 0
+        self.children_dropped = 0
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, node_id: str) -> Iterator['ResearchBudget']:
+        """
+        Make this the active budget, charging calls to node_id, for the duration of the block.
+
+        A node tracked inside another node's block is its child: its seconds
+        are left out of the parent's own_seconds.
+        """
+        active = _active.get()
+        parent_id = active[1] if active and active[0] is self else None
+        with self._lock:
+            self._nodes.setdefault(node_id, {
+                'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0, 'calls': 0,
+                'started_at': time.time(), 'child_seconds': 0.0
+            })
+        token = _active.set((self, node_id))
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+            with self._lock:
+                node = self._nodes[node_id]
+                node['seconds'] = time.time() - node.pop('started_at')
+                node['own_seconds'] = max(0.0, node['seconds'] - node.pop('child_seconds'))
+                parent = self._nodes.get(parent_id)
+                if parent is not None and 'child_seconds' in parent:
+                    parent['child_seconds'] += node['seconds']
+
+    def record(self, node_id: str, model: str, input_tokens: int, output_tokens: int,
+               cache_write_tokens: int = 0, cache_read_tokens: int = 0):
+        """Charge one Claude call to the budget and to node_id."""
+        all_input_tokens = input_tokens + cache_write_tokens + cache_read_tokens
+        cost = call_cost(model, input_tokens, output_tokens, cache_write_tokens, cache_read_tokens)
+        with self._lock:
+            self.calls += 1
+            self.spent['input_tokens'] += all_input_tokens
+            self.spent['output_tokens'] += output_tokens
+            self.spent['cost_usd'] += cost
+            node = self._nodes.get(node_id)
+            if node is not None:
+                node['input_tokens'] += all_input_tokens
+                node['output_tokens'] += output_tokens
+                node['cost_usd'] += cost
+                node['calls'] += 1
+
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    def remaining(self) -> Dict[str, float]:
+        """Return what is left of each limit that is set (never negative)."""
+        with self._lock:
+            spent = dict(self.spent)
+        spent['seconds'] = self.elapsed()
+        return {key: max(0.0, limit - spent[key]) for key, limit in self.limits.items() if limit is not None}
+
+    def remaining_fraction(self) -> float:
+        """Return the smallest fraction left across all limits."""
+        remaining = self.remaining()
+        return min(remaining[key] / limit for key, limit in self.limits.items() if limit)
+
+    def is_low(self) -> bool:
+        """Check whether any limit is into the share kept back for syntheses."""
+        return self.remaining_fraction() < BUDGET_LOW_FRACTION
+
+    def can_expand(self) -> bool:
+        """Check whether a node may be broken down into sub-questions."""
+        return not self.is_low()
+
+    def node_estimate(self) -> Dict[str, float]:
+        """
+        Average spend of the nodes finished so far, or BUDGET_NODE_ESTIMATE before any have.
+
+        Seconds average each node's own time (its planning and answer), without
+        its children's, so the estimate does not grow with the tree's depth.
+        """
+        with self._lock:
+            finished = [node for node in self._nodes.values() if 'seconds' in node]
+            if not finished:
+                return dict(BUDGET_NODE_ESTIMATE)
+            estimate = {
+                key: max(sum(node[key] for node in finished) / len(finished), 1e-6)
+                for key in ('input_tokens', 'output_tokens', 'cost_usd')
+            }
+            estimate['seconds'] = max(sum(node['own_seconds'] for node in finished) / len(finished), 1e-6)
+            return estimate
+
+    def affordable_children(self, requested: int) -> int:
+        """
+        Return how many of the requested child nodes fit in the budget.
+
+        Each child is assumed to cost an average node, and the low-budget
+        share of every limit is kept back for the syntheses still to come.
+        """
+        remaining = self.remaining()
+        estimate = self.node_estimate()
+        affordable = requested
+        for key, limit in self.limits.items():
+            if limit is None:
+                continue
+            usable = remaining[key] - limit * BUDGET_LOW_FRACTION
+            affordable = min(affordable, int(max(0.0, usable) // estimate[key]))
+        if affordable < requested:
+            with self._lock:
+                self.children_dropped += requested - affordable
+        return affordable
+
+    def max_tokens_for(self, requested: int) -> int:
+        """
+        Shrink an answer's max_tokens to fit the budget.
+
+        Once the budget is low, max_tokens scales down with what is left,
+        and it never exceeds the output tokens remaining.
+        """
+        remaining = self.remaining()
+        fraction = self.remaining_fraction()
+        max_tokens = requested
+        if fraction < BUDGET_LOW_FRACTION:
+            max_tokens = int(requested * fraction / BUDGET_LOW_FRACTION)
+        max_tokens = min(max_tokens, int(remaining['output_tokens']))
+        return max(BUDGET_MIN_ANSWER_TOKENS, max_tokens)
+
+    def deadline_allows(self, depth: int, nodes: int = 1) -> bool:
+        """
+        Check whether nodes more nodes below a node at depth can finish before the deadline.
+
+        Enough time is kept back for the synthesis at each level from depth up
+        to the root. Always True without a deadline.
+        """
+        if self.deadline is None:
+            return True
+        needed = DEADLINE_SYNTHESIS_SECONDS * (depth + 1) + DEADLINE_NODE_SECONDS * nodes
+        return self.deadline.remaining() >= needed
+
+    def record_timeout(self):
+        """Note that part of the tree was skipped or cut short because of the deadline."""
+        with self._lock:
+            self.timed_out = True
+
+    def record_collapse(self):
+        with self._lock:
+            self.nodes_collapsed += 1
+
+    def node_spend(self, node_id: str) -> Dict[str, Any]:
+        """
+        Return the spend charged to a single node.
+
+        Tokens, cost and calls cover the node's own Claude calls, not its
+        children's; seconds is the node's wall time including its children,
+        and own_seconds the part of it spent outside its children.
+        """
+        with self._lock:
+            node = dict(self._nodes.get(node_id, {}))
+        node.pop('started_at', None)
+        node.pop('child_seconds', None)
+        node['cost_usd'] = round(node.get('cost_usd', 0.0), 6)
+        node['seconds'] = round(node.get('seconds', 0.0), 2)
+        node['own_seconds'] = round(node.get('own_seconds', 0.0), 2)
+        return node
+
+    def summary(self) -> Dict[str, Any]:
+        """Return limits, total spend and how the budget shaped the tree."""
+        with self._lock:
+            spent = dict(self.spent)
+        spent['seconds'] = round(self.elapsed(), 2)
+        spent['cost_usd'] = round(spent['cost_usd'], 6)
+        return {
+            'limits': dict(self.limits),
+            'spent': spent,
+            'calls': self.calls,
+            'nodes_collapsed': self.nodes_collapsed,
+            'children_dropped': self.children_dropped,
+            'deadline_seconds': round(self.deadline.seconds, 2) if self.deadline else None,
+            'timed_out': self.timed_out
+        }
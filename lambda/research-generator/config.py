@@ -6,6 +6,8 @@ import os
 # Maximum allowed values for user-configurable parameters
 MAX_ALLOWED_RECURSION_DEPTH = 4
 MAX_ALLOWED_SUB_QUESTIONS = 5
+MAX_ALLOWED_RECURSION_THRESHOLD = 2
+MIN_ALLOWED_SUB_QUESTIONS = 2  # A node planned with fewer sub-questions is answered without breaking it down
 
 # Default values
 DEFAULT_RECURSION_DEPTH = 2
@@ -17,11 +19,183 @@ VECTOR_DB_TYPE = "faiss"  # Options: faiss, milvus, pinecone
 EMBEDDING_MODEL = "text-embedding-3-small"  # OpenAI's embedding model
 VECTOR_DB_PATH = "/tmp/vector_db"  # Use Lambda's writable /tmp directory
 TOP_K_RESULTS = 3  # Number of most relevant documents to retrieve
+# Read-only base index produced by ingest_corpus.py, shipped in the deployment package or a
+# layer (e.g. /opt/prebuilt_index) and opened with mmap. /tmp only holds the writable delta.
+PREBUILT_INDEX_PATH = os.environ.get(
+    'PREBUILT_INDEX_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prebuilt_index')
+)
+BASE_INDEX_IVF_MIN_VECTORS = 4096  # Smaller base indexes stay flat instead of IVF
+BASE_INDEX_NPROBE = 16  # IVF lists probed per base index search
 
 # Model configuration
 DEFAULT_MODEL = "claude-3-5-sonnet-20240620"  # Using Sonnet for better quality
 DEFAULT_ANSWER_MAX_TOKENS = 1800  # Restored to original value for comprehensive final answer
 DEFAULT_EVALUATION_MAX_TOKENS = 400  # Keep unchanged
+FAST_MODEL = "claude-3-haiku-20240307"  # Lower latency model for short, structured stages
+
+# Per-stage model routing (RAGEngine._route). Answers are further capped by depth
+# (get_token_limit_for_depth). When a model is overloaded, keeps failing or has an open
+# circuit, the gateway moves on to the stage's fallbacks in order.
+MODEL_ROUTES = {
+    # complexity of each internal node while its search runs (node_executor.py), and the
+    # simple/complex answer style when no plan is available
+    'classifier': {'model': FAST_MODEL, 'max_tokens': 10, 'temperature': 0, 'fallbacks': [DEFAULT_MODEL]},
+    # complexity, answer style and sub-questions for each non-leaf node
+    'planner': {'model': FAST_MODEL, 'max_tokens': DEFAULT_EVALUATION_MAX_TOKENS, 'temperature': 0,
+                'fallbacks': [DEFAULT_MODEL]},
+    # concise answers for sub-questions (depth >= 1)
+    'leaf_answer': {'model': FAST_MODEL, 'max_tokens': 800, 'temperature': 1.0, 'fallbacks': [DEFAULT_MODEL]},
+    # condensing groups of child answers when a parent's synthesis input is over budget
+    'synthesis_map': {'model': FAST_MODEL, 'max_tokens': 500, 'temperature': 0, 'fallbacks': [DEFAULT_MODEL]},
+    # the answer returned to the user (depth 0)
+    'root_synthesis': {'model': DEFAULT_MODEL, 'max_tokens': DEFAULT_ANSWER_MAX_TOKENS, 'temperature': 1.0,
+                       'fallbacks': [FAST_MODEL]},
+}
+
+# Node preparation (node_executor.py): assess an internal node's complexity from the question alone
+# while its Brave search and ingestion run, skip the planner call for questions it rates as very simple,
+# and give the planner its rating for the others
+SPECULATIVE_PLANNING = os.environ.get('SPECULATIVE_PLANNING', 'true').lower() == 'true'
+NODE_EXECUTOR_STEPS_PER_TREE = 2  # Background steps per tree at once: a node's search, its children's prefetch
+QUERY_EMBEDDING_CACHE_SIZE = 512  # Retrieval query embeddings kept per engine
+
+# Asynchronous research jobs (job_store.py, lambda_function.py)
+# file:///dir, sqlite:///path/to/jobs.db or s3://bucket/prefix. Lambda containers don't share
+# /tmp, so deployments set an S3 URL; the file and SQLite stores are for local runs and tests.
+JOB_STORE_URL = os.environ.get('JOB_STORE_URL', 'file:///tmp/research_jobs')
+# 'lambda': run jobs in an asynchronous (InvocationType=Event) invocation of this function;
+# 'thread': run them in a background thread of the submitting process (local runs only)
+JOB_WORKER_MODE = os.environ.get('JOB_WORKER_MODE', 'lambda' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'thread')
+JOB_PROGRESS_INTERVAL = 2.0  # Minimum seconds between progress writes to the job store
+
+# Cold starts (lambda_function.py): API keys, the RAG engine and the Anthropic client are created
+# once per container, during the Lambda init phase when PRELOAD_ON_INIT is set, and reused
+PRELOAD_ON_INIT = os.environ.get('PRELOAD_ON_INIT', 'true' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'false').lower() == 'true'
+API_KEY_CACHE_SECONDS = 3600  # API keys read from SSM are re-read after this long, to pick up rotations
+
+# Logging (log.py): DEBUG adds the per-chunk, per-document and per-step messages of the hot
+# paths, which production leaves off. 'json' writes one JSON object per line (for CloudWatch
+# Logs Insights), 'text' a readable line.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'text').lower()
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', '20'))  # Sampled per-item messages: 1st, 21st, 41st... of each kind
+
+# Long-running server (server.py): one process serves many concurrent research requests
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('PORT', '8080'))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '16'))  # Research requests handled at once; more wait for a worker
+SERVER_REQUEST_TIMEOUT_SECONDS = 900  # Deadline of each request's tree, as Lambda's maximum timeout
+SERVER_SHUTDOWN_GRACE_SECONDS = 60  # On shutdown, in-flight requests get this long to finish
+HTTP_POOL_MAXSIZE = 32  # Pooled connections per host for Brave Search and page fetches
+HTTP_TIMEOUT_SECONDS = 20  # Connect and read timeout of those requests
+
+# In-flight coalescing (singleflight.py): concurrent identical research requests, Brave searches,
+# query embeddings and Claude calls share one computation
+SINGLEFLIGHT_ENABLED = os.environ.get('SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'
+
+# Request tracing (tracing.py): per-stage and per-node timings in metadata.timings
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', 'true').lower() == 'true'
+# Spans kept per request for the trace file; later spans are still counted in the timings
+TRACE_MAX_SPANS = 5000
+# Directory (or None) each request's Chrome trace file is written to
+TRACE_EXPORT_DIR = os.environ.get('TRACE_EXPORT_DIR') or None
+
+# Response bodies (response_format.py): compressed with brotli or gzip when the client accepts it
+RESPONSE_COMPRESSION_MIN_BYTES = 1024  # Smaller bodies are sent uncompressed
+# API Gateway's binaryMediaTypes (cdk/lib/research-stack.ts). It only decodes a base64 (compressed) response body
+# for a request whose first Accept type is one of them, so other API Gateway requests get uncompressed bodies
+API_GATEWAY_BINARY_MEDIA_TYPES = ('application/json',)
+
+# Whole-result cache for repeated questions (result_cache.py)
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+# sqlite:///path (per container) or s3://bucket/prefix (shared by all containers)
+RESULT_CACHE_URL = os.environ.get('RESULT_CACHE_URL', 'sqlite:///tmp/result_cache.db')
+RESULT_CACHE_TTL_SECONDS = 6 * 3600  # Results are served as they are for this long
+RESULT_CACHE_STALE_SECONDS = 3 * 24 * 3600  # Then served stale, and refreshed in the background, until this age
+RESULT_CACHE_REFRESH_TIMEOUT = 900  # A background refresh claimed longer ago is presumed to have died
+
+# Parent answer synthesis (synthesis.py): child answers are compacted into notes, and
+# condensed in groups (map-reduce) while they exceed the input budget
+SYNTHESIS_NOTE_MAX_TOKENS = 400  # Per child answer, after compaction
+SYNTHESIS_MAX_INPUT_TOKENS = 2500  # Notes sent to the final synthesis call
+SYNTHESIS_GROUP_TOKENS = 1500  # Notes per condensing call
+SYNTHESIS_MAX_LEVELS = 3  # Rounds of condensing before the notes are truncated
+
+# Per-request research budget (budget.py). Spend is counted from every Claude call's usage;
+# when less than BUDGET_LOW_FRACTION of any limit is left, subtrees are collapsed into leaf
+# answers and answer max_tokens are scaled down.
+RESEARCH_BUDGET = {
+    'max_input_tokens': 250000,  # Including prompt cache writes and reads
+    'max_output_tokens': 25000,
+    'max_seconds': 480,  # The Lambda timeout is 10 minutes
+    'max_cost_usd': 1.50,
+}
+BUDGET_LOW_FRACTION = 0.2  # Share of each limit kept back for the remaining syntheses
+BUDGET_MIN_ANSWER_TOKENS = 150  # Answers are never shrunk below this many output tokens
+# Assumed spend of a leaf node before any node in the request has finished
+BUDGET_NODE_ESTIMATE = {'input_tokens': 5000, 'output_tokens': 600, 'seconds': 10, 'cost_usd': 0.02}
+# Hard deadline (deadline.py), derived from the Lambda invocation's remaining time. Work that
+# cannot finish in time is skipped and the partial tree is returned, marked timed_out.
+DEADLINE_SAFETY_MARGIN_SECONDS = 15  # Kept back for building and returning the response
+DEADLINE_SYNTHESIS_SECONDS = 30  # Kept back per tree level for the syntheses above a node
+DEADLINE_NODE_SECONDS = 15  # Least time a sub-question (a leaf answer) is started with
+DEADLINE_MIN_CALL_SECONDS = 5  # Claude calls are not started with less time than this
+# Adaptive tree shape (tree_shape.py): requests with target_latency_seconds get the largest
+# tree whose estimated build time fits, from the gateway's measured per-model latencies
+ADAPTIVE_DEFAULT_LATENCIES = {  # Seconds per call of each stage until enough calls are measured
+    'classifier': 1.0,
+    'planner': 3.0,
+    'leaf_answer': 6.0,
+    'root_synthesis': 20.0,
+}
+ADAPTIVE_MIN_SAMPLES = 5  # Calls to a model before its measured median latency is trusted
+ADAPTIVE_SEARCH_SECONDS = 3.0  # Brave search and ingestion of a node's results
+# USD per million tokens; cache writes cost 1.25x and cache reads 0.1x the input price
+MODEL_PRICING = {
+    DEFAULT_MODEL: {'input': 3.00, 'output': 15.00},
+    FAST_MODEL: {'input': 0.25, 'output': 1.25},
+}
+
+# LLM gateway (llm_gateway.py): per-model token buckets shared by every call in the process
+LLM_RATE_LIMITS = {
+    'default': {
+        'requests_per_minute': 50,
+        'input_tokens_per_minute': 40000,
+        'output_tokens_per_minute': 8000,
+    },
+}
+LLM_MAX_RETRIES = 5  # Retries of retryable errors only (429, 5xx, 529, connection errors)
+LLM_RETRY_BASE_DELAY = 0.5  # Seconds; full-jitter exponential backoff when no Retry-After is sent
+LLM_RETRY_MAX_DELAY = 30  # Seconds; cap on any single retry wait, including Retry-After
+LLM_CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failures before a model's circuit opens
+LLM_CIRCUIT_RESET_SECONDS = 30  # Seconds an open circuit rejects calls before a trial call
+
+# Offline batch research (batch_research.py): Claude requests from many trees are submitted
+# together through the Message Batches API instead of one synchronous call at a time
+BATCH_API_URL = "https://api.anthropic.com/v1/messages/batches"
+BATCH_API_BETA = "message-batches-2024-09-24"
+BATCH_POLL_SECONDS = 30  # Seconds between batch status checks
+BATCH_HTTP_TIMEOUT_SECONDS = 120  # Connect and read timeout of Batches API requests (results can be large)
+BATCH_COLLECT_SECONDS = 30  # Longest wait for every running tree to reach its next Claude call
+BATCH_MAX_REQUESTS = 10000  # Message Batches API limit on requests per batch
+BATCH_MAX_TREES = 200  # Questions researched concurrently
+# Batches have their own, much higher limits, so batch mode does not throttle like live requests
+BATCH_RATE_LIMITS = {
+    'default': {
+        'requests_per_minute': 100000,
+        'input_tokens_per_minute': 100000000,
+        'output_tokens_per_minute': 100000000,
+    },
+}
+
+# Prompt caching: the static system prefix shared by every Claude call is marked cacheable,
+# so after the first call in a ~5 minute window it is read from the provider's cache
+PROMPT_CACHING_ENABLED = os.environ.get('PROMPT_CACHING_ENABLED', 'true').lower() == 'true'
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"  # anthropic-beta header required by anthropic==0.18
+# Shortest prefix the API caches, by model family. A shorter prefix is sent without a breakpoint:
+# the shared prefix (~1.2k tokens) is only cached for Sonnet-routed stages (root_synthesis)
+PROMPT_CACHE_MIN_TOKENS = {'haiku': 2048, 'default': 1024}
 
 # RAG configuration
 CHUNK_SIZE = 150  # Reduced from 250 to prevent potential memory issues
@@ -34,5 +208,20 @@ if CHUNK_SIZE <= CHUNK_OVERLAP:
 if CHUNK_SIZE <= 0 or CHUNK_OVERLAP < 0:
     raise ValueError("CHUNK_SIZE must be positive and CHUNK_OVERLAP must be non-negative")
 
+# Context assembly (context_assembler.py): what retrieved chunks are sent to Claude as context
+CONTEXT_MAX_TOKENS = 1500  # Token budget for the assembled context of one prompt
+CONTEXT_DUPLICATE_THRESHOLD = 0.8  # Word-shingle Jaccard similarity above which a passage is a near-duplicate
+CONTEXT_SHINGLE_SIZE = 3  # Words per shingle when comparing passages
+CONTEXT_MIN_PASSAGE_TOKENS = 30  # Don't truncate a passage to fit the budget below this many tokens
+
+# Ingestion pipeline settings (ingest_pipeline.py, ingest_corpus.py)
+INGEST_EMBED_BATCH_SIZE = 256  # Minimum chunks per embedding request batch
+INGEST_QUEUE_SIZE = 4  # Items buffered between pipeline stages (bounds memory)
+INGEST_CHECKPOINT_EVERY = 10  # Batches between index checkpoints
+# A checkpoint rewrites the whole index, so it also waits until the index has grown by this fraction
+# since the last one: the total written stays proportional to the corpus instead of quadratic in it
+INGEST_CHECKPOINT_GROWTH = 0.25
+MAX_EMBEDDING_INPUTS = 2048  # OpenAI limit on inputs per embeddings request
+
 # Additional token limits
 DEFAULT_SUB_QUESTION_MAX_TOKENS = 500 
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+Context assembly for Claude prompts.
+
+Retrieval returns chunk dicts ({'content': ..., 'metadata': {...}}) in
+relevance order. assemble_context turns them into the context block of a
+prompt: only chunk text is sent, overlapping and adjacent chunks of the same
+source are merged back into one passage, near-duplicate passages are dropped,
+and passages are packed most relevant first up to a token budget, each under
+a source marker.
+"""
+import re
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config import (
+    CHUNK_OVERLAP, CONTEXT_MAX_TOKENS, CONTEXT_DUPLICATE_THRESHOLD,
+    CONTEXT_SHINGLE_SIZE, CONTEXT_MIN_PASSAGE_TOKENS
+)
+from llm_gateway import estimate_tokens
+from log import get_logger
+
+logger = get_logger(__name__)
+
+_WORD = re.compile(r"\w+")
+
+
+def _passages(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Turn retrieved chunks into passages, keeping each chunk's retrieval rank."""
+    passages = []
+    for rank, doc in enumerate(docs):
+        if not isinstance(doc, dict):
+            continue
+        text = (doc.get('content') or '').strip()
+        if not text:
+            continue
+        metadata = doc.get('metadata') or {}
+        start = metadata.get('char_start')
+        passages.append({
+            'text': doc['content'],
+            'source': metadata.get('source', 'Unknown source'),
+            'title': metadata.get('title', 'Untitled'),
+            'rank': rank,
+            'start': start,
+            'end': start + len(doc['content']) if start is not None else None
+        })
+    return passages
+
+
+def _merge_source(passages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Merge overlapping and adjacent chunks of one source.
+
+    Chunks with a char_start are merged by position. Chunks indexed before
+    positions were recorded are merged when one starts with the CHUNK_OVERLAP
+    characters the other ends with, the way _chunk_text cuts them.
+    """
+    positioned = sorted((p for p in passages if p['start'] is not None), key=lambda p: p['start'])
+    merged = []
+    for passage in positioned:
+        last = merged[-1] if merged else None
+        if last is not None and passage['start'] <= last['end']:
+            if passage['end'] > last['end']:
+                last['text'] += passage['text'][last['end'] - passage['start']:]
+                last['end'] = passage['end']
+            last['rank'] = min(last['rank'], passage['rank'])
+        else:
+            merged.append(dict(passage))
+
+    unpositioned = [dict(p) for p in passages if p['start'] is None]
+    joined = True
+    while joined and CHUNK_OVERLAP > 0:
+        joined = False
+        for first in unpositioned:
+            tail = first['text'][-CHUNK_OVERLAP:]
+            for second in unpositioned:
+                if second is first or len(second['text']) <= CHUNK_OVERLAP or not second['text'].startswith(tail):
+                    continue
+                first['text'] += second['text'][CHUNK_OVERLAP:]
+                first['rank'] = min(first['rank'], second['rank'])
+                unpositioned.remove(second)
+                joined = True
+                break
+            if joined:
+                break
+    return merged + unpositioned
+
+
+def _shingles(text: str) -> Set[Tuple[str, ...]]:
+    words = _WORD.findall(text.lower())
+    if len(words) < CONTEXT_SHINGLE_SIZE:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + CONTEXT_SHINGLE_SIZE]) for i in range(len(words) - CONTEXT_SHINGLE_SIZE + 1)}
+
+
+def _is_near_duplicate(shingles: Set[Tuple[str, ...]], kept: List[Set[Tuple[str, ...]]],
+                       threshold: float) -> bool:
+    """Check whether a passage is mostly contained in, or mostly the same as, a kept one."""
+    if not shingles:
+        return True
+    for other in kept:
+        overlap = len(shingles & other)
+        if not overlap:
+            continue
+        jaccard = overlap / len(shingles | other)
+        containment = overlap / len(shingles)
+        if jaccard >= threshold or containment >= threshold:
+            return True
+    return False
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cut text to about max_tokens, at a word boundary."""
+    cut = text[:max(0, (max_tokens - 1) * 4)]
+    if ' ' in cut:
+        cut = cut[:cut.rfind(' ')]
+    return cut.rstrip() + ' ...'
+
+
+def _marker(passage: Dict[str, Any]) -> str:
+    return f"[Source: {passage['title']} ({passage['source']})]"
+
+
+def assemble_context(docs: List[Dict[str, Any]], max_tokens: Optional[int] = None,
+                     duplicate_threshold: float = CONTEXT_DUPLICATE_THRESHOLD) -> str:
+    """
+    Build a prompt context block from retrieved chunks.
+
+    Args:
+        docs: Retrieved chunk dicts, most relevant first
+        max_tokens: Token budget for the whole block (default CONTEXT_MAX_TOKENS)
+        duplicate_threshold: Shingle similarity above which a passage is dropped
+
+    Returns:
+        Passages separated by blank lines, each under a source marker, or an
+        empty string when no chunk has text
+    """
+    max_tokens = CONTEXT_MAX_TOKENS if max_tokens is None else max_tokens
+    passages = _passages(docs)
+
+    by_source = {}
+    for passage in passages:
+        by_source.setdefault(passage['source'], []).append(passage)
+    merged = [p for source_passages in by_source.values() for p in _merge_source(source_passages)]
+    merged.sort(key=lambda p: p['rank'])
+
+    kept_shingles = []
+    sections = []
+    used_tokens = 0
+    duplicates = 0
+    truncated = 0
+    for passage in merged:
+        text = passage['text'].strip()
+        shingles = _shingles(text)
+        if _is_near_duplicate(shingles, kept_shingles, duplicate_threshold):
+            duplicates += 1
+            continue
+
+        marker = _marker(passage)
+        available = max_tokens - used_tokens - estimate_tokens(marker)
+        if estimate_tokens(text) > available:
+            if available < CONTEXT_MIN_PASSAGE_TOKENS:
+                continue
+            text = _truncate(text, available)
+            truncated += 1
+
+        section = f"{marker}\n{text}"
+        sections.append(section)
+        kept_shingles.append(shingles)
+        used_tokens += estimate_tokens(section)
+
+    logger.debug("Assembled context", chunks=len(passages), passages=len(merged), kept=len(sections),
+                 duplicates=duplicates, truncated=truncated, tokens=used_tokens)
+    return "\n\n".join(sections)
@@ -0,0 +1,59 @@
+"""
+Hard deadlines for research requests.
+
+Lambda kills an invocation at its timeout and the client then gets nothing.
+lambda_handler derives a Deadline from context.get_remaining_time_in_millis(),
+minus a safety margin for building and returning the response, and passes it
+to the request's ResearchBudget. The tree checks it before expanding a node
+and before starting each sub-question, the gateway checks it before every
+Claude call and caps the call's timeout by it, and whatever was built by then
+is returned as a partial tree marked timed_out.
+"""
+import time
+from typing import Optional
+
+from config import DEADLINE_SAFETY_MARGIN_SECONDS
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting work that cannot finish before the deadline."""
+
+
+class Deadline:
+    """
+    A point in time that work must be finished by.
+
+    Args:
+        seconds: Seconds from now until the deadline
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_lambda_context(cls, context, margin: float = DEADLINE_SAFETY_MARGIN_SECONDS) -> Optional['Deadline']:
+        """Return the deadline of a Lambda invocation, or None without a Lambda context (local runs)."""
+        if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+            return None
+        return cls(max(0.0, context.get_remaining_time_in_millis() / 1000 - margin))
+
+    def remaining(self) -> float:
+        """Seconds left before the deadline (never negative)."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, needed_seconds: float, what: str):
+        """
+        Raise DeadlineExceeded unless at least needed_seconds are left.
+
+        Args:
+            needed_seconds: Time the work is expected to take at least
+            what: Description of the work, for the error message
+        """
+        remaining = self.remaining()
+        if remaining < needed_seconds:
+            raise DeadlineExceeded(f"Not enough time left for {what}: {remaining:.1f} seconds "
+                                   f"remaining, {needed_seconds:.1f} needed")
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Bulk ingestion of local document corpora into the knowledge base.
+
+Streams a directory of HTML, PDF, JSONL and plain-text files through the
+ingestion pipeline (read -> extract -> chunk -> embed -> index), checkpointing progress so an interrupted
+run can be resumed, and emits a prebuilt index artifact that the Lambda
+function opens read-only with mmap on cold start (see base_index.py and
+PREBUILT_INDEX_PATH in config.py).
+
+Indexed chunks are appended to documents.jsonl in the work directory as
+they are indexed, instead of being kept in memory. A checkpoint rewrites
+the FAISS index, so checkpoints are spaced out as the index grows
+(INGEST_CHECKPOINT_GROWTH).
+
+Usage:
+    python ingest_corpus.py ./corpus
+    python ingest_corpus.py ./corpus --output prebuilt_index --batch-size 512
+    python ingest_corpus.py ./corpus --fresh   # ignore any existing checkpoint
+
+JSONL files contain one document per line with a 'content' (or 'text') field
+and optional 'title', 'url'/'source' and 'metadata' fields.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+
+import faiss
+
+from config import (
+    EMBEDDING_MODEL, PREBUILT_INDEX_PATH, INGEST_EMBED_BATCH_SIZE, INGEST_CHECKPOINT_EVERY, INGEST_CHECKPOINT_GROWTH
+)
+from rag_engine import RAGEngine
+from knowledge_base import extract_html_text, extract_pdf_text
+from base_index import DOCUMENTS_FILE, write_base_index
+from ingest_pipeline import IndexedBatch
+from sources_ledger import SourcesLedger
+
+SUPPORTED_EXTENSIONS = {
+    '.html': 'html',
+    '.htm': 'html',
+    '.pdf': 'pdf',
+    '.jsonl': 'jsonl',
+    '.txt': 'text',
+    '.md': 'text',
+}
+
+
+def discover_files(corpus_dir: str) -> List[str]:
+    """Return all supported files under corpus_dir in a stable order."""
+    paths = []
+    for root, dirs, files in os.walk(corpus_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS:
+                paths.append(os.path.join(root, name))
+    return paths
+
+
+def iter_file_documents(path: str, start_record: int = 0) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Yield (record_number, document) pairs for a single corpus file.
+
+    HTML, PDF and text files produce a single record (number 0). JSONL files
+    produce one record per line, so a resumed run can skip to start_record.
+    """
+    file_type = SUPPORTED_EXTENSIONS[os.path.splitext(path)[1].lower()]
+    fetched_at = str(datetime.now())
+
+    if file_type == 'jsonl':
+        with open(path, 'r', encoding='utf-8') as f:
+            for record_number, line in enumerate(f):
+                if record_number < start_record or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"Skipping malformed line {record_number + 1} in {path}: {str(e)}")
+                    continue
+
+                content = record.get('content') or record.get('text') or ''
+                if not content:
+                    continue
+                source = record.get('url') or record.get('source') or f"{path}#{record_number + 1}"
+                yield record_number, {
+                    'content': content,
+                    'metadata': {
+                        **record.get('metadata', {}),
+                        'source': source,
+                        'type': 'jsonl',
+                        'title': record.get('title', '') or os.path.basename(path),
+                        'fetched_at': fetched_at
+                    }
+                }
+        return
+
+    if start_record > 0:
+        return
+
+    if file_type == 'html':
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            page = extract_html_text(f.read())
+        content, title = page['content'], page['title']
+    elif file_type == 'pdf':
+        with open(path, 'rb') as f:
+            content = extract_pdf_text(f)
+        title = ''
+    else:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            content = f.read()
+        title = ''
+
+    if content.strip():
+        yield 0, {
+            'content': content,
+            'metadata': {
+                'source': path,
+                'type': file_type,
+                'title': title or os.path.basename(path),
+                'fetched_at': fetched_at
+            }
+        }
+
+
+class IngestCheckpoint:
+    """
+    Resumable ingestion position, persisted atomically after each index save.
+
+    Files are ingested in a stable order, so the position is the last
+    (file, record) whose chunks are safely in the saved index. documents_bytes
+    is the length of documents.jsonl at that point.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_file = None
+        self.last_record = -1
+        self.documents = 0
+        self.chunks = 0
+        self.documents_bytes = 0
+
+    def load(self) -> bool:
+        """Load the checkpoint from disk. Returns False if there is none."""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r') as f:
+            state = json.load(f)
+        self.last_file = state.get('last_file')
+        self.last_record = state.get('last_record', -1)
+        self.documents = state.get('documents', 0)
+        self.chunks = state.get('chunks', 0)
+        self.documents_bytes = state.get('documents_bytes', 0)
+        return True
+
+    def save(self):
+        """Write the checkpoint via a temporary file so it is never half-written."""
+        state = {
+            'last_file': self.last_file,
+            'last_record': self.last_record,
+            'documents': self.documents,
+            'chunks': self.chunks,
+            'documents_bytes': self.documents_bytes,
+            'updated_at': str(datetime.now())
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def remaining(self, files: List[str]) -> Iterator[Tuple[str, int]]:
+        """Yield (path, start_record) for every file that still needs ingesting."""
+        resume_index = files.index(self.last_file) if self.last_file in files else -1
+        for i, path in enumerate(files):
+            if i < resume_index:
+                continue
+            if i == resume_index:
+                yield path, self.last_record + 1
+            else:
+                yield path, 0
+
+
+class IngestProgress:
+    """Track and print ingestion progress and throughput."""
+
+    def __init__(self, total_files: int):
+        self.total_files = total_files
+        self.files_done = 0
+        self.documents = 0
+        self.chunks = 0
+        self.characters = 0
+        self.start_time = time.time()
+
+    def record_batch(self, batch: IndexedBatch):
+        self.documents += len(batch.documents)
+        self.chunks += len(batch.chunks)
+        self.characters += sum(len(chunk['content']) for chunk in batch.chunks)
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print(
+            f"[{self.files_done}/{self.total_files} files] "
+            f"{self.documents} docs, {self.chunks} chunks in {elapsed:.1f}s | "
+            f"{self.documents / elapsed:.2f} docs/s, {self.chunks / elapsed:.1f} chunks/s, "
+            f"{self.characters / elapsed / 1e6:.2f} MB/s"
+        )
+
+
+def ingest_corpus(corpus_dir: str, work_dir: str, embed_batch_size: int = INGEST_EMBED_BATCH_SIZE,
+                  checkpoint_every: int = INGEST_CHECKPOINT_EVERY, fresh: bool = False) -> Dict[str, Any]:
+    """
+    Ingest every supported file under corpus_dir into the index in work_dir.
+
+    Files are streamed through the ingestion pipeline: reading and parsing,
+    chunking, embedding and indexing run concurrently with bounded queues in
+    between, so memory use does not grow with the size of the corpus.
+
+    Args:
+        corpus_dir: Directory containing the corpus files
+        work_dir: Directory holding the index being built and the checkpoint
+        embed_batch_size: Minimum number of chunks embedded per batch
+        checkpoint_every: Minimum number of batches between index saves and checkpoints
+        fresh: Discard any existing work directory instead of resuming
+
+    Returns:
+        Summary statistics for the run
+    """
+    if fresh and os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+
+    checkpoint = IngestCheckpoint(os.path.join(work_dir, 'checkpoint.json'))
+    if checkpoint.load():
+        print(f"Resuming from checkpoint after {checkpoint.last_file} record {checkpoint.last_record}: "
+              f"{checkpoint.documents} documents, {checkpoint.chunks} chunks")
+
+    # The work directory is built on its own; the shipped base index is not searched here
+    rag = RAGEngine(vector_db_path=work_dir, use_base_index=False, ledger_path=os.path.join(work_dir, 'sources.db'))
+    rag.set_openai_key(os.environ['OPENAI_API_KEY'])
+    kb_manager = rag.kb_manager
+
+    if rag.index.ntotal != checkpoint.chunks:
+        print(f"WARNING: Index holds {rag.index.ntotal} vectors but the checkpoint expects "
+              f"{checkpoint.chunks}. Re-run with --fresh if the work directory is corrupted.")
+
+    files = discover_files(corpus_dir)
+    progress = IngestProgress(len(files))
+    print(f"Found {len(files)} supported files in {corpus_dir}")
+
+    batches_since_checkpoint = 0
+    saved_chunks = checkpoint.chunks
+
+    def save_checkpoint():
+        nonlocal batches_since_checkpoint, saved_chunks
+        documents_file.flush()
+        os.fsync(documents_file.fileno())
+        # Writes the index, an empty documents.npy (the chunks are in documents.jsonl) and the sources
+        kb_manager.flush()
+        checkpoint.chunks = saved_chunks = rag.index.ntotal
+        checkpoint.documents_bytes = documents_file.tell()
+        checkpoint.save()
+        batches_since_checkpoint = 0
+
+    def on_batch_indexed(batch):
+        nonlocal batches_since_checkpoint
+        for chunk in batch.chunks:
+            documents_file.write(json.dumps(chunk, default=str).encode('utf-8') + b'\n')
+        # Runs on the index stage's thread, right after the batch was added
+        rag.documents.clear()
+        progress.record_batch(batch)
+        checkpoint.last_file, checkpoint.last_record = batch.tags[-1]
+        checkpoint.documents += len(batch.documents)
+        progress.files_done = files.index(checkpoint.last_file)
+        progress.report()
+        batches_since_checkpoint += 1
+        grown = rag.index.ntotal - saved_chunks >= INGEST_CHECKPOINT_GROWTH * saved_chunks
+        if batches_since_checkpoint >= checkpoint_every and grown:
+            save_checkpoint()
+
+    def extract_file(task, _):
+        path, start_record = task
+        for record_number, document in iter_file_documents(path, start_record):
+            yield (path, record_number), document
+
+    with open(os.path.join(work_dir, DOCUMENTS_FILE), 'ab') as documents_file:
+        # Drop the chunks appended after the last checkpoint; they are ingested again
+        documents_file.truncate(checkpoint.documents_bytes)
+        documents_file.seek(0, os.SEEK_END)
+        pipeline_stats = kb_manager.ingest(
+            checkpoint.remaining(files),
+            extract=extract_file,
+            persist=False,
+            on_batch_indexed=on_batch_indexed,
+            embed_batch_size=embed_batch_size
+        )
+        save_checkpoint()
+    progress.files_done = len(files)
+    progress.report()
+
+    return {
+        'files': len(files),
+        'documents': checkpoint.documents,
+        'chunks': checkpoint.chunks,
+        'batches': pipeline_stats['batches'],
+        'elapsed_seconds': round(time.time() - progress.start_time, 2)
+    }
+
+
+def export_artifact(work_dir: str, output_dir: str, stats: Dict[str, Any]):
+    """Write the built index to output_dir as a base index artifact with a manifest."""
+    index = faiss.read_index(os.path.join(work_dir, 'index.faiss'))
+
+    def read_documents():
+        with open(os.path.join(work_dir, DOCUMENTS_FILE), 'rb') as f:
+            for line in f:
+                yield json.loads(line)
+
+    write_base_index(index, read_documents(), output_dir)
+
+    ledger = SourcesLedger(os.path.join(work_dir, 'sources.db'))
+    ledger.backup(os.path.join(output_dir, 'sources.db'))
+    ledger.close()
+
+    manifest = {
+        **stats,
+        'embedding_model': EMBEDDING_MODEL,
+        'created_at': str(datetime.now())
+    }
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Index artifact written to {output_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk-ingest a document corpus into the knowledge base.')
+    parser.add_argument('corpus_dir', type=str, help='Directory of HTML, PDF, JSONL or text files')
+    parser.add_argument('--output', '-o', type=str, default=PREBUILT_INDEX_PATH,
+                        help='Directory for the base index artifact opened by Lambda')
+    parser.add_argument('--work-dir', '-w', type=str,
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ingest'),
+                        help='Directory for the in-progress index and checkpoint')
+    parser.add_argument('--batch-size', '-b', type=int, default=INGEST_EMBED_BATCH_SIZE,
+                        help='Minimum chunks embedded and indexed per batch')
+    parser.add_argument('--checkpoint-every', '-c', type=int, default=INGEST_CHECKPOINT_EVERY,
+                        help='Batches between checkpoints')
+    parser.add_argument('--fresh', action='store_true',
+                        help='Ignore any existing checkpoint and start over')
+    args = parser.parse_args()
+
+    if 'OPENAI_API_KEY' not in os.environ:
+        raise ValueError("Please set OPENAI_API_KEY environment variable")
+
+    stats = ingest_corpus(args.corpus_dir, args.work_dir, args.batch_size,
+                          args.checkpoint_every, args.fresh)
+    export_artifact(args.work_dir, args.output, stats)
+    print(f"Ingestion completed: {stats['documents']} documents, {stats['chunks']} chunks "
+          f"in {stats['elapsed_seconds']:.2f} seconds")
+
+
+if __name__ == '__main__':
+    main()
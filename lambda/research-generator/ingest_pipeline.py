@@ -0,0 +1,216 @@
+"""
+Streaming ingestion pipeline for the research generator's knowledge base.
+
+Items flow through fetch -> extract -> chunk -> embed -> index stages that run
+concurrently and are connected by bounded queues. A slow stage blocks the
+stages upstream of it instead of letting work pile up, so network, CPU and
+persistence overlap while memory is bounded by the queue sizes rather than by
+the size of the corpus.
+"""
+import queue
+import contextvars
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import INGEST_EMBED_BATCH_SIZE, INGEST_QUEUE_SIZE, MAX_EMBEDDING_INPUTS
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class IndexedBatch:
+    """A batch of whole documents whose chunks have been embedded and indexed."""
+
+    def __init__(self):
+        self.tags = []
+        self.documents = []
+        self.chunks = []
+        self.embeddings = None
+
+    def add(self, tag: Any, document: Dict[str, Any], chunks: List[Dict[str, Any]]):
+        self.tags.append(tag)
+        # Only metadata is kept once the document has been chunked
+        self.documents.append({'metadata': document.get('metadata', {})})
+        self.chunks.extend(chunks)
+
+
+class IngestPipeline:
+    """
+    Concurrent fetch -> extract -> chunk -> embed -> index pipeline.
+
+    Args:
+        rag_engine: The RAGEngine whose index receives the chunks
+        fetch: Turns a source item into raw content (e.g. downloads a URL).
+            Defaults to passing the item through unchanged.
+        extract: Turns (item, raw) into an iterable of (tag, document) pairs.
+            Defaults to treating the raw content as a single document tagged
+            with the item. Tags are handed back in on_batch_indexed.
+        on_batch_indexed: Called from the index stage after every batch, e.g.
+            to record sources or write checkpoints
+        embed_batch_size: Minimum number of chunks embedded per batch. Batches
+            always hold whole documents, so a document is never half-indexed.
+        queue_size: Capacity of each queue between stages
+    """
+
+    def __init__(self, rag_engine, fetch: Optional[Callable[[Any], Any]] = None,
+                 extract: Optional[Callable[[Any, Any], Iterable[Tuple[Any, Dict[str, Any]]]]] = None,
+                 on_batch_indexed: Optional[Callable[[IndexedBatch], None]] = None,
+                 embed_batch_size: int = INGEST_EMBED_BATCH_SIZE, queue_size: int = INGEST_QUEUE_SIZE):
+        self.rag_engine = rag_engine
+        self.fetch = fetch or (lambda item: item)
+        self.extract = extract or (lambda item, raw: [(item, raw)])
+        self.on_batch_indexed = on_batch_indexed
+        self.embed_batch_size = embed_batch_size
+        self.queue_size = queue_size
+
+        self._stop = threading.Event()
+        self._error = None
+
+    def run(self, items: Iterable[Any]) -> Dict[str, Any]:
+        """
+        Run every item through the pipeline and block until it has been indexed.
+
+        Per-item fetch and extract failures are logged and skipped. Embedding and
+        indexing failures stop the pipeline and are re-raised here.
+
+        Returns:
+            Counts of documents, chunks and batches indexed, and elapsed seconds
+        """
+        start_time = time.time()
+        fetched = queue.Queue(self.queue_size)
+        extracted = queue.Queue(self.queue_size)
+        batched = queue.Queue(self.queue_size)
+        embedded = queue.Queue(self.queue_size)
+
+        steps = [
+            (self._fetch_stage, items, fetched, 'ingest-fetch'),
+            (self._extract_stage, fetched, extracted, 'ingest-extract'),
+            (self._chunk_stage, extracted, batched, 'ingest-chunk'),
+            (self._embed_stage, batched, embedded, 'ingest-embed'),
+        ]
+        # Each stage runs in a copy of the caller's context, so its log fields and trace spans follow it
+        stages = [
+            threading.Thread(target=contextvars.copy_context().run, args=(self._guard, step, source, output),
+                             name=name)
+            for step, source, output, name in steps
+        ]
+        for stage in stages:
+            stage.daemon = True
+            stage.start()
+
+        stats = {'documents': 0, 'chunks': 0, 'batches': 0}
+        try:
+            # The index stage runs on the calling thread so callbacks that persist
+            # the index never race with it being written to
+            while True:
+                batch = self._get(embedded)
+                if batch is _DONE:
+                    break
+                self.rag_engine.add_embedded_chunks(batch.chunks, batch.embeddings)
+                stats['documents'] += len(batch.documents)
+                stats['chunks'] += len(batch.chunks)
+                stats['batches'] += 1
+                if self.on_batch_indexed:
+                    self.on_batch_indexed(batch)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            self._stop.set()
+            for stage in stages:
+                stage.join()
+
+        if self._error is not None:
+            raise self._error
+
+        stats['elapsed_seconds'] = round(time.time() - start_time, 2)
+        return stats
+
+    def _fetch_stage(self, items: Iterable[Any], output: queue.Queue):
+        for item in items:
+            if self._stop.is_set():
+                return
+            try:
+                raw = self.fetch(item)
+            except Exception as e:
+                logger.error("Error fetching ingestion item", item=item, error=str(e))
+                continue
+            self._put(output, (item, raw))
+
+    def _extract_stage(self, source: queue.Queue, output: queue.Queue):
+        while True:
+            fetched = self._get(source)
+            if fetched is _DONE:
+                return
+            item, raw = fetched
+            try:
+                for tag, document in self.extract(item, raw):
+                    self._put(output, (tag, document))
+            except Exception as e:
+                logger.error("Error extracting ingestion item", item=item, error=str(e))
+
+    def _chunk_stage(self, source: queue.Queue, output: queue.Queue):
+        batch = IndexedBatch()
+        while True:
+            extracted = self._get(source)
+            if extracted is _DONE:
+                break
+            tag, document = extracted
+            chunks = self.rag_engine.chunk_document(document)
+            if not chunks:
+                continue
+            batch.add(tag, document, chunks)
+            if len(batch.chunks) >= self.embed_batch_size:
+                self._put(output, batch)
+                batch = IndexedBatch()
+        if batch.chunks:
+            self._put(output, batch)
+
+    def _embed_stage(self, source: queue.Queue, output: queue.Queue):
+        while True:
+            batch = self._get(source)
+            if batch is _DONE:
+                return
+            texts = [chunk['content'] for chunk in batch.chunks]
+            parts = [
+                self.rag_engine.get_embeddings(texts[start:start + MAX_EMBEDDING_INPUTS])
+                for start in range(0, len(texts), MAX_EMBEDDING_INPUTS)
+            ]
+            batch.embeddings = parts[0] if len(parts) == 1 else np.concatenate(parts)
+            self._put(output, batch)
+
+    def _guard(self, stage: Callable, source: Any, output: queue.Queue):
+        """Run a stage, signalling the end of its output or a pipeline failure."""
+        try:
+            stage(source, output)
+        except BaseException as e:
+            self._fail(e)
+            return
+        self._put(output, _DONE)
+
+    def _fail(self, error: BaseException):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _put(self, output: queue.Queue, item: Any):
+        # Blocks while the next stage is behind (backpressure) unless the pipeline stops
+        while not self._stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, source: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
@@ -0,0 +1,201 @@
+"""
+Storage for asynchronous research jobs.
+
+A job is a JSON-serializable dictionary:
+
+    {
+        'job_id': '...',
+        'status': 'queued' | 'running' | 'succeeded' | 'failed',
+        'request': {'expression': '...'},
+        'created_at': 1700000000.0,    # epoch seconds
+        'updated_at': 1700000000.0,
+        'progress': {...},             # nodes completed, streamed answer so far
+        'result': {...},               # the synchronous response body, once succeeded
+        'error': '...'                 # once failed
+    }
+
+The submitting request creates the job, a background worker updates its
+progress and result, and clients poll it by job_id. Stores are chosen by URL
+with create_job_store:
+
+    file:///tmp/research_jobs      one JSON file per job (local runs)
+    sqlite:///tmp/jobs.db          a SQLite table (local runs and tests)
+    s3://bucket/prefix             one S3 object per job (deployments)
+"""
+import os
+import abc
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from config import JOB_STORE_URL
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed')
+
+
+class JobNotFoundError(KeyError):
+    """No job with the requested id exists in the store."""
+
+
+def new_job(request: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a new, queued job record for a research request."""
+    now = time.time()
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': 'queued',
+        'request': request,
+        'created_at': now,
+        'updated_at': now,
+        'progress': {}
+    }
+
+
+class JobStore(abc.ABC):
+    """Base class for job stores; subclasses implement put and get."""
+
+    @abc.abstractmethod
+    def put(self, job: Dict[str, Any]):
+        """Create or replace a job record."""
+
+    @abc.abstractmethod
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return a job record, or None if it doesn't exist."""
+
+    def update(self, job_id: str, **fields) -> Dict[str, Any]:
+        """
+        Merge fields into a job record and return it.
+
+        Only the job's worker updates a job after it is created, so a plain
+        read-modify-write is enough.
+
+        Raises:
+            JobNotFoundError: If the job doesn't exist
+        """
+        job = self.get(job_id)
+        if job is None:
+            raise JobNotFoundError(job_id)
+        if fields.get('status', job['status']) not in JOB_STATUSES:
+            raise ValueError(f"Invalid job status: {fields['status']}")
+        job.update(fields)
+        job['updated_at'] = time.time()
+        self.put(job)
+        return job
+
+
+class FileJobStore(JobStore):
+    """One JSON file per job in a directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id: str) -> str:
+        if not job_id or os.path.basename(job_id) != job_id:
+            raise JobNotFoundError(job_id)
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def put(self, job: Dict[str, Any]):
+        path = self._path(job['job_id'])
+        # Write then rename, so a poll never reads a half-written job
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f, default=str)
+        os.replace(tmp_path, path)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, JobNotFoundError):
+            return None
+
+
+class SQLiteJobStore(JobStore):
+    """Jobs as JSON rows of a SQLite table."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def put(self, job: Dict[str, Any]):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, record, updated_at) VALUES (?, ?, ?)",
+                (job['job_id'], json.dumps(job, default=str), job['updated_at'])
+            )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+class S3JobStore(JobStore):
+    """One JSON object per job under an S3 prefix."""
+
+    def __init__(self, bucket: str, prefix: str = ''):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self._s3 = boto3.client('s3')
+
+    def _key(self, job_id: str) -> str:
+        return f"{self.prefix}/{job_id}.json" if self.prefix else f"{job_id}.json"
+
+    def put(self, job: Dict[str, Any]):
+        self._s3.put_object(
+            Bucket=self.bucket,
+            Key=self._key(job['job_id']),
+            Body=json.dumps(job, default=str).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            response = self._s3.get_object(Bucket=self.bucket, Key=self._key(job_id))
+        except self._s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+
+def create_job_store(url: str) -> JobStore:
+    """
+    Create a job store from a URL (see the module docstring).
+
+    Raises:
+        ValueError: If the URL scheme is not file, sqlite or s3
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'file':
+        return FileJobStore(parsed.netloc + parsed.path)
+    if parsed.scheme == 'sqlite':
+        return SQLiteJobStore(parsed.netloc + parsed.path)
+    if parsed.scheme == 's3':
+        return S3JobStore(parsed.netloc, parsed.path)
+    raise ValueError(f"Unsupported job store URL: {url}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    """Return the process-wide job store for JOB_STORE_URL, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = create_job_store(JOB_STORE_URL)
+        return _store
@@ -3,33 +3,113 @@ Knowledge base management for the research generator.
 """
 import os
 import json
-from typing import List, Dict, Any
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List
 import requests
-from bs4 import BeautifulSoup
-import PyPDF2
-from io import BytesIO
+from requests.adapters import HTTPAdapter
 from datetime import datetime
+from sources_ledger import SourcesLedger
+from ingest_pipeline import IngestPipeline
+from config import INGEST_EMBED_BATCH_SIZE, HTTP_POOL_MAXSIZE, HTTP_TIMEOUT_SECONDS
+from log import get_logger
+from singleflight import SingleFlight, normalize_text
+from tracing import annotate, span
+
+logger = get_logger(__name__)
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """
+    Return the process's shared HTTP session for Brave Search and page fetches.
+    
+    Its connections are kept alive and pooled (up to HTTP_POOL_MAXSIZE per
+    host), so concurrent requests reuse them instead of opening new ones.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+def extract_html_text(html: str) -> Dict[str, str]:
+    """Extract the title and paragraph text from an HTML page."""
+    # Imported here: only page fetching and bulk ingestion parse HTML, not the request path
+    from bs4 import BeautifulSoup
+    
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    # Extract main content (customize based on website structure)
+    content = ' '.join([p.get_text() for p in soup.find_all('p')])
+    title = soup.title.string if soup.title and soup.title.string else ''
+    
+    return {'title': title.strip(), 'content': content}
+
+def extract_pdf_text(file) -> str:
+    """Extract the text of every page from a PDF path or binary file object."""
+    import PyPDF2
+    
+    pdf_reader = PyPDF2.PdfReader(file)
+    content = ''
+    for page in pdf_reader.pages:
+        content += (page.extract_text() or '') + '\n'
+    return content
 
 class KnowledgeBaseManager:
-    def __init__(self, rag_engine):
+    def __init__(self, rag_engine, ledger_path: str = None):
         self.rag_engine = rag_engine
         
+        if ledger_path:
+            # Explicit location, e.g. alongside an offline-built index
+            self.ledger_path = ledger_path
         # Use /tmp directory for Lambda environments, which is writable
-        if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        elif os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
             # We're running in Lambda, use /tmp directory
-            self.sources_file = os.path.join('/tmp', 'sources.json')
+            self.ledger_path = os.path.join('/tmp', 'sources.db')
         else:
             # Local development environment
-            self.sources_file = os.path.join(os.path.dirname(__file__), 'data/sources.json')
-            os.makedirs(os.path.dirname(self.sources_file), exist_ok=True)
+            self.ledger_path = os.path.join(os.path.dirname(__file__), 'data/sources.db')
         
         # Ensure the parent directory exists
-        os.makedirs(os.path.dirname(self.sources_file), exist_ok=True)
+        os.makedirs(os.path.dirname(self.ledger_path), exist_ok=True)
+        self.ledger = SourcesLedger(self.ledger_path)
+        
+        # Migrate the old read-modify-write sources file, if present
+        legacy_sources_file = os.path.join(os.path.dirname(self.ledger_path), 'sources.json')
+        if os.path.exists(legacy_sources_file):
+            try:
+                self.ledger.import_json(legacy_sources_file)
+            except Exception as e:
+                logger.error("Error importing legacy sources file", path=legacy_sources_file, error=str(e))
+        
+        # Sources of documents added with persist=False, written by flush()
+        self._pending_sources = []
+        self._pending_lock = threading.Lock()
+        # Searches in progress, shared by concurrent nodes and requests searching the same query
+        self._searches = SingleFlight('brave_search')
     
     def populate_from_brave_search(self, query: str, api_key: str, num_results: int = 3) -> List[Dict[str, Any]]:
-        """Populate knowledge base with content from Brave Search results."""
-        print(f"\nFetching search results for: {query}")
+        """
+        Populate knowledge base with content from Brave Search results.
+        
+        A search for a query (ignoring case and whitespace) that is already in
+        progress is not repeated: the caller waits for it and gets its documents.
         
+        Returns:
+            The indexed documents (metadata only)
+        """
+        documents, _ = self._searches.do((normalize_text(query), num_results),
+                                         self._populate_from_brave_search, query, api_key, num_results)
+        return documents
+    
+    def _populate_from_brave_search(self, query: str, api_key: str, num_results: int) -> List[Dict[str, Any]]:
         headers = {
             'X-Subscription-Token': api_key,
             'Accept': 'application/json',
@@ -45,132 +125,115 @@ class KnowledgeBaseManager:
         }
         
         try:
-            print(f"Making Brave Search API request to {search_url}...")
-            print(f"Query parameters: {params}")
-            response = requests.get(search_url, headers=headers, params=params)
-            print(f"Response status code: {response.status_code}")
+            with span('brave.search', num_results=num_results):
+                response = get_http_session().get(search_url, headers=headers, params=params,
+                                                  timeout=HTTP_TIMEOUT_SECONDS)
+                annotate(status=response.status_code)
             
             if response.status_code != 200:
-                print(f"Error response from Brave Search: {response.text}")
+                logger.error("Error response from Brave Search", status=response.status_code,
+                             body=response.text[:500], query=query)
                 return []
                 
             response.raise_for_status()
             search_results = response.json()
             
             results_count = len(search_results.get('web', {}).get('results', []))
-            print(f"Received {results_count} search results from Brave Search")
             
             if results_count == 0:
-                print("No results found in the response")
-                if 'web' not in search_results:
-                    print("No 'web' field in response")
-                print(f"Response structure: {json.dumps(search_results.keys(), indent=2)}")
+                logger.info("No results from Brave Search", query=query, response_keys=list(search_results))
                 return []
             
-            documents = []
-            for i, result in enumerate(search_results.get('web', {}).get('results', []), 1):
-                print(f"\nProcessing result {i}/{results_count}:")
-                print(f"Title: {result.get('title', 'No title')}")
-                print(f"URL: {result.get('url', 'No URL')}")
-                
-                # Create document from Brave Search result
-                content = [
-                    result.get('title', ''),
-                    result.get('description', ''),
-                    result.get('content', {}).get('text', '')
-                ]
-                
-                # Filter out empty content
-                content = [c for c in content if c]
-                print(f"Content length: {sum(len(c) for c in content)} characters")
-                
-                document = {
-                    'content': '\n\n'.join(content),
-                    'metadata': {
-                        'source': result['url'],
-                        'type': 'web',
-                        'title': result.get('title', ''),
-                        'description': result.get('description', ''),
-                        'query': query,
-                        'fetched_at': str(datetime.now())
-                    }
-                }
-                documents.append(document)
+            def extract_result(result, _):
+                logger.sampled(logging.DEBUG, 'brave.result', "Processing search result",
+                               title=result.get('title', 'No title'), url=result.get('url', 'No URL'))
+                yield result['url'], self._search_result_document(result, query)
             
-            # Add documents to the knowledge base
-            if documents:
-                print(f"\nAdding {len(documents)} documents to knowledge base...")
-                self.rag_engine.add_documents(documents)
-                self._save_sources(documents)
-                print("Documents added successfully")
-            else:
-                print("No valid documents to add to knowledge base")
+            # Stream the results through the ingestion pipeline
+            documents = []
+            self.ingest(
+                search_results.get('web', {}).get('results', []),
+                extract=extract_result,
+                on_batch_indexed=lambda batch: documents.extend(batch.documents)
+            )
+            logger.info("Added Brave Search results to the knowledge base", query=query[:50],
+                        results=results_count, documents=len(documents))
             
             return documents
             
         except requests.exceptions.RequestException as e:
-            print(f"Network error making Brave Search API request: {str(e)}")
+            logger.error("Network error making Brave Search API request", query=query, error=str(e))
             return []
         except json.JSONDecodeError as e:
-            print(f"Error parsing Brave Search response as JSON: {str(e)}")
-            print(f"Raw response: {response.text[:500]}...")  # Print first 500 chars
+            logger.error("Error parsing Brave Search response as JSON", query=query, error=str(e),
+                         body=response.text[:500])
             return []
         except Exception as e:
-            print(f"Unexpected error in populate_from_brave_search: {str(e)}")
+            logger.exception("Unexpected error in populate_from_brave_search", query=query, error=str(e))
             return []
     
-    def add_web_content(self, urls: List[str]):
+    @staticmethod
+    def _search_result_document(result: Dict[str, Any], query: str) -> Dict[str, Any]:
+        """Create a document from a Brave Search result."""
+        content = [
+            result.get('title', ''),
+            result.get('description', ''),
+            result.get('content', {}).get('text', '')
+        ]
+        
+        # Filter out empty content
+        content = [c for c in content if c]
+        
+        return {
+            'content': '\n\n'.join(content),
+            'metadata': {
+                'source': result['url'],
+                'type': 'web',
+                'title': result.get('title', ''),
+                'description': result.get('description', ''),
+                'query': query,
+                'fetched_at': str(datetime.now())
+            }
+        }
+    
+    def add_web_content(self, urls: Iterable[str]):
         """Add content from web pages to the knowledge base."""
-        documents = []
-        for url in urls:
-            try:
-                response = requests.get(url)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Extract main content (customize based on website structure)
-                content = ' '.join([p.get_text() for p in soup.find_all('p')])
-                
-                documents.append({
-                    'content': content,
-                    'metadata': {
-                        'source': url,
-                        'type': 'web',
-                        'title': soup.title.string if soup.title else url
-                    }
-                })
-            except Exception as e:
-                print(f"Error processing {url}: {str(e)}")
+        def fetch_page(url):
+            with span('http.fetch'):
+                response = get_http_session().get(url, timeout=HTTP_TIMEOUT_SECONDS)
+                annotate(status=response.status_code)
+            response.raise_for_status()
+            return response.text
+        
+        def extract_page(url, html):
+            page = extract_html_text(html)
+            yield url, {
+                'content': page['content'],
+                'metadata': {
+                    'source': url,
+                    'type': 'web',
+                    'title': page['title'] or url,
+                    'fetched_at': str(datetime.now())
+                }
+            }
         
-        if documents:
-            self.rag_engine.add_documents(documents)
-            self._save_sources(documents)
+        self.ingest(urls, fetch=fetch_page, extract=extract_page)
     
-    def add_pdf_documents(self, pdf_paths: List[str]):
+    def add_pdf_documents(self, pdf_paths: Iterable[str]):
         """Add content from PDF files to the knowledge base."""
-        documents = []
-        for path in pdf_paths:
-            try:
-                with open(path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    content = ''
-                    for page in pdf_reader.pages:
-                        content += page.extract_text() + '\n'
-                    
-                    documents.append({
-                        'content': content,
-                        'metadata': {
-                            'source': path,
-                            'type': 'pdf',
-                            'title': os.path.basename(path)
-                        }
-                    })
-            except Exception as e:
-                print(f"Error processing {path}: {str(e)}")
+        def extract_pdf(path, _):
+            with open(path, 'rb') as file:
+                content = extract_pdf_text(file)
+            yield path, {
+                'content': content,
+                'metadata': {
+                    'source': path,
+                    'type': 'pdf',
+                    'title': os.path.basename(path)
+                }
+            }
         
-        if documents:
-            self.rag_engine.add_documents(documents)
-            self._save_sources(documents)
+        self.ingest(pdf_paths, extract=extract_pdf)
     
     def add_text_content(self, text: str, metadata: Dict[str, Any]):
         """Add raw text content to the knowledge base."""
@@ -181,42 +244,82 @@ class KnowledgeBaseManager:
                 'type': 'text'
             }
         }
-        self.rag_engine.add_documents([document])
-        self._save_sources([document])
+        self.add_documents([document])
+    
+    def add_documents(self, documents: Iterable[Dict[str, Any]], persist: bool = True):
+        """Index documents in the vector database and record their sources."""
+        self.ingest(documents, persist=persist)
+    
+    def ingest(self, items: Iterable[Any], fetch: Callable = None, extract: Callable = None,
+               persist: bool = True, on_batch_indexed: Callable = None,
+               embed_batch_size: int = INGEST_EMBED_BATCH_SIZE) -> Dict[str, Any]:
+        """
+        Stream items through the ingestion pipeline and record their sources.
+        
+        See IngestPipeline for the fetch and extract contracts. With persist=False
+        neither the index nor the sources are written until flush() is called, so
+        both stay consistent with each other on disk.
+        
+        Returns:
+            Pipeline statistics (documents, chunks, batches, elapsed_seconds)
+        """
+        def record_batch(batch):
+            if persist:
+                self._save_sources(batch.documents)
+            else:
+                with self._pending_lock:
+                    self._pending_sources.extend(batch.documents)
+            if on_batch_indexed:
+                on_batch_indexed(batch)
+        
+        with span('kb.ingest'):
+            stats = IngestPipeline(self.rag_engine, fetch=fetch, extract=extract,
+                                   on_batch_indexed=record_batch,
+                                   embed_batch_size=embed_batch_size).run(items)
+            annotate(documents=stats['documents'], chunks=stats['chunks'])
+            if persist and stats['chunks']:
+                self.rag_engine.save_vector_db()
+        return stats
+    
+    def flush(self):
+        """Persist the vector database and any sources recorded with persist=False."""
+        self.rag_engine.save_vector_db()
+        with self._pending_lock:
+            pending, self._pending_sources = self._pending_sources, []
+        if pending:
+            self._save_sources(pending)
     
     def _save_sources(self, documents: List[Dict[str, Any]]):
-        """Save source information to track what's in the knowledge base."""
-        sources = []
-        if os.path.exists(self.sources_file):
-            with open(self.sources_file, 'r') as f:
-                sources = json.load(f)
-        
-        # Add new sources
-        for doc in documents:
-            source_info = {
-                'title': doc['metadata'].get('title', ''),
-                'source': doc['metadata'].get('source', ''),
-                'type': doc['metadata'].get('type', ''),
-                'added_at': str(datetime.now())
-            }
-            sources.append(source_info)
+        """Append source information to the ledger to track what's in the knowledge base."""
+        with span('persist.sources', documents=len(documents)):
+            self.ledger.append(documents)
+    
+    def list_sources(self, source_type: str = None, limit: int = None, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        List sources in the knowledge base.
         
-        # Save updated sources
-        with open(self.sources_file, 'w') as f:
-            json.dump(sources, f, indent=2)
+        Args:
+            source_type: Only list sources of this type (e.g. 'web', 'pdf')
+            limit: Maximum number of sources to return (all if None)
+            offset: Number of sources to skip, for pagination
+            
+        Returns:
+            A list of source entries, oldest first
+        """
+        return self.ledger.list_sources(source_type=source_type, limit=limit, offset=offset)
+    
+    def get_source(self, url: str) -> List[Dict[str, Any]]:
+        """Return every ledger entry recorded for a URL."""
+        return self.ledger.get_by_url(url)
     
-    def list_sources(self) -> List[Dict[str, Any]]:
-        """List all sources in the knowledge base."""
-        if os.path.exists(self.sources_file):
-            with open(self.sources_file, 'r') as f:
-                return json.load(f)
-        return []
+    def is_source_fresh(self, url: str, max_age_seconds: float) -> bool:
+        """Check whether a URL was fetched within the last max_age_seconds."""
+        return self.ledger.is_fresh(url, max_age_seconds)
     
     def clear_knowledge_base(self):
         """Clear all documents from the knowledge base."""
-        if os.path.exists(self.rag_engine.VECTOR_DB_PATH):
+        if os.path.exists(self.rag_engine.vector_db_path):
             import shutil
-            shutil.rmtree(self.rag_engine.VECTOR_DB_PATH)
-        if os.path.exists(self.sources_file):
-            os.remove(self.sources_file)
-        self.rag_engine.initialize_vector_db() 
\ No newline at end of file
+            shutil.rmtree(self.rag_engine.vector_db_path)
+        self.ledger.clear()
+        self.rag_engine.initialize_vector_db()
@@ -2,267 +2,499 @@
 Main Lambda function handler for the research generator.
 """
 import json
+import base64
 import boto3
 import os
 from anthropic import Anthropic
-import openai
-from rag_engine import RAGEngine, deduplicate_sources
+from rag_engine import RAGEngine, tree_parameters
 from utils import build_response
+from response_format import format_response, parse_fields
+from job_store import get_job_store, new_job
+from result_cache import get_result_cache, result_cache_key
+from deadline import Deadline
+from tree_shape import SHAPE_PARAMETERS, TreeShape, shape_from_request
+from llm_gateway import get_gateway
+from log import get_logger, log_context
+from singleflight import SingleFlight
+from tracing import Trace
+from config import (
+    JOB_WORKER_MODE, JOB_PROGRESS_INTERVAL, RESULT_CACHE_ENABLED, PRELOAD_ON_INIT, API_KEY_CACHE_SECONDS,
+    TRACE_ENABLED, TRACE_EXPORT_DIR, API_GATEWAY_BINARY_MEDIA_TYPES
+)
 import time
-import traceback
+import threading
+from contextlib import nullcontext
+
+logger = get_logger(__name__)
+
+# Key of the payload this function sends itself to run a job in the background (see submit_job)
+JOB_WORKER_EVENT_KEY = 'research_job'
+
+# requestContext.stage of the events server.py builds, which decode every base64-encoded response body
+LOCAL_SERVER_STAGE = 'local-server'
+
+# Created once per container (see preload) and reused by every invocation it serves
+_api_keys = None
+_api_keys_loaded_at = 0.0
+_rag_engine = None
+_rag_engine_openai_key = None
+_anthropic_clients = {}
+_warm_lock = threading.Lock()
+
+# Research trees being built, shared by concurrent requests for the same tree
+_research_flights = SingleFlight('research')
+
 
 def lambda_handler(event, context):
+    # Every line logged during the invocation carries its request id
+    with log_context(request_id=getattr(context, 'aws_request_id', None)):
+        return handle_event(event, context)
+
+
+def handle_event(event, context):
+    # Asynchronous invocation running a submitted job
+    if JOB_WORKER_EVENT_KEY in event:
+        run_job(event[JOB_WORKER_EVENT_KEY]['job_id'], Deadline.from_lambda_context(context))
+        return {'job_id': event[JOB_WORKER_EVENT_KEY]['job_id']}
+    
     # Check if this is a Lambda Function URL invocation
     is_function_url = 'requestContext' in event and 'http' in event.get('requestContext', {})
     
+    # Compress the response if the client accepts it (Function URLs lower-case header names)
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    accept_encoding = headers.get('accept-encoding') if decodes_binary_body(event, headers) else None
+    
+    def respond(status_code, response_body):
+        return build_response(status_code, response_body, not is_function_url, accept_encoding)
+    
     # Handle preflight OPTIONS request
     if event.get('httpMethod') == 'OPTIONS':
-        return build_response(200, {}, not is_function_url)
+        return respond(200, {})
     
-    # Get API keys from environment variables
-    anthropic_key_name = os.environ['ANTHROPIC_API_KEY_SECRET_NAME']
-    openai_key_name = os.environ['OPENAI_API_KEY_SECRET_NAME']
-    brave_key_name = os.environ['BRAVE_API_KEY_SECRET_NAME']
+    # Parse the incoming event
+    try:
+        raw_body = event.get('body') or '{}'
+        # API Gateway base64-encodes request bodies of its binary media types (application/json)
+        if event.get('isBase64Encoded'):
+            raw_body = base64.b64decode(raw_body).decode('utf-8')
+        body = json.loads(raw_body)
+    except ValueError:
+        return respond(400, {'error': 'Invalid JSON in request body'})
     
-    session = boto3.session.Session()
-    ssm_client = session.client('ssm')
+    # Response sections to return (fields=summary,tree,...) and whether sources are referenced by index
+    query_params = event.get('queryStringParameters') or {}
+    try:
+        fields = parse_fields(query_params.get('fields') or body.get('fields'))
+    except ValueError as ve:
+        return respond(400, {'error': f'Invalid parameter value: {str(ve)}'})
+    compact = str(query_params.get('compact', body.get('compact', False))).lower() in ('true', '1')
+    
+    # Poll an asynchronous job: GET ?job_id=... or a POST body with a job_id
+    job_id = query_params.get('job_id') or body.get('job_id')
+    if job_id:
+        return get_job_response(job_id, is_function_url, accept_encoding, fields, compact)
+    
+    query = body.get('expression')
+    if not query:
+        return respond(400, {
+            'error': 'Missing required parameter. Please provide a research topic.'
+        })
     
+    # Tree depth, breadth and recursion threshold, clamped to the allowed ranges,
+    # or chosen from target_latency_seconds and the measured Claude latencies
+    shape_params = {name: body[name] for name in SHAPE_PARAMETERS if body.get(name) is not None}
     try:
-        # Get API keys from SSM
-        anthropic_key = ssm_client.get_parameter(
-            Name=anthropic_key_name,
-            WithDecryption=True
-        )['Parameter']['Value']
-        
-        openai_key = ssm_client.get_parameter(
-            Name=openai_key_name,
-            WithDecryption=True
-        )['Parameter']['Value']
-        
-        brave_key = ssm_client.get_parameter(
-            Name=brave_key_name,
-            WithDecryption=True
-        )['Parameter']['Value']
-        
-        # Initialize clients
-        client = Anthropic(api_key=anthropic_key)
-        
-        # Parse the incoming event
+        shape = shape_from_request(shape_params, get_gateway().metrics.snapshot())
+    except ValueError as ve:
+        return respond(400, {'error': f'Invalid parameter value: {str(ve)}'})
+    
+    # Asynchronous mode: return a job id now and build the tree in the background
+    if body.get('mode') == 'async':
         try:
-            body = json.loads(event.get('body', '{}'))
-            query = body.get('expression')
-            
-            if not query:
-                return build_response(400, {
-                    'error': 'Missing required parameter. Please provide a research topic.'
-                }, not is_function_url)
-            
-            # Initialize RAG engine
-            rag = RAGEngine()
-            # Set OpenAI API key
-            rag.set_openai_key(openai_key)
-            
-            # Generate answer with question tree using dynamic knowledge base
-            start_time = time.time()
-            try:
-                print(f"Starting answer generation for query: '{query}'")
-                question_tree = rag.generate_answer_with_tree(query, client, brave_key)
-                print("Answer generation completed successfully")
-            except Exception as e:
-                print(f"ERROR during answer generation: {str(e)}")
-                print(f"Exception type: {type(e).__name__}")
-                print(f"Exception traceback: {traceback.format_exc()}")
-                raise ValueError(f"Failed to generate answer: {str(e)}")
-                
-            processing_time = time.time() - start_time
-            print(f"Total processing time: {processing_time:.2f} seconds")
-            
-            # Log the question tree structure for debugging
-            print("Generated question tree structure:")
-            try:
-                print(json.dumps(question_tree, indent=2, default=str))
-            except Exception as e:
-                print(f"ERROR serializing question tree: {str(e)}")
-                print(f"Question tree type: {type(question_tree)}")
-                print(f"Question tree keys: {question_tree.keys() if isinstance(question_tree, dict) else 'Not a dict'}")
-            
-            # Verify if answer exists in the question tree
-            if isinstance(question_tree, dict) and 'answer' not in question_tree:
-                print("WARNING: Root node is missing 'answer' field")
-                print(f"Available fields in root node: {list(question_tree.keys())}")
-                
-                # Check if there was an error message in the question tree
-                if 'error' in question_tree:
-                    print(f"Error found in question tree: {question_tree['error']}")
-                    raise ValueError(f"Error in answer generation: {question_tree['error']}")
-            elif not isinstance(question_tree, dict):
-                print(f"WARNING: Question tree is not a dictionary. Type: {type(question_tree)}")
-                raise ValueError("Invalid question tree structure returned")
-            else:
-                print(f"Answer field exists in root node, length: {len(question_tree.get('answer', ''))}")
-            
-            # Collect all sources from the tree
-            all_sources = collect_all_sources(question_tree)
-            
-            # If there's a breakdown, use the final answer from the root node
-            if question_tree.get('needs_breakdown', False) and question_tree.get('children'):
-                final_answer = question_tree.get('answer', "No answer was generated. Please try again with a more specific question.")
-                
-                # Check if sources section is missing and add it if necessary
-                if all_sources:
-                    # Check if the final answer already has a sources section
-                    if "<div class=\"sources\">" not in final_answer and "<div class='sources'>" not in final_answer:
-                        # Add all sources to the final answer
-                        sources_html = "<div class=\"sources\"><h2>Sources</h2><ol>"
-                        for source in all_sources:
-                            sources_html += f"<li>{source.get('title', 'Untitled')} - <a href=\"{source.get('url', '#')}\">{source.get('url', '#')}</a></li>"
-                        sources_html += "</ol></div>"
-                        final_answer += f"\n\n{sources_html}"
-                    else:
-                        print("Final answer already has a sources section")
-            else:
-                # If no breakdown, use the direct answer
-                final_answer = question_tree.get('answer', "No answer was generated. Please try again with a more specific question.")
-                
-                # Add sources section if missing
-                if all_sources and "<div class=\"sources\">" not in final_answer and "<div class='sources'>" not in final_answer:
-                    # Add all sources to the final answer
-                    sources_html = "<div class=\"sources\"><h2>Sources</h2><ol>"
-                    for source in all_sources:
-                        sources_html += f"<li>{source.get('title', 'Untitled')} - <a href=\"{source.get('url', '#')}\">{source.get('url', '#')}</a></li>"
-                    sources_html += "</ol></div>"
-                    final_answer += f"\n\n{sources_html}"
-            
-            # Calculate metadata for the frontend
-            metadata = {
-                'total_nodes': count_nodes(question_tree),
-                'max_depth': get_max_depth(question_tree),
-                'processing_time': f"{processing_time:.2f} seconds"
-            }
-            
-            # Include all sources in the response for the frontend to handle
-            response = {
-                'explanation': final_answer,
-                'question_tree': question_tree,
-                'metadata': metadata,
-                'all_sources': all_sources,
-                'sources_metadata': {
-                    'total_sources': len(all_sources),
-                    'sources_by_relevance': sorted(all_sources, key=lambda s: -s.get('relevance', 0)),
-                    'most_frequent_sources': sorted(all_sources, key=lambda s: -s.get('frequency', 0))[:5]
-                }
-            }
-            
-            return build_response(200, response, not is_function_url)
-            
-        except json.JSONDecodeError:
-            return build_response(400, {'error': 'Invalid JSON in request body'}, not is_function_url)
-        except ValueError as ve:
-            return build_response(400, {'error': f'Invalid parameter value: {str(ve)}'}, not is_function_url)
+            job = submit_job({'expression': query, **shape_params}, context)
         except Exception as e:
-            return build_response(500, {'error': f'Internal server error: {str(e)}'}, not is_function_url)
-            
+            logger.exception("Error submitting research job", error=str(e))
+            return respond(500, {'error': f'Error submitting research job: {str(e)}'})
+        return respond(202, {'job_id': job['job_id'], 'status': job['status']})
+    
+    try:
+        api_keys = get_api_keys()
     except Exception as e:
-        return build_response(500, {'error': f'Error retrieving API keys: {str(e)}'}, not is_function_url)
+        return respond(500, {'error': f'Error retrieving API keys: {str(e)}'})
+    
+    try:
+        # Stale cached results are refreshed by a background job, with the same tree shape
+        response = run_research(query, api_keys,
+                                revalidate=lambda: submit_job({'expression': query, 'refresh_cache': True,
+                                                               **shape.as_dict()}, context),
+                                deadline=Deadline.from_lambda_context(context), shape=shape)
+        return respond(200, format_response(response, fields, compact))
+    except ValueError as ve:
+        return respond(400, {'error': f'Invalid parameter value: {str(ve)}'})
+    except Exception as e:
+        return respond(500, {'error': f'Internal server error: {str(e)}'})
 
-def count_nodes(tree):
-    """Count the total number of nodes in the tree."""
-    if not tree:
-        return 0
+def load_api_keys():
+    """
+    Read the Anthropic, OpenAI and Brave API keys from SSM Parameter Store.
     
-    count = 1  # Count the current node
+    Outside Lambda (local runs, server.py) a key whose *_SECRET_NAME
+    parameter name is not set is read from its plain environment variable
+    (ANTHROPIC_API_KEY, OPENAI_API_KEY, BRAVE_API_KEY) instead.
+    """
+    ssm_client = None
+    keys = {}
+    for name, env_var in (('anthropic', 'ANTHROPIC_API_KEY'),
+                          ('openai', 'OPENAI_API_KEY'),
+                          ('brave', 'BRAVE_API_KEY')):
+        if f'{env_var}_SECRET_NAME' not in os.environ and env_var in os.environ:
+            keys[name] = os.environ[env_var]
+            continue
+        if ssm_client is None:
+            ssm_client = boto3.session.Session().client('ssm')
+        keys[name] = ssm_client.get_parameter(
+            Name=os.environ[f'{env_var}_SECRET_NAME'],
+            WithDecryption=True
+        )['Parameter']['Value']
+    return keys
+
+def get_api_keys():
+    """Return the API keys, read from SSM on first use and again once API_KEY_CACHE_SECONDS have passed."""
+    global _api_keys, _api_keys_loaded_at
+    with _warm_lock:
+        if _api_keys is None or time.time() - _api_keys_loaded_at >= API_KEY_CACHE_SECONDS:
+            _api_keys = load_api_keys()
+            _api_keys_loaded_at = time.time()
+        return _api_keys
+
+def get_rag_engine(openai_api_key):
+    """
+    Return the container's RAG engine, created on first use.
     
-    # Add count of all children
-    if 'children' in tree and tree['children']:
-        for child in tree['children']:
-            count += count_nodes(child)
+    Opening the knowledge base (the mmapped base index and the /tmp delta
+    index) and starting the engine's thread pool are paid once per
+    container instead of once per request.
+    """
+    global _rag_engine, _rag_engine_openai_key
+    with _warm_lock:
+        if _rag_engine is None:
+            _rag_engine = RAGEngine()
+        if _rag_engine_openai_key != openai_api_key:
+            _rag_engine.set_openai_key(openai_api_key)
+            _rag_engine_openai_key = openai_api_key
+        return _rag_engine
+
+def get_anthropic_client(api_key):
+    """Return a shared Anthropic client for the key, so its HTTP connections are reused across invocations."""
+    with _warm_lock:
+        if api_key not in _anthropic_clients:
+            _anthropic_clients[api_key] = Anthropic(api_key=api_key)
+        return _anthropic_clients[api_key]
+
+def preload():
+    """
+    Warm the container during the Lambda init phase.
     
-    return count
+    Reads the API keys and creates the RAG engine and the Anthropic client
+    before the first invocation, so the first request doesn't pay for them.
+    Failures are logged and left for the first request to retry.
+    
+    Returns:
+        Whether the keys, engine and client are ready
+    """
+    start_time = time.time()
+    try:
+        api_keys = get_api_keys()
+        get_rag_engine(api_keys['openai'])
+        get_anthropic_client(api_keys['anthropic'])
+        logger.info("Preloaded API keys and RAG engine", seconds=round(time.time() - start_time, 2))
+        return True
+    except Exception as e:
+        logger.error("Error preloading during init", error=str(e))
+        return False
+
+def flush_knowledge_base():
+    """Persist the warm RAG engine's knowledge base, if one has been created (used on server shutdown)."""
+    with _warm_lock:
+        rag = _rag_engine
+    if rag is not None:
+        rag.kb_manager.flush()
 
-def get_max_depth(tree, current_depth=0):
-    """Get the maximum depth of the tree."""
-    if not tree:
-        return current_depth
+def run_research(query, api_keys, on_token=None, on_node=None, revalidate=None, refresh=False, deadline=None,
+                 shape=None):
+    """
+    Return the response body for a query, from the result cache or by building its question tree.
+    
+    Fresh cached results are returned as they are. Stale ones are returned
+    too, and revalidate is called (by one caller at a time) to rebuild them
+    in the background. metadata.cache reports whether the result came from
+    the cache and how old it is.
     
-    max_depth = current_depth
+    Requests for a tree that is already being built for another request (the
+    same query and tree parameters) wait for that build and share its result,
+    with metadata.coalesced set. Streamed requests and jobs (on_token or
+    on_node) always build their own tree.
+    
+    Args:
+        query: The research question
+        api_keys: Dict with 'anthropic', 'openai' and 'brave' keys (see load_api_keys)
+        on_token: Optional callback receiving the root answer's text deltas
+        on_node: Optional callback receiving each tree node as it completes
+        revalidate: Optional callback that starts a background refresh of the query
+        refresh: Skip the cache lookup and rebuild the result (a background refresh)
+        deadline: Optional Deadline the tree must be built by; a partial tree is
+            returned, with metadata.timed_out set, if it could not be completed
+        shape: Optional TreeShape of the tree (the default shape if not given)
+    
+    Raises:
+        ValueError: If the answer could not be generated
+    """
+    key = result_cache_key(query, tree_parameters(shape))
+    cache = get_result_cache() if RESULT_CACHE_ENABLED else None
+    if cache is not None and not refresh:
+        state, entry = cache.lookup(key)
+        if state != 'miss':
+            logger.info("Serving cached result", state=state, age_seconds=round(entry['age_seconds']), query=query)
+            if state == 'stale' and revalidate and cache.claim_refresh(key):
+                try:
+                    revalidate()
+                except Exception as e:
+                    logger.error("Error starting result cache refresh", error=str(e))
+            response = entry['response']
+            response['metadata'] = {
+                **response.get('metadata', {}),
+                'cache': {
+                    'hit': True,
+                    'state': state,
+                    'age_seconds': round(entry['age_seconds'], 1),
+                    'cached_at': entry['cached_at']
+                }
+            }
+            return response
     
-    # Check all children for their max depth
-    if 'children' in tree and tree['children']:
-        for child in tree['children']:
-            child_depth = get_max_depth(child, current_depth + 1)
-            max_depth = max(max_depth, child_depth)
+    def build():
+        response = build_research_response(query, api_keys, on_token, on_node, deadline, shape)
+        if cache is None:
+            return response
+        response['metadata']['cache'] = {'hit': False, 'state': 'refresh' if refresh else 'miss', 'age_seconds': 0}
+        root = response['question_tree']
+        # Don't keep results whose root answer failed or that were cut short by the deadline
+        if not root.get('error') and not root.get('answer_error') and not root.get('timed_out'):
+            cache.put(key, response)
+        return response
     
-    return max_depth
+    # The callbacks report one caller's progress, so those builds can't be shared
+    if on_token or on_node:
+        return build()
+    response, shared = _research_flights.do(('refresh' if refresh else 'build', key), build)
+    if shared:
+        logger.info("Shared an in-flight research build", query=query)
+        response = {**response, 'metadata': {**response['metadata'], 'coalesced': True}}
+    return response
 
-def collect_all_sources(tree):
-    """Collect all sources from the tree with frequency and relevance information."""
-    sources = []
-    source_frequency = {}  # Track how many times each source appears
-    
-    # Helper function to recursively collect sources with depth information
-    def _collect_sources_with_depth(node, depth=0):
-        if not node or not isinstance(node, dict):
-            print(f"WARNING: Invalid node at depth {depth}: {type(node)}")
-            return []
-            
-        node_sources = []
+def build_research_response(query, api_keys, on_token=None, on_node=None, deadline=None, shape=None):
+    """
+    Build the question tree for a query and return the response body.
+    
+    Raises:
+        ValueError: If the answer could not be generated
+    """
+    # Warm clients and engine, created during init or by an earlier invocation
+    client = get_anthropic_client(api_keys['anthropic'])
+    rag = get_rag_engine(api_keys['openai'])
+    
+    # Generate answer with question tree using dynamic knowledge base
+    start_time = time.time()
+    
+    # Spans of every external call and index operation, aggregated into metadata.timings
+    trace = Trace(query)
+    try:
+        logger.info("Starting answer generation", query=query)
+        with trace.activate() if TRACE_ENABLED else nullcontext():
+            # The root answer is only streamed to callers that asked for it: a streamed call can't be
+            # retried after its first token, and isn't shared with identical concurrent calls
+            question_tree = rag.generate_answer_with_tree(query, client, api_keys['brave'], on_token=on_token,
+                                                          on_node=on_node, deadline=deadline, shape=shape)
+    except Exception as e:
+        logger.exception("Error during answer generation", error=str(e))
+        raise ValueError(f"Failed to generate answer: {str(e)}")
         
-        # Collect sources from the current node if available
-        if 'sources' in node and node['sources']:
+    processing_time = time.time() - start_time
+    # Recorded by the gateway's span when the root answer was streamed (traces only)
+    first_token_time = trace.first_token_time
+    tree = question_tree.tree
+    logger.info("Generated question tree", nodes=tree.node_count, max_depth=tree.max_depth,
+                answer_characters=len(question_tree.answer or ''), seconds=round(processing_time, 2))
+    if question_tree.answer is None:
+        raise ValueError(f"Error in answer generation: {question_tree.error or 'no answer was generated'}")
+    
+    # Sources of the whole tree, counted as its nodes were built
+    all_sources = tree.all_sources()
+    
+    # The root's answer: the synthesis of its children's answers, or the direct answer
+    final_answer = question_tree.answer
+    
+    # Add a sources section if the answer doesn't have one
+    if all_sources and "<div class=\"sources\">" not in final_answer and "<div class='sources'>" not in final_answer:
+        sources_html = "<div class=\"sources\"><h2>Sources</h2><ol>"
+        for source in all_sources:
+            sources_html += f"<li>{source.get('title', 'Untitled')} - <a href=\"{source.get('url', '#')}\">{source.get('url', '#')}</a></li>"
+        sources_html += "</ol></div>"
+        final_answer += f"\n\n{sources_html}"
+    
+    # Calculate metadata for the frontend
+    metadata = {
+        'total_nodes': tree.node_count,
+        'max_depth': tree.max_depth,
+        'processing_time': f"{processing_time:.2f} seconds",
+        'time_to_first_token': f"{first_token_time - start_time:.2f} seconds" if first_token_time else None,
+        # Set when the deadline cut the tree short; the partial tree is returned
+        'timed_out': bool(question_tree.timed_out),
+        # Token, cost and time spend against the request's research budget
+        'budget': question_tree.budget,
+        # Latency, retry and throttle counters for this container's Claude calls
+        'llm_gateway': rag.gateway.metrics.snapshot()
+    }
+    if TRACE_ENABLED:
+        # Wall time, calls and tokens of this request, per stage and per tree node
+        metadata['timings'] = trace.summary()
+        if TRACE_EXPORT_DIR:
             try:
-                for source in node['sources']:
-                    if not isinstance(source, dict):
-                        print(f"WARNING: Invalid source type: {type(source)}")
-                        continue
-                        
-                    # Create a copy of the source with depth information
-                    source_with_depth = source.copy()
-                    source_with_depth['depth'] = depth
-                    source_with_depth['node_question'] = node.get('question', '')
-                    node_sources.append(source_with_depth)
-                    
-                    # Track frequency
-                    url = source.get('url', '')
-                    if url:
-                        source_frequency[url] = source_frequency.get(url, 0) + 1
-            except Exception as e:
-                print(f"ERROR processing sources at depth {depth}: {str(e)}")
-        
-        # Recursively collect sources from children
-        if 'children' in node and node['children']:
+                metadata['timings']['trace_file'] = trace.export_chrome(
+                    os.path.join(TRACE_EXPORT_DIR, f"{trace.id}.json"))
+            except OSError as e:
+                logger.error("Error writing the trace file", path=TRACE_EXPORT_DIR, error=str(e))
+        logger.info("Request timings", stages=metadata['timings']['stages'])
+    logger.info("LLM gateway metrics", llm_gateway=metadata['llm_gateway'])
+    
+    # The tree shape the request was built with, and how it was chosen in adaptive mode
+    shape = shape or TreeShape()
+    parameters_used = shape.as_dict()
+    if shape.estimate:
+        parameters_used['adaptive'] = shape.estimate
+    
+    # Include all sources in the response for the frontend to handle
+    response = {
+        'explanation': final_answer,
+        # Serialized once, here
+        'question_tree': question_tree.to_dict(),
+        'metadata': metadata,
+        'parameters_used': parameters_used,
+        'all_sources': all_sources,
+        'sources_metadata': {
+            'total_sources': len(all_sources),
+            'sources_by_relevance': sorted(all_sources, key=lambda s: -s.get('relevance', 0)),
+            'most_frequent_sources': sorted(all_sources, key=lambda s: -s.get('frequency', 0))[:5]
+        }
+    }
+    
+    return response
+
+def submit_job(request, context):
+    """
+    Store a new research job and start building its tree in the background.
+    
+    In 'lambda' worker mode this function invokes itself asynchronously
+    (InvocationType=Event) with the job id, so the tree is built in a
+    separate invocation that isn't bound by the caller's HTTP timeout. In
+    'thread' mode (local runs) it is built in a background thread.
+    
+    Returns:
+        The queued job record
+    """
+    store = get_job_store()
+    job = new_job(request)
+    store.put(job)
+    
+    if JOB_WORKER_MODE == 'lambda':
+        boto3.client('lambda').invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({JOB_WORKER_EVENT_KEY: {'job_id': job['job_id']}}).encode('utf-8')
+        )
+    else:
+        threading.Thread(target=run_job, args=(job['job_id'],), name=f"job-{job['job_id']}", daemon=True).start()
+    
+    logger.info("Submitted research job", job_id=job['job_id'], worker=JOB_WORKER_MODE)
+    return job
+
+def run_job(job_id, deadline=None):
+    """
+    Build a submitted job's tree, writing progress and the result to the job store.
+    
+    Progress (completed nodes and the root answer streamed so far) is
+    written at most every JOB_PROGRESS_INTERVAL seconds. With a deadline
+    (the worker invocation's), a partial result is stored before it.
+    """
+    # Every line logged while building the job's tree carries its job id
+    with log_context(job_id=job_id):
+        _run_job(job_id, deadline)
+
+def _run_job(job_id, deadline):
+    store = get_job_store()
+    job = store.update(job_id, status='running', started_at=time.time())
+    progress = {'nodes_completed': 0, 'last_completed_question': None, 'answer_so_far': ''}
+    last_write = 0.0
+    
+    def write_progress(force=False):
+        nonlocal last_write
+        if force or time.time() - last_write >= JOB_PROGRESS_INTERVAL:
+            last_write = time.time()
             try:
-                for child in node['children']:
-                    child_sources = _collect_sources_with_depth(child, depth + 1)
-                    if child_sources:
-                        node_sources.extend(child_sources)
+                store.update(job_id, progress=dict(progress))
             except Exception as e:
-                print(f"ERROR processing children at depth {depth}: {str(e)}")
-        
-        return node_sources
+                logger.error("Error writing job progress", error=str(e))
+    
+    def on_node(node):
+        progress['nodes_completed'] += 1
+        progress['last_completed_question'] = node.question
+        write_progress()
+    
+    def on_token(text):
+        progress['answer_so_far'] += text
+        write_progress()
     
     try:
-        # Collect all sources with depth information
-        sources = _collect_sources_with_depth(tree)
-        
-        # Deduplicate sources while preserving the most relevant information
-        deduplicated_sources = []
-        seen_urls = set()
-        
-        # Sort sources by frequency (most frequent first) and then by depth (lower depth first)
-        sources.sort(key=lambda s: (-source_frequency.get(s.get('url', ''), 0), s.get('depth', 0)))
-        
-        for source in sources:
-            url = source.get('url', '')
-            if url and url not in seen_urls:
-                # Add frequency information
-                source['frequency'] = source_frequency.get(url, 1)
-                # Calculate relevance score (higher is more relevant)
-                source['relevance'] = (source['frequency'] * 10) / (source.get('depth', 0) + 1)
-                deduplicated_sources.append(source)
-                seen_urls.add(url)
-        
-        return deduplicated_sources
+        shape = shape_from_request(job['request'], get_gateway().metrics.snapshot())
+        response = run_research(job['request']['expression'], get_api_keys(), on_token=on_token, on_node=on_node,
+                                refresh=job['request'].get('refresh_cache', False), deadline=deadline,
+                                shape=shape)
     except Exception as e:
-        print(f"ERROR in collect_all_sources: {str(e)}")
-        # Return an empty list in case of error
-        return []
\ No newline at end of file
+        logger.exception("Error in research job", error=str(e))
+        store.update(job_id, status='failed', error=str(e), progress=progress, finished_at=time.time())
+        return
+    
+    store.update(job_id, status='succeeded', result=response, progress=progress, finished_at=time.time())
+    logger.info("Research job succeeded")
+
+def decodes_binary_body(event, headers) -> bool:
+    """
+    Check whether the invoker turns a base64-encoded (compressed) response body back into bytes.
+
+    Function URLs and server.py always do. API Gateway only does for requests
+    whose first Accept media type is one of its binary media types.
+    """
+    request_context = event.get('requestContext') or {}
+    if 'http' in request_context or request_context.get('stage') == LOCAL_SERVER_STAGE:
+        return True
+    first_accepted = (headers.get('accept') or '').split(',')[0].split(';')[0].strip().lower()
+    return first_accepted in API_GATEWAY_BINARY_MEDIA_TYPES
+
+
+def get_job_response(job_id, is_function_url, accept_encoding=None, fields=None, compact=False):
+    """
+    Build the poll response for a job: its status and progress, plus the result once it has succeeded.
+    
+    The result is formatted with the poll's fields and compact options (see response_format.py).
+    """
+    job = get_job_store().get(job_id)
+    if job is None:
+        return build_response(404, {'error': f'Unknown job id: {job_id}'}, not is_function_url, accept_encoding)
+    if job.get('result'):
+        job['result'] = format_response(job['result'], fields, compact)
+    return build_response(200, job, not is_function_url, accept_encoding)
+
+
+# Module scope runs in the Lambda init phase, before the first invocation
+if PRELOAD_ON_INIT:
+    preload()
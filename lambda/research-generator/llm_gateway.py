@@ -0,0 +1,566 @@
+"""
+Gateway for every Claude Messages API call made by the research generator.
+
+All calls go through one process-wide LLMGateway so that concurrent tree
+nodes (and concurrent requests in a warm container) share a single view of
+the account's quotas. For each model the gateway:
+
+- throttles with token buckets for requests, input tokens and output tokens
+- retries only errors that can succeed on retry (429, 408, 409, 5xx, 529,
+  connection errors and timeouts), honoring Retry-After when it is sent
+- fails fast through a circuit breaker while the model keeps erroring
+- records latency, retry, throttle and token metrics, including prompt
+  cache writes and reads
+- adds the prompt caching beta header to requests that mark cache breakpoints
+- streams text deltas to a callback, retrying only before the first delta
+- falls back to other models when a model is overloaded or its circuit is open
+- respects the request's deadline: calls are not started or retried without
+  DEADLINE_MIN_CALL_SECONDS left, and each call's timeout is capped by it
+- coalesces identical non-streamed calls made at the same time into one
+  (singleflight.py); only the call that ran is charged to a budget
+- records each call as a 'claude.<stage>' span of the request's trace
+  (tracing.py), with its model, tokens, retries and throttle wait
+"""
+import time
+import random
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from config import (
+    LLM_RATE_LIMITS, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY,
+    LLM_CIRCUIT_FAILURE_THRESHOLD, LLM_CIRCUIT_RESET_SECONDS,
+    PROMPT_CACHING_ENABLED, PROMPT_CACHING_BETA, PROMPT_CACHE_MIN_TOKENS, DEADLINE_MIN_CALL_SECONDS
+)
+from budget import current_budget, record_usage
+from deadline import DeadlineExceeded
+from log import get_logger
+from singleflight import SingleFlight, request_key
+from tracing import annotate, record, span
+
+logger = get_logger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERROR_NAMES = {'APIConnectionError', 'APITimeoutError'}
+# Rate limiting is handled by waiting, so it does not count towards opening the circuit
+CIRCUIT_IGNORED_STATUS_CODES = {429}
+# Overloaded models are not retried when there is a fallback model to move on to
+OVERLOADED_STATUS_CODES = {529}
+LATENCY_SAMPLES = 500
+
+
+class CircuitOpenError(Exception):
+    """Raised when a model's circuit breaker is open and calls are being rejected."""
+
+    def __init__(self, model: str, retry_in: float):
+        super().__init__(f"Circuit open for {model}; retry in {retry_in:.1f} seconds")
+        self.model = model
+        self.retry_in = retry_in
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Check whether an API error can succeed if the call is retried."""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES or isinstance(error, (ConnectionError, TimeoutError))
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Return the server-requested delay in seconds from a Retry-After header, if any."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def estimate_request_tokens(system: Any, messages: List[Dict[str, Any]]) -> int:
+    """Estimate the input tokens of a Messages API request."""
+    def text_of(content):
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            return ''.join(text_of(block.get('text', '')) if isinstance(block, dict) else str(block)
+                           for block in content)
+        return str(content or '')
+
+    return estimate_tokens(text_of(system) + ''.join(text_of(m.get('content')) for m in messages))
+
+
+def min_cacheable_tokens(model: str) -> int:
+    """Return the shortest prefix the API will cache for a model (PROMPT_CACHE_MIN_TOKENS)."""
+    for family, tokens in PROMPT_CACHE_MIN_TOKENS.items():
+        if family in model:
+            return tokens
+    return PROMPT_CACHE_MIN_TOKENS['default']
+
+
+def cached_system(static_prefix: str, instructions: str = '', model: Optional[str] = None) -> Any:
+    """
+    Build a system prompt whose static prefix is marked as a prompt cache breakpoint.
+
+    The prefix must be identical across calls for cache reads to hit, so
+    anything that varies per call belongs in instructions (after the
+    breakpoint) or in the messages.
+
+    Args:
+        static_prefix: The prefix shared by every call
+        instructions: Task instructions that follow it
+        model: The model the call is routed to. The prefix is not marked if
+            it is shorter than the model can cache, since the breakpoint
+            would have no effect.
+
+    Returns:
+        A list of system text blocks, or a plain string if caching is disabled
+        or the prefix is too short to cache
+    """
+    too_short = model is not None and estimate_tokens(static_prefix) < min_cacheable_tokens(model)
+    if not PROMPT_CACHING_ENABLED or too_short:
+        return f"{static_prefix}\n\n{instructions}" if instructions else static_prefix
+
+    blocks = [{"type": "text", "text": static_prefix, "cache_control": {"type": "ephemeral"}}]
+    if instructions:
+        blocks.append({"type": "text", "text": instructions})
+    return blocks
+
+
+def uses_prompt_caching(kwargs: Dict[str, Any]) -> bool:
+    """Check whether a Messages API request marks any cache_control breakpoints."""
+    def marked(content):
+        return isinstance(content, list) and any(
+            isinstance(block, dict) and 'cache_control' in block for block in content
+        )
+
+    return marked(kwargs.get('system')) or any(marked(m.get('content')) for m in kwargs.get('messages', []))
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously up to a per-minute limit."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def acquire(self, amount: float) -> float:
+        """
+        Take amount tokens, blocking until they are available.
+
+        Returns:
+            Seconds spent waiting
+        """
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.refill_rate
+            time.sleep(wait)
+            waited += wait
+
+    def refund(self, amount: float):
+        """Return unused tokens, e.g. when fewer output tokens were used than reserved."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures, then allows a trial call after a cool-down.
+
+    Once the cool-down has passed, the first caller of check() claims the
+    trial call; the others are rejected until its outcome is recorded
+    (record_success, record_failure or release_trial).
+    """
+
+    def __init__(self, failure_threshold: int = LLM_CIRCUIT_FAILURE_THRESHOLD,
+                 reset_seconds: float = LLM_CIRCUIT_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def check(self, model: str):
+        """
+        Raise CircuitOpenError if calls to model should be rejected right now.
+
+        In the half-open state the first caller claims the trial call, and
+        must report its outcome.
+        """
+        with self._lock:
+            state = self.state
+            if state == 'open':
+                raise CircuitOpenError(model, self.reset_seconds - (time.monotonic() - self.opened_at))
+            if state == 'half_open':
+                if self.trial_in_flight:
+                    raise CircuitOpenError(model, 0.0)
+                self.trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.trial_in_flight = False
+            self.failures += 1
+            # A failed trial call in the half-open state re-opens the circuit immediately
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """Give up a claimed trial call that says nothing about the model's health (not sent, or rate limited)."""
+        with self._lock:
+            self.trial_in_flight = False
+
+
+class GatewayMetrics:
+    """Per-model call, latency, retry, throttle and token counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def _model(self, model: str) -> Dict[str, Any]:
+        if model not in self._models:
+            self._models[model] = {
+                'calls': 0, 'successes': 0, 'failures': 0, 'retries': 0,
+                'circuit_rejections': 0, 'fallbacks': 0, 'throttle_wait_seconds': 0.0, 'retry_wait_seconds': 0.0,
+                'input_tokens': 0, 'output_tokens': 0,
+                'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0, 'coalesced': 0, 'latencies': []
+            }
+        return self._models[model]
+
+    def record(self, model: str, **increments):
+        with self._lock:
+            stats = self._model(model)
+            for key, value in increments.items():
+                stats[key] += value
+
+    def record_latency(self, model: str, seconds: float):
+        with self._lock:
+            latencies = self._model(model)['latencies']
+            latencies.append(seconds)
+            if len(latencies) > LATENCY_SAMPLES:
+                del latencies[0]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Return the metrics for every model, with latency percentiles in seconds."""
+        with self._lock:
+            result = {}
+            for model, stats in self._models.items():
+                latencies = sorted(stats['latencies'])
+                summary = {key: value for key, value in stats.items() if key != 'latencies'}
+                summary['throttle_wait_seconds'] = round(summary['throttle_wait_seconds'], 3)
+                summary['retry_wait_seconds'] = round(summary['retry_wait_seconds'], 3)
+                if latencies:
+                    summary['latency_p50'] = round(latencies[len(latencies) // 2], 3)
+                    summary['latency_p95'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3)
+                    summary['latency_max'] = round(latencies[-1], 3)
+                result[model] = summary
+            return result
+
+
+class LLMGateway:
+    """Rate-limited, retrying, circuit-broken entry point for client.messages.create and stream."""
+
+    def __init__(self, rate_limits: Dict[str, Dict[str, int]] = None, max_retries: int = LLM_MAX_RETRIES,
+                 base_delay: float = LLM_RETRY_BASE_DELAY, max_delay: float = LLM_RETRY_MAX_DELAY):
+        self.rate_limits = rate_limits or LLM_RATE_LIMITS
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = GatewayMetrics()
+        self._buckets = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight('claude')
+
+    def _limits_for(self, model: str):
+        """Return the (requests, input tokens, output tokens) buckets and breaker for a model."""
+        with self._lock:
+            if model not in self._buckets:
+                limits = self.rate_limits.get(model, self.rate_limits['default'])
+                self._buckets[model] = (
+                    TokenBucket(limits['requests_per_minute']),
+                    TokenBucket(limits['input_tokens_per_minute']),
+                    TokenBucket(limits['output_tokens_per_minute'])
+                )
+                self._breakers[model] = CircuitBreaker()
+            return self._buckets[model], self._breakers[model]
+
+    def waiting_callers(self) -> int:
+        """Return the number of callers blocked on an identical call made by another caller."""
+        return self._flights.stats()['waiting']
+
+    def _backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff: uniform in [0, min(max_delay, base * 2^attempt)]."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def create_message(self, client, fallback_models: Optional[List[str]] = None, stage: Optional[str] = None,
+                       **kwargs):
+        """
+        Call client.messages.create(**kwargs) through the gateway.
+
+        Args:
+            client: An Anthropic client
+            fallback_models: Models to try in order if the requested model is
+                overloaded, has an open circuit or keeps failing
+            stage: Pipeline stage making the call (see MODEL_ROUTES), which
+                names its trace span
+            **kwargs: Arguments for messages.create (model is required)
+
+        Returns:
+            The Messages API response. Identical calls made while this one is in
+            flight share it (counted as 'coalesced'). A shared response is still
+            charged to this caller's research budget, and this caller waits for
+            it no longer than its own deadline allows. If the call it waited for
+            ran out of its caller's time, this caller makes the call itself.
+
+        Raises:
+            CircuitOpenError: If the circuit breaker of the last model tried is open
+            DeadlineExceeded: If the request's deadline leaves no time for the call,
+                or passes while waiting for an identical call
+            Exception: The last API error if it is not retryable or retries run out
+        """
+        model = kwargs['model']
+        budget = current_budget()
+        deadline = getattr(budget, 'deadline', None)
+        with span(f"claude.{stage or 'call'}", model=model):
+            try:
+                response, shared = self._flights.do(
+                    request_key(kwargs, fallback_models), self._call_with_fallbacks,
+                    client, kwargs, fallback_models, lambda api_client: api_client.messages.create(**kwargs),
+                    wait_seconds=deadline.remaining() if deadline is not None else None,
+                    retry_on=(DeadlineExceeded,)
+                )
+            except FutureTimeoutError:
+                budget.record_timeout()
+                raise DeadlineExceeded(f"Deadline reached while waiting for an identical call to {model}")
+            if shared:
+                self.metrics.record(model, coalesced=1)
+                annotate(coalesced=True)
+                record_usage(model, getattr(response, 'usage', None))
+        return response
+
+    def stream_message(self, client, on_token: Callable[[str], None],
+                       fallback_models: Optional[List[str]] = None, stage: Optional[str] = None, **kwargs):
+        """
+        Stream a message through the gateway, passing each text delta to on_token.
+
+        A failed attempt is only retried if no text has been passed to on_token
+        yet, so the callback never sees text twice.
+
+        Args:
+            client: An Anthropic client
+            on_token: Called with each text delta as it arrives
+            fallback_models: Models to try in order if the requested model is
+                unavailable, as for create_message
+            stage: Pipeline stage making the call, as for create_message
+            **kwargs: Arguments for messages.stream (model is required)
+
+        Returns:
+            The final, accumulated Messages API response
+
+        Raises:
+            CircuitOpenError: If the model's circuit breaker is open
+            Exception: The last API error if it is not retryable, retries run out
+                or the stream fails after text was delivered
+        """
+        delivered = []
+        span_start = time.time()
+
+        def stream(api_client):
+            start_time = time.time()
+            with api_client.messages.stream(**kwargs) as message_stream:
+                for text in message_stream.text_stream:
+                    if not delivered:
+                        logger.debug("First token", model=kwargs['model'], seconds=round(time.time() - start_time, 2))
+                        # From the start of the span, so throttle waits and retries count
+                        annotate(first_token_seconds=round(time.time() - span_start, 3))
+                    delivered.append(len(text))
+                    on_token(text)
+                return message_stream.get_final_message()
+
+        with span(f"claude.{stage or 'call'}", model=kwargs['model'], streamed=True):
+            return self._call_with_fallbacks(client, kwargs, fallback_models, stream, can_retry=lambda: not delivered)
+
+    def _call_with_fallbacks(self, client, kwargs: Dict[str, Any], fallback_models: Optional[List[str]],
+                             send: Callable[[Any], Any], can_retry: Callable[[], bool] = lambda: True):
+        """Run send(client) against kwargs['model'], then each fallback model while they are unavailable."""
+        models = [kwargs['model']] + [model for model in (fallback_models or []) if model != kwargs['model']]
+        for i, model in enumerate(models):
+            kwargs['model'] = model
+            has_fallback = i < len(models) - 1
+            try:
+                return self._call(client, kwargs, send, can_retry, fail_fast_on_overload=has_fallback)
+            except Exception as e:
+                # Bad requests would fail on every model, and streamed text cannot be taken back
+                if not has_fallback or not (isinstance(e, CircuitOpenError) or is_retryable_error(e)) \
+                        or not can_retry():
+                    raise
+                self.metrics.record(model, fallbacks=1)
+                logger.warning("Model unavailable; falling back", model=model, error_type=type(e).__name__,
+                               fallback=models[i + 1])
+
+    def _call(self, client, kwargs: Dict[str, Any], send: Callable[[Any], Any],
+              can_retry: Callable[[], bool] = lambda: True, fail_fast_on_overload: bool = False):
+        """Run send(client) with throttling, retries, the circuit breaker and metrics."""
+        model = kwargs['model']
+        (requests_bucket, input_bucket, output_bucket), breaker = self._limits_for(model)
+        input_estimate = estimate_request_tokens(kwargs.get('system', ''), kwargs.get('messages', []))
+        output_reserved = kwargs.get('max_tokens', 0)
+
+        # The gateway owns retries, so the SDK's own retry loop is disabled
+        if hasattr(client, 'with_options'):
+            client = client.with_options(max_retries=0)
+
+        if uses_prompt_caching(kwargs):
+            kwargs['extra_headers'] = {**(kwargs.get('extra_headers') or {}), 'anthropic-beta': PROMPT_CACHING_BETA}
+
+        attempt = 0
+        while True:
+            try:
+                breaker.check(model)
+            except CircuitOpenError:
+                self.metrics.record(model, circuit_rejections=1)
+                raise
+
+            throttle_wait = requests_bucket.acquire(1)
+            throttle_wait += input_bucket.acquire(input_estimate)
+            throttle_wait += output_bucket.acquire(output_reserved)
+            self.metrics.record(model, calls=1, throttle_wait_seconds=throttle_wait)
+            record(throttle_wait_seconds=throttle_wait)
+
+            # Don't start a call that cannot finish before the request's deadline
+            deadline = getattr(current_budget(), 'deadline', None)
+            if deadline is not None:
+                try:
+                    deadline.check(DEADLINE_MIN_CALL_SECONDS, f"a call to {model}")
+                except DeadlineExceeded:
+                    breaker.release_trial()
+                    current_budget().record_timeout()
+                    requests_bucket.refund(1)
+                    input_bucket.refund(input_estimate)
+                    output_bucket.refund(output_reserved)
+                    raise
+                kwargs['timeout'] = deadline.remaining()
+
+            start_time = time.time()
+            try:
+                response = send(client)
+            except Exception as e:
+                self.metrics.record_latency(model, time.time() - start_time)
+                output_bucket.refund(output_reserved)
+                # Only server-side failures say anything about the model's health
+                if is_retryable_error(e) and getattr(e, 'status_code', None) not in CIRCUIT_IGNORED_STATUS_CODES:
+                    breaker.record_failure()
+                else:
+                    breaker.release_trial()
+
+                overloaded = fail_fast_on_overload and getattr(e, 'status_code', None) in OVERLOADED_STATUS_CODES
+                if not is_retryable_error(e) or attempt >= self.max_retries or not can_retry() or overloaded:
+                    self.metrics.record(model, failures=1)
+                    logger.error("LLM call failed", model=model, attempts=attempt + 1, error=str(e))
+                    raise
+
+                retry_after = get_retry_after(e)
+                delay = min(self.max_delay, retry_after) if retry_after is not None else self._backoff(attempt)
+                if deadline is not None and deadline.remaining() - delay < DEADLINE_MIN_CALL_SECONDS:
+                    self.metrics.record(model, failures=1)
+                    logger.error("LLM call failed and there is no time left to retry", model=model, error=str(e))
+                    raise
+                attempt += 1
+                self.metrics.record(model, retries=1, retry_wait_seconds=delay)
+                record(retries=1)
+                logger.warning("Retryable LLM error; retrying", model=model, error_type=type(e).__name__,
+                               delay_seconds=round(delay, 2), attempt=attempt, max_retries=self.max_retries)
+                time.sleep(delay)
+                continue
+
+            self.metrics.record_latency(model, time.time() - start_time)
+            breaker.record_success()
+
+            usage = getattr(response, 'usage', None)
+            input_tokens = getattr(usage, 'input_tokens', None) or 0
+            output_tokens = getattr(usage, 'output_tokens', None) or 0
+            cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+            cache_read_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+            output_bucket.refund(max(0, output_reserved - output_tokens))
+            self.metrics.record(
+                model, successes=1,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                cache_creation_input_tokens=cache_write_tokens,
+                cache_read_input_tokens=cache_read_tokens
+            )
+            # Charge the research budget (and tree node) this call was made for, if any
+            record_usage(model, usage)
+            record(input_tokens=input_tokens, output_tokens=output_tokens,
+                   cache_creation_input_tokens=cache_write_tokens, cache_read_input_tokens=cache_read_tokens)
+            # The model that answered, after any fallbacks
+            annotate(model=model)
+            logger.debug("LLM call usage", model=model, input_tokens=input_tokens, output_tokens=output_tokens,
+                         cache_write_tokens=cache_write_tokens, cache_read_tokens=cache_read_tokens)
+            return response
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    """Return the process-wide gateway shared by every RAGEngine."""
+    global _gateway
+    with _gateway_lock:
+        if _gateway is None:
+            _gateway = LLMGateway()
+        return _gateway
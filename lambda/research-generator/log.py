@@ -0,0 +1,165 @@
+"""
+Structured, leveled logging for the request path.
+
+Modules get a logger with get_logger(__name__) and log a message with
+keyword fields:
+
+    logger.info("Retrieved documents", documents=len(docs), depth=depth)
+
+Every line also carries the fields of the active log_context (the Lambda
+request id, the job id, the tree node's id and depth), which is a context
+variable, so it follows the request into NodeExecutor's threads. With
+LOG_FORMAT 'json' each line is one JSON object; with 'text' the fields
+follow the message.
+
+Messages below LOG_LEVEL cost an isEnabledFor check: their arguments are
+%-formatted only when they are written. Messages logged once per chunk,
+document or score use logger.sampled, which writes the first of each kind
+and then one in LOG_SAMPLE_EVERY.
+"""
+import sys
+import json
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+from config import LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_EVERY
+
+# Parent of every logger returned by get_logger
+ROOT_LOGGER = 'research'
+
+# Fields added to every line logged in the current context
+_context = contextvars.ContextVar('log_context', default={})
+
+_configure_lock = threading.Lock()
+_configured = False
+
+
+@contextmanager
+def log_context(**fields) -> Iterator[None]:
+    """Add fields (those that are not None) to every line logged inside the block and in contexts copied from it."""
+    token = _context.set({**_context.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def context_fields() -> Dict[str, Any]:
+    """Return the fields of the active log context."""
+    return dict(_context.get())
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object: time, level, logger, message, context and fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **_context.get(),
+            **getattr(record, 'fields', {})
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formats a record as a readable line with its context and fields as key=value pairs."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {**_context.get(), **getattr(record, 'fields', {})}
+        line = f"{record.levelname:<7} {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items() if value is not None)
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT):
+    """
+    Send the research loggers to stdout at a level and format ('json' or 'text').
+
+    Called with the configured defaults on the first get_logger; call it again
+    to change them (e.g. from a local script).
+    """
+    global _configured
+    with _configure_lock:
+        logger = logging.getLogger(ROOT_LOGGER)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        logger.addHandler(handler)
+        logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+        # Lambda's runtime installs its own handler on the root logger
+        logger.propagate = False
+        _configured = True
+
+
+class StructuredLogger:
+    """
+    A logger whose methods take the message's fields as keyword arguments.
+
+    Args:
+        name: Logger name, under the 'research' logger
+    """
+
+    __slots__ = ('logger', '_counts', '_lock')
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(f"{ROOT_LOGGER}.{name}")
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def is_enabled(self, level: int) -> bool:
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level: int, msg: str, args, fields: Dict[str, Any], exc_info=False):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, msg, *args, exc_info=exc_info, extra={'fields': fields}, stacklevel=3)
+
+    def debug(self, msg: str, *args, **fields):
+        self._log(logging.DEBUG, msg, args, fields)
+
+    def info(self, msg: str, *args, **fields):
+        self._log(logging.INFO, msg, args, fields)
+
+    def warning(self, msg: str, *args, **fields):
+        self._log(logging.WARNING, msg, args, fields)
+
+    def error(self, msg: str, *args, **fields):
+        self._log(logging.ERROR, msg, args, fields)
+
+    def exception(self, msg: str, *args, **fields):
+        """Log at ERROR with the traceback of the exception being handled."""
+        self._log(logging.ERROR, msg, args, fields, exc_info=True)
+
+    def sampled(self, level: int, key: str, msg: str, *args, **fields):
+        """
+        Log a per-item message of the kind `key` only once every LOG_SAMPLE_EVERY times.
+
+        The first message of each kind is written. Written messages carry
+        'sample_every' and the kind's running 'occurrence' count.
+        """
+        if not self.logger.isEnabledFor(level):
+            return
+        with self._lock:
+            occurrence = self._counts.get(key, 0) + 1
+            self._counts[key] = occurrence
+        if (occurrence - 1) % max(LOG_SAMPLE_EVERY, 1) == 0:
+            self._log(level, msg, args, {**fields, 'sample_every': LOG_SAMPLE_EVERY, 'occurrence': occurrence})
+
+
+def get_logger(name: str) -> StructuredLogger:
+    """Return a structured logger for a module, configuring the research loggers on first use."""
+    if not _configured:
+        configure_logging()
+    return StructuredLogger(name)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Local stub of the Anthropic Messages API for checking prompt caching offline.
+
+StubAnthropic accepts the same messages.create and messages.stream arguments
+as the real client, rejects requests whose cache_control payloads the API
+would reject, and simulates the provider's prompt cache so cache write and
+read token counts can be inspected without an API key.
+
+Usage:
+    python messages_stub.py   # answer two questions and show the cache write, then the read
+"""
+
+import json
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from config import MODEL_ROUTES, PROMPT_CACHING_BETA
+from llm_gateway import estimate_tokens, min_cacheable_tokens
+
+MAX_CACHE_BREAKPOINTS = 4
+CACHE_TTL_SECONDS = 300
+
+
+class StubRequestError(Exception):
+    """An invalid request, reported like the API's 400 invalid_request_error."""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.status_code = 400
+
+
+def _blocks(content: Any, field: str) -> List[Dict[str, Any]]:
+    """Validate a system or message content value and return it as a list of blocks."""
+    if isinstance(content, str):
+        return [{'type': 'text', 'text': content}]
+    if not isinstance(content, list):
+        raise StubRequestError(f"{field} must be a string or a list of content blocks")
+
+    for i, block in enumerate(content):
+        if not isinstance(block, dict) or 'type' not in block:
+            raise StubRequestError(f"{field}.{i} must be a content block with a type")
+        if block['type'] == 'text' and not isinstance(block.get('text'), str):
+            raise StubRequestError(f"{field}.{i}.text must be a string")
+        if field == 'system' and block['type'] != 'text':
+            raise StubRequestError(f"system.{i}.type must be 'text'")
+        if 'cache_control' in block and block['cache_control'] != {'type': 'ephemeral'}:
+            raise StubRequestError(f"{field}.{i}.cache_control must be {{'type': 'ephemeral'}}")
+    return content
+
+
+class StubMessages:
+    """Validating, cache-simulating stand-in for client.messages."""
+
+    def __init__(self, responder: Callable[[Dict[str, Any]], str], cache_ttl: float):
+        self.responder = responder
+        self.cache_ttl = cache_ttl
+        self.requests = []
+        # Cached prefix key -> (token count, expiry time)
+        self._cache = {}
+
+    def create(self, **kwargs):
+        for field in ('model', 'max_tokens', 'messages'):
+            if field not in kwargs:
+                raise StubRequestError(f"{field}: Field required")
+
+        model = kwargs['model']
+        system_blocks = _blocks(kwargs.get('system', ''), 'system')
+        messages = kwargs['messages']
+        if not messages or messages[0].get('role') != 'user':
+            raise StubRequestError("messages: first message must use the 'user' role")
+
+        # The prompt is cached in order: system blocks, then message blocks
+        prompt_blocks = list(system_blocks)
+        for i, message in enumerate(messages):
+            if i > 0 and message.get('role') == messages[i - 1].get('role'):
+                raise StubRequestError("messages: roles must alternate between 'user' and 'assistant'")
+            prompt_blocks.extend(_blocks(message.get('content'), f"messages.{i}.content"))
+
+        breakpoints = [i for i, block in enumerate(prompt_blocks) if 'cache_control' in block]
+        if len(breakpoints) > MAX_CACHE_BREAKPOINTS:
+            raise StubRequestError(f"A maximum of {MAX_CACHE_BREAKPOINTS} blocks with cache_control may be provided")
+        beta = (kwargs.get('extra_headers') or {}).get('anthropic-beta', '')
+        if breakpoints and PROMPT_CACHING_BETA not in beta:
+            raise StubRequestError(f"cache_control requires the 'anthropic-beta: {PROMPT_CACHING_BETA}' header")
+
+        self.requests.append(kwargs)
+        usage = self._apply_cache(model, prompt_blocks, breakpoints)
+        text = self.responder(kwargs)
+        usage['output_tokens'] = estimate_tokens(text)
+        return SimpleNamespace(
+            id=f"msg_stub_{uuid.uuid4().hex[:12]}",
+            type='message',
+            role='assistant',
+            model=model,
+            content=[SimpleNamespace(type='text', text=text)],
+            stop_reason='end_turn',
+            usage=SimpleNamespace(**usage)
+        )
+
+    def stream(self, **kwargs) -> 'StubMessageStream':
+        """Validate and answer the request like create, then replay the text in small deltas."""
+        return StubMessageStream(self.create(**kwargs))
+
+    def _apply_cache(self, model: str, prompt_blocks: List[Dict[str, Any]], breakpoints: List[int]) -> Dict[str, int]:
+        """Look up and write cache prefixes the way the API does, returning the input usage."""
+        def text_of(block):
+            return block.get('text', '') if block['type'] == 'text' else json.dumps(block)
+
+        total_tokens = estimate_tokens(''.join(text_of(block) for block in prompt_blocks))
+        now = time.time()
+        read_tokens = 0
+        write_tokens = 0
+
+        # The longest cached prefix ending at a breakpoint is read; longer ones are written
+        for index in sorted(breakpoints, reverse=True):
+            prefix = [{k: v for k, v in block.items() if k != 'cache_control'} for block in prompt_blocks[:index + 1]]
+            key = json.dumps([model, prefix], sort_keys=True)
+            prefix_tokens = estimate_tokens(''.join(text_of(block) for block in prefix))
+            cached = self._cache.get(key)
+            if cached and cached[1] > now:
+                read_tokens = cached[0]
+                self._cache[key] = (cached[0], now + self.cache_ttl)
+                break
+            if prefix_tokens >= min_cacheable_tokens(model):
+                self._cache[key] = (prefix_tokens, now + self.cache_ttl)
+                write_tokens = max(write_tokens, prefix_tokens)
+
+        write_tokens = max(0, write_tokens - read_tokens)
+        return {
+            'input_tokens': total_tokens - read_tokens - write_tokens,
+            'cache_creation_input_tokens': write_tokens,
+            'cache_read_input_tokens': read_tokens
+        }
+
+
+class StubMessageStream:
+    """Context manager mimicking the SDK's MessageStream for a finished stub response."""
+
+    def __init__(self, message):
+        self.message = message
+        text = message.content[0].text
+        self.text_stream = iter([text[i:i + 16] for i in range(0, len(text), 16)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def get_final_message(self):
+        for _ in self.text_stream:
+            pass
+        return self.message
+
+
+class StubAnthropic:
+    """
+    Drop-in replacement for anthropic.Anthropic with a validating messages.create.
+
+    Args:
+        responder: Returns the response text for a request's kwargs
+        cache_ttl: Seconds a cached prefix lives after its last use
+    """
+
+    def __init__(self, responder: Optional[Callable[[Dict[str, Any]], str]] = None,
+                 cache_ttl: float = CACHE_TTL_SECONDS):
+        self.messages = StubMessages(responder or (lambda kwargs: '<p class="body-text">Stub answer.</p>'), cache_ttl)
+
+    def with_options(self, **options):
+        return self
+
+
+def main():
+    from rag_engine import RAGEngine
+
+    def responder(kwargs):
+        if 'TASK: Plan' in json.dumps(kwargs.get('system')):
+            return json.dumps({'complexity': 2, 'answer_style': 'simple',
+                               'sub_questions': ['What is a qubit?', 'How are qubits controlled?']})
+        return '<p class="body-text">Stub answer.</p>'
+
+    client = StubAnthropic(responder)
+    rag = RAGEngine(use_base_index=False)
+    questions = [
+        ('How do quantum computers work?', 'Quantum computers use qubits.'),
+        ('What is superposition?', 'Superposition lets a qubit hold several states at once.'),
+    ]
+    for question, context in questions:
+        plan = rag.plan_question(question, context, client)
+        print(f"{question} -> {plan}")
+        # The root answer is the Sonnet-routed stage, whose minimum the shared prefix reaches
+        rag._answer_from_context(question, context, client, 0, False, plan['answer_style'], None, time.time())
+
+    prefix_tokens = estimate_tokens(rag.shared_system_prompt)
+    print(f"\nShared system prefix: ~{prefix_tokens} tokens")
+    for stage, route in MODEL_ROUTES.items():
+        cacheable = prefix_tokens >= min_cacheable_tokens(route['model'])
+        print(f"  {stage} ({route['model']}, minimum {min_cacheable_tokens(route['model'])}): "
+              f"{'cached' if cacheable else 'sent without a breakpoint'}")
+    for model, stats in rag.gateway.metrics.snapshot().items():
+        print(f"{model}: {stats['cache_creation_input_tokens']} cache write tokens, "
+              f"{stats['cache_read_input_tokens']} cache read tokens")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Concurrent execution of the steps that prepare an internal tree node.
+
+Done in sequence, planning a node means a Brave search, chunking, embedding
+and indexing the results, a retrieval and then the planner call. Sub-questions
+are only as good as the context they are written from, so the planner still
+waits for the search. What can overlap is the complexity assessment: the
+search and ingestion run in the background while the caller's thread rates
+the question with the classifier. A question rated very simple is answered
+without sub-questions, so its planner call is skipped altogether. Otherwise
+the question is planned from the retrieved context with that complexity, so
+the planner does not rate it again, and the embeddings of the sub-questions,
+which the children retrieve with next, are prefetched.
+
+Only the search and the prefetch run on the pool, so it needs
+NODE_EXECUTOR_STEPS_PER_TREE threads for each tree built at once.
+"""
+import time
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+from config import SPECULATIVE_PLANNING, NODE_EXECUTOR_STEPS_PER_TREE
+from planner import max_sub_questions_for
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+class NodeExecutor:
+    """
+    Runs the background steps of preparing a node on a thread pool.
+
+    Args:
+        rag_engine: The RAGEngine whose knowledge base and planner are used
+        concurrent_trees: Trees the engine builds at once (e.g. the server's
+            workers or batch research's max_trees); the pool is sized so
+            none of them waits for another's steps
+    """
+
+    def __init__(self, rag_engine, concurrent_trees: int):
+        self.rag = rag_engine
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrent_trees) * NODE_EXECUTOR_STEPS_PER_TREE,
+                                        thread_name_prefix='node-step')
+
+    def _submit(self, fn: Callable, *args, **kwargs) -> Future:
+        # Run in a copy of the caller's context so Claude calls are charged to its budget and node
+        context = contextvars.copy_context()
+        return self._pool.submit(context.run, fn, *args, **kwargs)
+
+    def plan_node(self, question: str, client, brave_api_key: str) -> Dict[str, Any]:
+        """
+        Populate the knowledge base for a question and plan it from the retrieved context.
+
+        The complexity assessment runs on the calling thread while the search
+        and ingestion run in the background. With SPECULATIVE_PLANNING
+        disabled this is RAGEngine.search_and_plan.
+
+        Returns:
+            The plan from RAGEngine.plan_question, or one without sub-questions
+            for a question assessed as very simple, once the knowledge base is
+            populated
+
+        Raises:
+            Exception: Any error from the search or the planner. Steps that
+                have not started yet are cancelled.
+        """
+        if not SPECULATIVE_PLANNING:
+            return self.rag.search_and_plan(question, client, brave_api_key)
+
+        start_time = time.time()
+        futures = []
+        try:
+            search = self._submit(self.rag.kb_manager.populate_from_brave_search, question, brave_api_key,
+                                  num_results=3)
+            futures.append(search)
+            complexity = self.rag.assess_complexity(question, client)
+            assess_seconds = time.time() - start_time
+            search.result()
+
+            if max_sub_questions_for(complexity) == 0:
+                logger.debug("Very simple question; skipping the planner",
+                             seconds=round(time.time() - start_time, 2), assess_seconds=round(assess_seconds, 2))
+                return {'complexity': complexity, 'answer_style': None, 'sub_questions': []}
+
+            plan = self.rag.plan_from_context(question, client, complexity=complexity)
+            if len(plan['sub_questions']) > 1:
+                # The children retrieve with their questions first; embed them all while the first one searches
+                self.prefetch(plan['sub_questions'])
+            logger.debug("Planned node; complexity assessed during search and ingestion",
+                         seconds=round(time.time() - start_time, 2), assess_seconds=round(assess_seconds, 2))
+            return plan
+        except Exception:
+            self.cancel(futures)
+            raise
+
+    def prefetch(self, queries: List[str]) -> Future:
+        """Start embedding retrieval queries in the background (see RAGEngine.prefetch_query_embeddings)."""
+        return self._submit(self.rag.prefetch_query_embeddings, queries)
+
+    @staticmethod
+    def cancel(futures: List[Future]):
+        """Cancel the steps that have not started; running ones finish and are ignored."""
+        cancelled = sum(1 for future in futures if future.cancel())
+        if cancelled:
+            logger.debug("Cancelled unneeded node steps", cancelled=cancelled)
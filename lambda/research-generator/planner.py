@@ -0,0 +1,107 @@
+"""
+Structured question planning for the research generator.
+
+A single planner call returns the complexity rating, the answer style and the
+sub-questions for a question as JSON. When the complexity has already been
+rated (by the classifier, while the node's search runs), the planner is given
+it and leaves it out of its response. This module holds the schema, the
+parser and the validation rules; RAGEngine.plan_question makes the call.
+"""
+import json
+from typing import Any, Dict, List, Optional
+
+ANSWER_STYLES = ('simple', 'comprehensive')
+
+# Documented for the prompt and for readers; validate_plan enforces it
+PLAN_SCHEMA = {
+    "type": "object",
+    "required": ["complexity", "answer_style", "sub_questions"],
+    "properties": {
+        "complexity": {"type": "integer", "minimum": 1, "maximum": 5},
+        "answer_style": {"type": "string", "enum": list(ANSWER_STYLES)},
+        "sub_questions": {"type": "array", "items": {"type": "string"}, "maxItems": 5}
+    }
+}
+
+
+class PlanValidationError(ValueError):
+    """Raised when a planner response is not valid JSON matching PLAN_SCHEMA."""
+
+
+def max_sub_questions_for(complexity: int) -> int:
+    """
+    Map a complexity level to the number of sub-questions to generate.
+
+    Level 1 questions are answered directly; levels 2-5 get that many sub-questions.
+    """
+    if complexity <= 1:
+        return 0
+    return min(complexity, 5)
+
+
+def validate_plan(data: Any, complexity: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Validate a decoded plan against PLAN_SCHEMA and normalize it.
+
+    Sub-questions are stripped, emptied ones dropped, and the list is trimmed
+    to the number allowed for the plan's complexity.
+
+    Args:
+        data: The decoded plan
+        complexity: The question's complexity if it was rated before planning;
+            the plan then needs no complexity field, and any it has is ignored
+
+    Raises:
+        PlanValidationError: If the plan does not match the schema
+    """
+    if not isinstance(data, dict):
+        raise PlanValidationError(f"Plan must be a JSON object, got {type(data).__name__}")
+
+    required = [key for key in PLAN_SCHEMA['required'] if complexity is None or key != 'complexity']
+    missing = [key for key in required if key not in data]
+    if missing:
+        raise PlanValidationError(f"Plan is missing required fields: {', '.join(missing)}")
+
+    if complexity is None:
+        complexity = data['complexity']
+        if isinstance(complexity, bool) or not isinstance(complexity, int) or not 1 <= complexity <= 5:
+            raise PlanValidationError(f"complexity must be an integer from 1 to 5, got {complexity!r}")
+
+    answer_style = data['answer_style']
+    if answer_style not in ANSWER_STYLES:
+        raise PlanValidationError(f"answer_style must be one of {ANSWER_STYLES}, got {answer_style!r}")
+
+    sub_questions = data['sub_questions']
+    if not isinstance(sub_questions, list) or not all(isinstance(q, str) for q in sub_questions):
+        raise PlanValidationError("sub_questions must be a list of strings")
+
+    cleaned: List[str] = [q.strip() for q in sub_questions if q.strip()]
+    return {
+        'complexity': complexity,
+        'answer_style': answer_style,
+        'sub_questions': cleaned[:max_sub_questions_for(complexity)]
+    }
+
+
+def parse_plan(text: str, complexity: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Parse and validate the planner's response text.
+
+    The model is asked for bare JSON, but any text around the outermost JSON
+    object (such as a code fence) is tolerated. complexity is passed to
+    validate_plan.
+
+    Raises:
+        PlanValidationError: If no valid plan can be parsed
+    """
+    start = text.find('{')
+    end = text.rfind('}')
+    if start == -1 or end <= start:
+        raise PlanValidationError("Planner response contains no JSON object")
+
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise PlanValidationError(f"Planner response is not valid JSON: {str(e)}")
+
+    return validate_plan(data, complexity)
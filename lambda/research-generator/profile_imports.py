@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Import-time profile of the Lambda handler.
+
+Imports a module in a fresh interpreter with `python -X importtime` and
+reports how long each imported module took, in milliseconds: its own
+import time ('self') and including the modules it imported ('cumulative').
+Packages are also totalled, so a heavy dependency (botocore, anthropic,
+faiss) shows up as one line however many submodules it has.
+
+Usage:
+    python profile_imports.py                     # lambda_function, top 25 modules
+    python profile_imports.py rag_engine --top 10
+    python profile_imports.py --json              # machine-readable report
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from typing import Any, Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def profile_imports(module: str = 'lambda_function', env: Dict[str, str] = None) -> List[Dict[str, Any]]:
+    """
+    Import a module in a fresh interpreter and return the time spent importing each module.
+
+    Args:
+        module: Module to import, from this directory
+        env: Extra environment variables for the interpreter (e.g. PRELOAD_ON_INIT=false,
+            so only imports are measured)
+
+    Returns:
+        One dict per imported module, in import order, with 'module', 'depth'
+        (nesting level), 'self_ms' and 'cumulative_ms'
+
+    Raises:
+        RuntimeError: If the import fails
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=HERE, env={**os.environ, 'PRELOAD_ON_INIT': 'false', **(env or {})},
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    modules = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append({
+            'module': name.strip(),
+            'depth': (len(name) - len(name.lstrip(' ')) - 1) // 2,
+            'self_ms': int(self_us) / 1000,
+            'cumulative_ms': int(cumulative_us) / 1000
+        })
+    return modules
+
+
+def package_totals(modules: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Return the import time of each top-level package (the sum of its modules' own times), in ms."""
+    totals = {}
+    for entry in modules:
+        package = entry['module'].split('.')[0]
+        totals[package] = totals.get(package, 0.0) + entry['self_ms']
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def import_report(module: str = 'lambda_function', top: int = 25) -> Dict[str, Any]:
+    """Profile a module's imports and summarize the slowest modules and packages."""
+    modules = profile_imports(module)
+    root = next((entry for entry in reversed(modules) if entry['module'] == module), None)
+    slowest = sorted(modules, key=lambda entry: -entry['cumulative_ms'])
+    return {
+        'module': module,
+        'total_ms': round(root['cumulative_ms'] if root else sum(e['self_ms'] for e in modules), 1),
+        'modules': len(modules),
+        'slowest_modules': [
+            {'module': e['module'], 'self_ms': round(e['self_ms'], 1), 'cumulative_ms': round(e['cumulative_ms'], 1)}
+            for e in slowest[:top]
+        ],
+        'packages': {name: round(ms, 1) for name, ms in list(package_totals(modules).items())[:top]}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the import time of each module imported by a module.')
+    parser.add_argument('module', nargs='?', default='lambda_function', help='Module to profile')
+    parser.add_argument('--top', type=int, default=25, help='Modules and packages to list')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = import_report(args.module, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"Importing {report['module']}: {report['total_ms']:.1f} ms, {report['modules']} modules\n")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for entry in report['slowest_modules']:
+        print(f"{entry['cumulative_ms']:>14.1f} {entry['self_ms']:>9.1f}  {entry['module']}")
+    print(f"\n{'package ms':>14}  package")
+    for name, ms in report['packages'].items():
+        print(f"{ms:>14.1f}  {name}")
+
+
+if __name__ == '__main__':
+    main()
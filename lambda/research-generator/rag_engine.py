@@ -2,45 +2,43 @@
 RAG (Retrieval-Augmented Generation) engine for the research generator.
 """
 import os
+import json
 import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
 import faiss
 import numpy as np
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable, Optional, Tuple
 from openai import OpenAI
 from config import (
     VECTOR_DB_TYPE, EMBEDDING_MODEL, VECTOR_DB_PATH,
     TOP_K_RESULTS, CHUNK_SIZE, CHUNK_OVERLAP,
-    SIMILARITY_THRESHOLD, DEFAULT_MODEL, DEFAULT_ANSWER_MAX_TOKENS,
-    DEFAULT_EVALUATION_MAX_TOKENS
+    SIMILARITY_THRESHOLD, PREBUILT_INDEX_PATH, MODEL_ROUTES,
+    SYNTHESIS_NOTE_MAX_TOKENS, SYNTHESIS_MAX_INPUT_TOKENS, SYNTHESIS_GROUP_TOKENS, SYNTHESIS_MAX_LEVELS,
+    QUERY_EMBEDDING_CACHE_SIZE, RESEARCH_BUDGET, SPECULATIVE_PLANNING, SERVER_WORKERS
 )
 from utils import extract_content
+from context_assembler import assemble_context
 from knowledge_base import KnowledgeBaseManager
+from base_index import open_base_index
+from ingest_pipeline import IngestPipeline
+from node_executor import NodeExecutor
+from llm_gateway import get_gateway, cached_system, estimate_tokens
+from synthesis import child_notes, group_notes, notes_tokens, truncate_notes
+from budget import ResearchBudget, current_budget
+from deadline import Deadline, DeadlineExceeded
+from planner import PLAN_SCHEMA, PlanValidationError, max_sub_questions_for, parse_plan
+from tree_shape import TreeShape
+from tree_model import Source, TreeNode
+from log import get_logger, log_context
+from singleflight import SingleFlight
+from tracing import annotate, span
+import logging
 import time
-import traceback
-import random
-
-def retry_with_exponential_backoff(initial_delay=1, exponential_base=2, jitter=True, max_retries=10, errors=(Exception,)):
-    """Retry a function with exponential backoff."""
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            num_retries = 0
-            delay = initial_delay
-            
-            while True:
-                try:
-                    return func(*args, **kwargs)
-                except errors as e:
-                    num_retries += 1
-                    if num_retries > max_retries:
-                        print(f"Maximum retries ({max_retries}) exceeded.")
-                        raise e
-                    
-                    delay *= exponential_base * (1 + jitter * random.random())
-                    print(f"Retrying in {delay:.2f} seconds... (Attempt {num_retries}/{max_retries})")
-                    print(f"Error: {str(e)}")
-                    time.sleep(delay)
-        return wrapper
-    return decorator
+
+logger = get_logger(__name__)
+
 
 def get_token_limit_for_depth(base_limit: int, depth: int) -> int:
     """
@@ -67,6 +65,25 @@ def get_token_limit_for_depth(base_limit: int, depth: int) -> int:
         # Root node - full detail
         return base_limit
 
+def tree_parameters(shape: Optional[TreeShape] = None) -> Dict[str, Any]:
+    """
+    Return the settings that shape a research tree and its answers.
+    
+    Results built with different parameters are not interchangeable, so
+    these are part of the result cache key (see result_cache.py).
+    
+    Args:
+        shape: The request's tree shape (the default shape if not given)
+    """
+    return {
+        **(shape or TreeShape()).as_dict(),
+        'model_routes': MODEL_ROUTES,
+        'research_budget': RESEARCH_BUDGET,
+        'speculative_planning': SPECULATIVE_PLANNING,
+        'top_k_results': TOP_K_RESULTS,
+        'similarity_threshold': SIMILARITY_THRESHOLD
+    }
+
 def estimate_sources_tokens(sources: List[Dict[str, str]]) -> int:
     """
     Estimate the number of tokens needed for the sources section.
@@ -120,13 +137,33 @@ def deduplicate_sources(sources: List[Dict[str, str]]) -> List[Dict[str, str]]:
     return list(unique_sources.values())
 
 class RAGEngine:
-    def __init__(self):
+    def __init__(self, vector_db_path: str = None, use_base_index: bool = True, ledger_path: str = None,
+                 concurrent_trees: int = SERVER_WORKERS):
+        # Writable delta index and its documents
         self.index = None
         self.documents = []
+        self._index_lock = threading.Lock()
+        # Serializes saves, so an older snapshot never overwrites a newer one
+        self._save_lock = threading.Lock()
+        # Explicit paths are used by offline tooling (e.g. bulk ingestion)
+        self.vector_db_path = vector_db_path or self._default_vector_db_path()
+        # Large read-only index searched alongside the delta index
+        self.base_index = open_base_index(PREBUILT_INDEX_PATH) if use_base_index else None
         self.initialize_vector_db()
-        self.kb_manager = KnowledgeBaseManager(self)
+        # Offline tooling keeps the sources ledger alongside its own index
+        self.kb_manager = KnowledgeBaseManager(self, ledger_path=ledger_path)
         # Initialize without API key - it will be set later
         self.openai_client = None
+        # Query text -> embedding, or a Future while a prefetch is computing it
+        self._query_embeddings = OrderedDict()
+        self._query_embeddings_lock = threading.Lock()
+        # Query embeddings being computed outside a prefetch, shared by concurrent callers
+        self._embedding_flights = SingleFlight('embedding')
+        # Every Claude call goes through the shared, rate-limited gateway
+        self.gateway = get_gateway()
+        # Overlaps a node's complexity assessment with its search and ingestion, for as many trees
+        # as this engine builds at once
+        self.node_executor = NodeExecutor(self, concurrent_trees=concurrent_trees)
         # Define HTML formatting templates
         self._init_formatting_templates()
     
@@ -234,20 +271,154 @@ AVOID:
 - Creating sub-questions that require their own breakdown
 
 Your responses should contain ONLY the sub-questions, one per line, with no additional text, prefixes, or explanations."""
+
+        # Planner task: complexity, answer style and sub-questions in one JSON response
+        self.planner_system_message = """TASK: Plan the research question in the user's message.
+Rate its complexity using <complexity_levels>, choose an answer style from <answer_styles> and break it down following <sub_question_guidelines>.
+
+- complexity: the complexity level from 1 to 5
+- answer_style: 'simple' if the question can be answered directly and concisely, otherwise 'comprehensive'
+- sub_questions: an empty list for level 1; otherwise exactly as many MUCH SIMPLER sub-questions as the complexity level (2-5)
+
+Respond with ONLY a JSON object matching <plan_schema>, with no code fences or additional text."""
+
+        # Planner task for a question whose complexity the classifier already rated: answer style and sub-questions
+        self.rated_planner_system_message = """TASK: Plan the research question in the user's message, whose complexity level (see <complexity_levels>) is given after it.
+Choose an answer style from <answer_styles> and break it down following <sub_question_guidelines>.
+
+- answer_style: 'simple' if the question can be answered directly and concisely, otherwise 'comprehensive'
+- sub_questions: exactly as many MUCH SIMPLER sub-questions as the given complexity level (2-5)
+
+Respond with ONLY a JSON object matching <plan_schema> but without the complexity field, with no code fences or additional text."""
+
+        # Answer tasks: static guidelines live here so the user message only holds context and question
+        self.simple_answer_instructions = """TASK: You are a helpful research assistant that provides clear, direct answers to simple questions.
+Answer the question in the user's message based on the provided context, formatted as described in <simple_format>.
+
+Guidelines:
+1. Be direct and to the point
+2. Provide a complete answer
+3. Use appropriate HTML formatting for readability"""
+
+        self.comprehensive_answer_instructions = """TASK: You are a helpful research assistant that provides comprehensive, well-structured answers based on provided context.
+Answer the question in the user's message based on the provided context, formatted as described in <comprehensive_format>.
+
+Guidelines:
+1. Be thorough and well-structured
+2. Use appropriate HTML formatting for readability"""
+
+        self.concise_answer_instructions = """TASK: You are a helpful research assistant that provides concise, focused answers to specific questions.
+Provide a VERY CONCISE answer to the specific question in the user's message, formatted as described in <simple_format>. Focus only on the most relevant information.
+
+Guidelines:
+1. Keep your answer brief and to the point
+2. Use bullet points and short paragraphs
+3. Include only the most essential information"""
+
+        # Synthesis map step: condense a group of child answer notes for a parent's answer
+        self.synthesis_map_instructions = """TASK: Condense the research notes in the user's message for answering the question it states.
+The notes are answers to sub-questions of that question. They will be combined with other condensed notes and used as the context for the final answer.
+
+Guidelines:
+1. Keep every fact, figure, name and date that helps answer the question
+2. Merge points that repeat each other and drop anything off-topic
+3. Keep each sub-question's heading (lines starting with ##) above its points
+4. Respond with ONLY plain-text notes: headings and short bullet points, no HTML"""
+
+        # Static prefix shared by every Claude call. It never varies, so it is marked as a
+        # prompt cache breakpoint and served from the cache after the first call; each call's
+        # task instructions follow it. The individual templates are too short to be cached alone.
+        self.shared_system_prompt = f"""You are a research assistant that plans research questions and answers them from provided context.
+The reference material below is shared by every task you may be given. Follow the TASK that comes after it.
+
+<complexity_levels>
+1 - Very Simple: Straightforward factual questions with single, direct answers
+   Example: "What is the capital of France?"
+2 - Simple: Questions with clear focus but requiring some explanation
+   Example: "How does photosynthesis work?"
+3 - Moderate: Questions with multiple aspects that benefit from some breakdown
+   Example: "What were the main causes of World War I?"
+4 - Complex: Multifaceted questions requiring comprehensive analysis
+   Example: "How has artificial intelligence impacted the global economy?"
+5 - Very Complex: Sophisticated questions with many interconnected dimensions
+   Example: "What are the economic, social, environmental, and ethical implications of gene editing technologies, and how might these evolve over the next decade?"
+</complexity_levels>
+
+<answer_styles>
+- simple: A single, well-defined concept that can be answered directly and concisely
+- comprehensive: Multiple interconnected concepts that need a structured, thorough answer
+</answer_styles>
+
+<sub_question_guidelines>
+Each sub-question MUST:
+1. Be significantly simpler than the original question
+2. Focus on a single, narrow aspect of the original question
+3. Use simpler vocabulary and more basic sentence structure
+4. Be answerable without requiring further breakdown
+5. Be more specific and concrete than the original question
+6. Avoid introducing new complexity or broadening the scope
+</sub_question_guidelines>
+
+<plan_schema>
+{json.dumps(PLAN_SCHEMA, indent=2)}
+</plan_schema>
+
+<comprehensive_format>
+{self.comprehensive_format}
+</comprehensive_format>
+
+<simple_format>
+{self.simple_format}
+</simple_format>"""
+    
+    @staticmethod
+    def _route(stage: str) -> Dict[str, Any]:
+        """
+        Return the gateway arguments for a pipeline stage from MODEL_ROUTES.
+        
+        Args:
+            stage: 'classifier', 'planner', 'leaf_answer', 'synthesis_map' or 'root_synthesis'
+            
+        Returns:
+            model, max_tokens, temperature (if set), fallback_models and the stage
+            (which names the call's trace span)
+        """
+        route = MODEL_ROUTES[stage]
+        request = {
+            'model': route['model'],
+            'max_tokens': route['max_tokens'],
+            'fallback_models': route.get('fallbacks', []),
+            'stage': stage
+        }
+        if route.get('temperature') is not None:
+            request['temperature'] = route['temperature']
+        return request
+    
+    def _system(self, instructions: str, stage: str) -> Any:
+        """
+        Build a system prompt of the shared prefix followed by task instructions.
+        
+        The prefix is marked cacheable when it is long enough to cache for the stage's model.
+        """
+        return cached_system(self.shared_system_prompt, instructions, MODEL_ROUTES[stage]['model'])
     
     def set_openai_key(self, api_key: str):
         """Set the OpenAI API key and initialize the client."""
         self.openai_client = OpenAI(api_key=api_key)
     
-    def initialize_vector_db(self):
-        """Initialize the vector database based on configuration."""
+    @staticmethod
+    def _default_vector_db_path() -> str:
+        """Return the writable vector DB directory for the current environment."""
         # Ensure we're using the /tmp directory in Lambda environments
         if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
             # We're running in Lambda, ensure we're using /tmp
-            vector_db_path = "/tmp/vector_db"
-        else:
-            # Use the configured path
-            vector_db_path = VECTOR_DB_PATH
+            return "/tmp/vector_db"
+        # Use the configured path
+        return VECTOR_DB_PATH
+    
+    def initialize_vector_db(self):
+        """Initialize the vector database based on configuration."""
+        vector_db_path = self.vector_db_path
             
         # Ensure the vector_db directory exists
         os.makedirs(vector_db_path, exist_ok=True)
@@ -263,10 +434,10 @@ Your responses should contain ONLY the sub-questions, one per line, with no addi
                     # Load documents
                     with open(documents_path, 'rb') as f:
                         self.documents = np.load(f, allow_pickle=True).tolist()
-                    print(f"Loaded existing vector DB from {vector_db_path}")
+                    logger.info("Loaded existing vector DB", path=vector_db_path)
                 except Exception as e:
-                    print(f"Error loading existing vector DB: {str(e)}")
-                    print("Creating new vector DB...")
+                    logger.warning("Error loading existing vector DB; creating a new one", path=vector_db_path,
+                                   error=str(e))
                     # Create new index
                     self.index = faiss.IndexFlatL2(1536)  # OpenAI embedding dimension
                     self.documents = []
@@ -275,7 +446,7 @@ Your responses should contain ONLY the sub-questions, one per line, with no addi
                         faiss.write_index(self.index, index_path)
                         np.save(documents_path, np.array(self.documents))
                     except Exception as e2:
-                        print(f"Error saving new vector DB: {str(e2)}")
+                        logger.error("Error saving new vector DB", path=vector_db_path, error=str(e2))
             else:
                 # Create new index
                 self.index = faiss.IndexFlatL2(1536)  # OpenAI embedding dimension
@@ -285,193 +456,273 @@ Your responses should contain ONLY the sub-questions, one per line, with no addi
                     faiss.write_index(self.index, index_path)
                     np.save(documents_path, np.array(self.documents))
                 except Exception as e:
-                    print(f"Error saving new vector DB: {str(e)}")
+                    logger.error("Error saving new vector DB", path=vector_db_path, error=str(e))
                 
-            print(f"Vector DB initialized at {vector_db_path}")
-            print(f"Number of documents: {len(self.documents)}")
-            print(f"Index size: {self.index.ntotal} vectors")
+            logger.info("Vector DB initialized", path=vector_db_path, documents=len(self.documents),
+                        index_vectors=self.index.ntotal,
+                        base_index_vectors=self.base_index.ntotal if self.base_index else None)
     
     def get_embeddings(self, texts: List[str]) -> np.ndarray:
         """Get embeddings for a list of texts using OpenAI's API."""
         try:
-            print(f"Starting embedding generation for {len(texts)} texts at {time.strftime('%H:%M:%S')}")
             start_time = time.time()
             
-            response = self.openai_client.embeddings.create(
-                model=EMBEDDING_MODEL,
-                input=texts
-            )
-            
-            end_time = time.time()
-            duration = end_time - start_time
-            print(f"Embedding generation completed in {duration:.2f} seconds")
+            with span('openai.embeddings', texts=len(texts)):
+                response = self.openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=texts
+                )
             
             embeddings = np.array([r.embedding for r in response.data])
-            print(f"Successfully processed {len(embeddings)} embeddings")
+            logger.debug("Generated embeddings", texts=len(texts), seconds=round(time.time() - start_time, 3))
             return embeddings
             
         except Exception as e:
-            print(f"Error in get_embeddings: {str(e)}")
-            if hasattr(e, 'response'):
-                print(f"Response status: {e.response.status_code}")
-                print(f"Response body: {e.response.text}")
+            response = getattr(e, 'response', None)
+            logger.error("Error in get_embeddings", texts=len(texts), error=str(e),
+                         status=getattr(response, 'status_code', None),
+                         body=getattr(response, 'text', None))
             raise
     
-    def add_documents(self, documents: List[Dict[str, Any]]):
-        """Add new documents to the vector database."""
-        print("\nProcessing documents for vector database...")
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Return the embedding of a retrieval query, from the query embedding cache if possible.
         
-        # Determine the vector_db_path
-        if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
-            # We're running in Lambda, ensure we're using /tmp
-            vector_db_path = "/tmp/vector_db"
-        else:
-            # Use the configured path
-            vector_db_path = VECTOR_DB_PATH
-        
-        # Process documents into chunks
-        print("Chunking documents...")
-        chunks = []
-        for i, doc in enumerate(documents, 1):
-            print(f"\nChunking document {i}/{len(documents)}:")
-            print(f"Document length: {len(doc['content'])} characters")
-            doc_chunks = self._chunk_text(doc['content'])
-            print(f"Created {len(doc_chunks)} chunks")
-            for chunk in doc_chunks:
-                chunks.append({
-                    'content': chunk,
-                    'metadata': doc.get('metadata', {})
-                })
+        A node and its answer retrieve with the same question, and
+        prefetch_query_embeddings or another thread may already be computing
+        it, so most queries are embedded only once.
+        """
+        with self._query_embeddings_lock:
+            cached = self._query_embeddings.get(query)
+            if cached is not None:
+                self._query_embeddings.move_to_end(query)
+        if isinstance(cached, Future):
+            # A prefetch is embedding it; on failure, embed it here instead
+            try:
+                cached.result()
+            except Exception:
+                pass
+            with self._query_embeddings_lock:
+                cached = self._query_embeddings.get(query)
+            if isinstance(cached, Future):
+                cached = None
+        if cached is not None:
+            return cached
         
-        print(f"\nTotal chunks created: {len(chunks)}")
+        embedding, _ = self._embedding_flights.do(query, self._compute_query_embedding, query)
+        return embedding
+    
+    def _compute_query_embedding(self, query: str) -> np.ndarray:
+        embedding = self.get_embeddings([query])[0]
+        self._cache_query_embedding(query, embedding)
+        return embedding
+    
+    def prefetch_query_embeddings(self, queries: List[str]):
+        """Embed the queries not yet cached with a single embeddings request."""
+        with self._query_embeddings_lock:
+            missing = [query for query in dict.fromkeys(queries) if query not in self._query_embeddings]
+            pending = Future()
+            pending.set_running_or_notify_cancel()
+            for query in missing:
+                self._query_embeddings[query] = pending
+        if not missing:
+            return
         
-        # Get embeddings for chunks
-        print("\nGenerating embeddings using OpenAI API...")
+        logger.debug("Prefetching query embeddings", queries=len(missing))
         try:
-            chunk_texts = [c['content'] for c in chunks]
-            print(f"Getting embeddings for {len(chunk_texts)} chunks")
-            embeddings = self.get_embeddings(chunk_texts)
-            print(f"Successfully generated {len(embeddings)} embeddings")
+            embeddings = self.get_embeddings(missing)
         except Exception as e:
-            print(f"Error generating embeddings: {str(e)}")
+            # Waiters fall back to embedding their own query
+            with self._query_embeddings_lock:
+                for query in missing:
+                    if self._query_embeddings.get(query) is pending:
+                        del self._query_embeddings[query]
+            pending.set_exception(e)
             raise
+        for query, embedding in zip(missing, embeddings):
+            self._cache_query_embedding(query, embedding)
+        pending.set_result(None)
+    
+    def _cache_query_embedding(self, query: str, embedding: np.ndarray):
+        with self._query_embeddings_lock:
+            self._query_embeddings[query] = embedding
+            self._query_embeddings.move_to_end(query)
+            while len(self._query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_embeddings.popitem(last=False)
+    
+    def save_vector_db(self, vector_db_path: str = None):
+        """
+        Persist the FAISS index and document list.
         
-        # Add to FAISS index
-        print("\nAdding embeddings to FAISS index...")
-        try:
-            self.index.add(embeddings)
-            print("Successfully added embeddings to FAISS index")
-        except Exception as e:
-            print(f"Error adding to FAISS index: {str(e)}")
-            raise
+        The index is only locked while it is copied, so concurrent requests
+        keep searching while the copy is written. Each file is written to a
+        temporary file and renamed into place, so a reader never sees a
+        partly written one.
+        """
+        vector_db_path = vector_db_path or self.vector_db_path
+        os.makedirs(vector_db_path, exist_ok=True)
         
-        # Update documents list
-        print("\nUpdating documents list...")
-        try:
+        logger.debug("Saving FAISS index and documents", path=vector_db_path)
+        index_path = os.path.join(vector_db_path, "index.faiss")
+        documents_path = os.path.join(vector_db_path, "documents.npy")
+        
+        with self._save_lock, span('persist.vector_db'):
+            with self._index_lock:
+                index_bytes = faiss.serialize_index(self.index)
+                documents = list(self.documents)
+            with open(f"{index_path}.tmp", 'wb') as f:
+                f.write(index_bytes.tobytes())
+            with open(f"{documents_path}.tmp", 'wb') as f:
+                np.save(f, np.array(documents))
+            os.replace(f"{index_path}.tmp", index_path)
+            os.replace(f"{documents_path}.tmp", documents_path)
+            annotate(index_chunks=len(documents), bytes=int(index_bytes.nbytes))
+    
+    def chunk_document(self, document: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Split a document into chunk dicts carrying its metadata.
+
+        Each chunk's metadata also records its index and character offset in
+        the document, so the context assembler can merge neighbouring chunks.
+        """
+        text = document['content']
+        metadata = document.get('metadata', {})
+        step = CHUNK_SIZE - CHUNK_OVERLAP
+        return [
+            {
+                'content': chunk,
+                'metadata': {**metadata, 'chunk_index': i, 'char_start': min(i * step, len(text) - len(chunk))}
+            }
+            for i, chunk in enumerate(self._chunk_text(text))
+        ]
+    
+    def add_embedded_chunks(self, chunks: List[Dict[str, Any]], embeddings: np.ndarray):
+        """Add already-embedded chunks to the FAISS index and documents list."""
+        with self._index_lock, span('faiss.add', chunks=len(chunks)):
+            try:
+                self.index.add(embeddings)
+            except Exception as e:
+                logger.error("Error adding to FAISS index", chunks=len(chunks), error=str(e))
+                raise
             self.documents.extend(chunks)
-            print(f"Documents list updated, new total: {len(self.documents)}")
-        except Exception as e:
-            print(f"Error updating documents list: {str(e)}")
-            raise
+            total = len(self.documents)
+        logger.debug("Added chunks to FAISS index", chunks=len(chunks), total=total)
+    
+    def add_documents(self, documents: Iterable[Dict[str, Any]], persist: bool = True):
+        """
+        Add new documents to the vector database.
+        
+        Documents are streamed through the ingestion pipeline, so chunking,
+        embedding and indexing overlap and the documents may be any iterable.
+        
+        Args:
+            documents: Documents with 'content' and 'metadata' keys
+            persist: Whether to write the index to disk afterwards. Bulk callers
+                disable this and call save_vector_db() at their own checkpoints.
+        """
+        stats = IngestPipeline(self).run(documents)
+        logger.info("Indexed documents", documents=stats['documents'], chunks=stats['chunks'],
+                    seconds=round(stats['elapsed_seconds'], 2))
+        
+        if not persist:
+            return
         
         # Save updated index and documents
-        print("\nSaving updated index and documents...")
         try:
-            print(f"Saving FAISS index to {vector_db_path}...")
-            index_path = os.path.join(vector_db_path, "index.faiss")
-            documents_path = os.path.join(vector_db_path, "documents.npy")
-            
-            faiss.write_index(self.index, index_path)
-            print(f"Saving documents to {vector_db_path}...")
-            np.save(documents_path, np.array(self.documents))
-            print("Successfully saved all updates")
-        except Exception as e:
-            print(f"Error saving updates: {str(e)}")
-            print(f"Exception type: {type(e).__name__}")
-            print(f"Exception traceback: {traceback.format_exc()}")
+            self.save_vector_db()
+        except Exception:
+            logger.exception("Error saving the vector DB", path=self.vector_db_path)
             raise
     
+    def _search(self, query_embedding: np.ndarray, top_k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """
+        Search the base and delta indexes together.
+        
+        Returns:
+            Up to top_k (distance, document) pairs from both indexes, closest first
+        """
+        query = query_embedding.reshape(1, -1).astype('float32')
+        candidates = []
+        
+        if self.base_index and self.base_index.ntotal > 0:
+            with span('faiss.search', index='base', top_k=top_k):
+                distances, indices = self.base_index.search(query, top_k)
+            for dist, idx in zip(distances[0], indices[0]):
+                if idx >= 0:
+                    candidates.append((float(dist), self.base_index.get_document(int(idx))))
+        
+        with self._index_lock, span('faiss.search', index='delta', top_k=top_k):
+            if self.index.ntotal > 0:
+                distances, indices = self.index.search(query, top_k)
+            else:
+                distances, indices = np.empty((1, 0)), np.empty((1, 0), dtype=np.int64)
+        for dist, idx in zip(distances[0], indices[0]):
+            if 0 <= idx < len(self.documents):  # Safety check
+                candidates.append((float(dist), self.documents[idx]))
+            elif idx >= 0:
+                logger.warning("FAISS index out of bounds of the documents", index=int(idx),
+                               documents=len(self.documents))
+        
+        candidates.sort(key=lambda candidate: candidate[0])
+        return candidates[:top_k]
+    
     def retrieve(self, query: str, top_k: int = TOP_K_RESULTS) -> List[Dict[str, Any]]:
         """Retrieve most relevant documents for a query."""
         # Get query embedding
-        query_embedding = self.get_embeddings([query])[0]
+        query_embedding = self.embed_query(query)
         
-        # Search in FAISS
-        distances, indices = self.index.search(
-            query_embedding.reshape(1, -1),
-            top_k
-        )
-        
-        # Enhanced logging for similarity scores
-        print(f"Retrieved {len(indices[0])} potential documents for query")
-        if len(indices[0]) > 0:
-            print(f"Similarity scores (lower is better): {distances[0]}")
-            print(f"Current similarity threshold: {SIMILARITY_THRESHOLD}")
+        # Search the base and delta indexes
+        candidates = self._search(query_embedding, top_k)
         
         # Filter by similarity threshold and return relevant documents
         results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx < len(self.documents):  # Safety check
-                if dist < SIMILARITY_THRESHOLD:
-                    results.append(self.documents[idx])
-                    print(f"Including document with score {dist:.4f}: {self.documents[idx].get('metadata', {}).get('title', 'Untitled')[:50]}...")
-                else:
-                    print(f"Excluding document with score {dist:.4f} (above threshold): {self.documents[idx].get('metadata', {}).get('title', 'Untitled')[:50]}...")
-            else:
-                print(f"Warning: Index {idx} out of bounds for documents array of length {len(self.documents)}")
+        for dist, doc in candidates:
+            included = dist < SIMILARITY_THRESHOLD
+            if included:
+                results.append(doc)
+            logger.sampled(logging.DEBUG, 'retrieve.document', "Scored document", score=round(dist, 4),
+                           included=included, title=doc.get('metadata', {}).get('title', 'Untitled')[:50])
         
-        print(f"Final result: {len(results)} documents passed the similarity threshold")
+        logger.debug("Retrieved documents", candidates=len(candidates), passed=len(results),
+                     threshold=SIMILARITY_THRESHOLD,
+                     scores=[round(dist, 4) for dist, _ in candidates] if logger.is_enabled(logging.DEBUG) else None)
         return results
     
     def retrieve_with_fallback(self, query: str, depth: int) -> List[Dict[str, Any]]:
         """Retrieve documents with fallback mechanism if no results are found."""
-        print(f"  Retrieving relevant documents for question at depth {depth}...")
         relevant_docs = self.retrieve(query)
-        print(f"  Retrieved {len(relevant_docs)} relevant documents.")
         
         # First fallback: If no sources found, try with a higher threshold
         if len(relevant_docs) == 0:
-            print(f"  No sources found with standard threshold. Trying first fallback retrieval...")
             # Temporarily increase the threshold by 100% (double) for this query only
             fallback_threshold = SIMILARITY_THRESHOLD * 2.0
-            print(f"  Using fallback threshold: {fallback_threshold:.4f}")
             
-            # Search in FAISS with the same query embedding but higher threshold
-            query_embedding = self.get_embeddings([query])[0]
-            distances, indices = self.index.search(
-                query_embedding.reshape(1, -1),
-                TOP_K_RESULTS
-            )
+            # Search with the same query embedding but higher threshold
+            query_embedding = self.embed_query(query)
+            candidates = self._search(query_embedding, TOP_K_RESULTS)
             
             # Filter with higher threshold
-            for dist, idx in zip(distances[0], indices[0]):
-                if idx < len(self.documents) and dist < fallback_threshold:
-                    relevant_docs.append(self.documents[idx])
-                    print(f"  Fallback 1: Including document with score {dist:.4f}")
-            
-            print(f"  First fallback retrieval found {len(relevant_docs)} documents")
+            for dist, doc in candidates:
+                if dist < fallback_threshold:
+                    relevant_docs.append(doc)
             
             # Second fallback: If still no sources found, just take the top 2 closest documents
-            if len(relevant_docs) == 0 and len(indices[0]) > 0:
-                print(f"  Still no sources found. Using second fallback: taking top 2 closest documents regardless of threshold.")
+            if len(relevant_docs) == 0 and len(candidates) > 0:
                 # Take at most 2 documents to avoid too much irrelevant content
-                for i in range(min(2, len(indices[0]))):
-                    idx = indices[0][i]
-                    dist = distances[0][i]
-                    if idx < len(self.documents):
-                        relevant_docs.append(self.documents[idx])
-                        print(f"  Fallback 2: Including document with score {dist:.4f} (above threshold but closest available)")
-                
-                print(f"  Second fallback retrieval found {len(relevant_docs)} documents")
+                relevant_docs.extend(doc for _, doc in candidates[:2])
+                logger.info("No documents within the fallback threshold; using the closest", depth=depth,
+                            documents=len(relevant_docs), fallback_threshold=round(fallback_threshold, 4))
+            else:
+                logger.info("No documents within the threshold; retrieved with the fallback threshold",
+                            depth=depth, documents=len(relevant_docs),
+                            fallback_threshold=round(fallback_threshold, 4))
         
         return relevant_docs
     
     def _chunk_text(self, text: str) -> List[str]:
         """Split text into overlapping chunks."""
-        print(f"\nChunking text of length {len(text)} with chunk size {CHUNK_SIZE} and overlap {CHUNK_OVERLAP}")
-        
         if not text:
-            print("Warning: Empty text provided to _chunk_text")
+            logger.warning("Empty text provided to _chunk_text")
             return []
             
         chunks = []
@@ -483,43 +734,109 @@ Your responses should contain ONLY the sub-questions, one per line, with no addi
             while start < len(text):
                 iteration += 1
                 if iteration > max_iterations:
-                    print(f"Warning: Maximum iterations ({max_iterations}) reached. Breaking loop.")
+                    # The overlap keeps the last chunk's start before the end of the text, so this is
+                    # how most texts finish
+                    logger.sampled(logging.DEBUG, 'chunk.max_iterations', "Maximum chunking iterations reached",
+                                   max_iterations=max_iterations, text_length=len(text))
                     break
-                    
-                print(f"Iteration {iteration}: Processing chunk starting at position {start}")
                 
                 end = start + CHUNK_SIZE
                 if end > len(text):
                     end = len(text)
                     
-                chunk = text[start:end]
-                chunk_len = len(chunk)
-                print(f"Created chunk of length {chunk_len}")
-                
-                chunks.append(chunk)
+                chunks.append(text[start:end])
                 start = end - CHUNK_OVERLAP
                 
-                print(f"Next start position: {start}")
-                
-            print(f"Chunking completed. Created {len(chunks)} chunks.")
+            logger.debug("Chunked text", text_length=len(text), chunks=len(chunks), chunk_size=CHUNK_SIZE,
+                         overlap=CHUNK_OVERLAP)
             return chunks
             
         except Exception as e:
-            print(f"Error in _chunk_text: {str(e)}")
+            logger.error("Error in _chunk_text", error=str(e), chunks=len(chunks))
             return chunks  # Return any chunks we managed to create
     
     def generate_sub_questions(self, question: str, client, brave_api_key: str) -> List[str]:
         """Generate sub-questions for a given question using RAG with dynamic knowledge base."""
+        return self.search_and_plan(question, client, brave_api_key)['sub_questions']
+    
+    def search_and_plan(self, question: str, client, brave_api_key: str) -> Dict[str, Any]:
+        """
+        Populate the knowledge base for a question, then plan it from the retrieved context.
+        
+        Returns:
+            The plan from plan_question
+        """
         # First, populate knowledge base with relevant content
         self.kb_manager.populate_from_brave_search(question, brave_api_key, num_results=3)
+        return self.plan_from_context(question, client)
+    
+    def plan_from_context(self, question: str, client, complexity: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Retrieve the context for a question from the populated knowledge base and plan it from that.
         
-        # Now retrieve relevant documents and generate sub-questions
+        complexity, if already rated, is passed to plan_question.
+        """
         relevant_docs = self.retrieve(question)
-        context = "\n\n".join([doc['content'] for doc in relevant_docs])
+        context = assemble_context(relevant_docs)
+        return self.plan_question(question, context, client, complexity=complexity)
+    
+    def plan_question(self, question: str, context: Optional[str], client,
+                      complexity: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Rate a question's complexity, pick its answer style and generate its
+        sub-questions with a single structured Claude call.
         
-        # First, assess the complexity of the question
-        system_message_complexity = self.system_message_complexity
+        Falls back to separate complexity and sub-question calls if the planner
+        response is not valid JSON matching PLAN_SCHEMA.
         
+        Args:
+            question: The question to plan
+            context: Retrieved context for the question, or None to plan from the
+                question alone
+            client: Anthropic client
+            complexity: The question's complexity (1-5) if it was already rated
+                with assess_complexity; the planner then only picks the answer
+                style and the sub-questions
+            
+        Returns:
+            Dict with 'complexity' (1-5), 'answer_style' ('simple', 'comprehensive',
+            or None from the fallback) and 'sub_questions'
+        """
+        prompt = f"""Context from knowledge base:
+{context}
+
+Main question: {question}""" if context is not None else f"Main question: {question}"
+        instructions = self.planner_system_message
+        if complexity is not None:
+            prompt += f"\n\nComplexity level: {complexity}"
+            instructions = self.rated_planner_system_message
+
+        try:
+            message = self.gateway.create_message(
+                client,
+                **self._route('planner'),
+                system=self._system(instructions, 'planner'),
+                messages=[
+                    {"role": "user", "content": prompt}
+                ]
+            )
+            plan = parse_plan(extract_content(message), complexity)
+        except PlanValidationError as e:
+            logger.warning("Invalid plan; falling back to separate planning calls", error=str(e))
+            return self._plan_with_separate_calls(question, context, client, complexity=complexity)
+        
+        logger.info("Planned question", complexity=plan['complexity'], answer_style=plan['answer_style'],
+                    sub_questions=len(plan['sub_questions']))
+        return plan
+    
+    def assess_complexity(self, question: str, client) -> int:
+        """
+        Rate a question's complexity from 1 to 5 with the classifier, from the question alone.
+        
+        Returns:
+            The complexity level, or 3 (moderate) if the call fails or its
+            response cannot be parsed
+        """
         complexity_prompt = f"""Question: {question}
 
 Analyze this question and determine its complexity level on a scale from 1 to 5:
@@ -543,84 +860,45 @@ Respond with ONLY ONE number from 1 to 5 representing the complexity level."""
 
         # Get complexity assessment
         try:
-            @retry_with_exponential_backoff(
-                initial_delay=2,
-                exponential_base=2,
-                jitter=True,
-                max_retries=5,
-                errors=(Exception,)
+            complexity_message = self.gateway.create_message(
+                client,
+                **self._route('classifier'),
+                system=self._system(self.system_message_complexity, 'classifier'),
+                messages=[
+                    {"role": "user", "content": complexity_prompt}
+                ]
             )
-            def assess_complexity_with_retry():
-                return client.messages.create(
-                    model=DEFAULT_MODEL,
-                    max_tokens=10,  # Very short response needed
-                    temperature=0,
-                    system=system_message_complexity,
-                    messages=[
-                        {"role": "user", "content": complexity_prompt}
-                    ]
-                )
-            
-            # Call the function with retry logic
-            complexity_message = assess_complexity_with_retry()
             
             complexity = extract_content(complexity_message).strip().lower()
-            print(f"  Question complexity assessed as: {complexity}")
+            logger.debug("Assessed question complexity", complexity=complexity)
         except Exception as e:
-            print(f"ERROR during complexity assessment: {str(e)}. Using standard comprehensive prompt.")
-            # Fall back to standard comprehensive prompt
-            system_message_complexity = f"""You are a helpful research assistant that provides comprehensive, well-structured answers based on provided context.
-{self.comprehensive_format}"""
-
-            complexity_prompt = f"""Context:
-{context}
+            logger.error("Error during complexity assessment", error=str(e))
+            complexity = None
 
-Question: {question}
-
-Please provide a comprehensive answer to this question based on the provided context.
-
-Guidelines:
-1. Be thorough and well-structured
-2. Use appropriate HTML formatting for readability
-"""
-
-        # Determine number of sub-questions based on complexity
         try:
-            complexity_level = int(complexity.strip())
+            complexity_level = max(1, min(5, int(complexity.strip())))
         except (ValueError, AttributeError):
             # Default to moderate complexity if parsing fails
-            print("  Warning: Could not parse complexity level. Defaulting to moderate (3).")
+            logger.warning("Could not parse complexity level; defaulting to moderate (3)", complexity=complexity)
             complexity_level = 3
-        
-        # Map complexity levels to sub-question ranges
-        if complexity_level <= 1:
+        return complexity_level
+    
+    def _plan_with_separate_calls(self, question: str, context: Optional[str], client,
+                                  complexity: Optional[int] = None) -> Dict[str, Any]:
+        """Plan a question with one complexity call (unless complexity is given) and one sub-question call."""
+        # First, assess the complexity of the question
+        complexity_level = complexity if complexity is not None else self.assess_complexity(question, client)
+
+        # Determine number of sub-questions based on complexity
+        num_sub_questions = max_sub_questions_for(complexity_level)
+        if num_sub_questions == 0:
             # Very simple questions don't need sub-questions
-            print("  Very simple question (level 1) detected. No sub-questions needed.")
-            return []
-        elif complexity_level == 2:
-            # Simple questions get 2 sub-questions
-            num_sub_questions = "2"
-            print(f"  Simple question (level 2) detected. Generating {num_sub_questions} sub-questions.")
-        elif complexity_level == 3:
-            # Simple questions get 3 sub-questions
-            num_sub_questions = "3"
-            print(f"  Moderate question (level 3) detected. Generating {num_sub_questions} sub-questions.")
-        elif complexity_level == 4:
-            # Moderate questions get 4 sub-questions
-            num_sub_questions = "4"
-            print(f"  Complex question (level 4) detected. Generating {num_sub_questions} sub-questions.")
-        else:
-            # Complex questions get 5 sub-questions
-            num_sub_questions = "5"
-            print(f"  Very complex question (level 5) detected. Generating {num_sub_questions} sub-questions.")
+            return {'complexity': complexity_level, 'answer_style': None, 'sub_questions': []}
+        logger.debug("Generating sub-questions", complexity=complexity_level, sub_questions=num_sub_questions)
         
         # Now generate the appropriate number of sub-questions
-        system_message = self.sub_question_system_message
-        
-        prompt = f"""Context from knowledge base:
-{context}
-
-Main question: {question}
+        context_section = f"Context from knowledge base:\n{context}\n\n" if context is not None else ""
+        prompt = f"""{context_section}Main question: {question}
 
 Break this question down into {num_sub_questions} MUCH SIMPLER sub-questions. Each sub-question must be significantly less complex than the main question.
 
@@ -653,427 +931,470 @@ IMPORTANT:
 - Each sub-question MUST be significantly less complex than the original
 - Do not include any other text, numbering, or explanations"""
 
-        @retry_with_exponential_backoff(
-            initial_delay=2,
-            exponential_base=2,
-            jitter=True,
-            max_retries=5,
-            errors=(Exception,)
+        message = self.gateway.create_message(
+            client,
+            **self._route('planner'),
+            system=self._system(self.sub_question_system_message, 'planner'),
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
         )
-        def generate_sub_questions_with_retry():
-            return client.messages.create(
-                model=DEFAULT_MODEL,
-                max_tokens=DEFAULT_EVALUATION_MAX_TOKENS,
-                temperature=0,
-                system=system_message,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
-        
-        # Call the function with retry logic
-        message = generate_sub_questions_with_retry()
         
         # Extract sub-questions from response and clean up
         response = extract_content(message)
         sub_questions = [q.strip() for q in response.split('\n') if q.strip() and not q.lower().startswith(("here are", "question", "-", "•", "*", "1.", "2.", "3."))]
         
-        # Set maximum number of sub-questions based on complexity level
-        if complexity_level <= 2:
-            max_questions = 2
-        elif complexity_level == 3:
-            max_questions = 3
-        elif complexity_level == 4:
-            max_questions = 4
-        else:  # complexity_level >= 5
-            max_questions = 5
-            
-        return sub_questions[:max_questions]
+        return {
+            'complexity': complexity_level,
+            'answer_style': None,
+            'sub_questions': sub_questions[:num_sub_questions]
+        }
     
-    def generate_answer_with_tree(self, question: str, client, brave_api_key: str, depth: int = 0) -> Dict[str, Any]:
-        """Generate an answer with question tree structure using RAG with dynamic knowledge base."""
-        print(f"Generating tree node for question at depth {depth}: {question[:50]}...")
+    def generate_answer_with_tree(self, question: str, client, brave_api_key: str, depth: int = 0,
+                                  on_token: Optional[Callable[[str], None]] = None,
+                                  budget: Optional[ResearchBudget] = None,
+                                  on_node: Optional[Callable[[TreeNode], None]] = None,
+                                  deadline: Optional[Deadline] = None,
+                                  shape: Optional[TreeShape] = None,
+                                  parent: Optional[TreeNode] = None) -> TreeNode:
+        """
+        Generate an answer with question tree structure using RAG with dynamic knowledge base.
+        
+        Args:
+            question: The question for this node
+            client: Anthropic client
+            brave_api_key: Brave Search API key
+            depth: Depth of this node in the tree (ignored if parent is given)
+            on_token: If given, the root answer (the synthesis of the children's answers,
+                or the direct answer when there is no breakdown) is streamed to it.
+                Sub-question answers are never streamed.
+            budget: Token, cost and time budget shared by the whole tree. A new one
+                with the RESEARCH_BUDGET limits is created for the root if not given.
+            on_node: If given, called with every node of the tree (children before
+                their parent) as soon as it is complete, for progress reporting.
+            deadline: Hard deadline for the root's new budget (ignored if budget is
+                given). Nodes are not expanded, and sub-questions not started, when
+                they could not finish in time; the root is then marked 'timed_out'.
+            shape: Depth, breadth and recursion threshold of the tree (see
+                tree_shape.py). The default shape is used if not given.
+            parent: The node this one is a sub-question of. It is not attached to
+                the parent here; the parent attaches it once it is complete.
+                
+        Returns:
+            The node (see tree_model.py), with the spend of its own Claude calls in
+            'spend'. The root also carries the request's budget summary in 'budget'.
+            node.tree holds the tree's node count, depth and sources, and
+            TreeNode.to_dict serializes it.
+        """
+        if budget is None:
+            budget = ResearchBudget(deadline=deadline)
+        if shape is None:
+            shape = TreeShape()
+        
+        node = TreeNode(question, parent.depth + 1 if parent else depth, parent=parent)
+        with budget.track(node.id), log_context(node_id=node.id, depth=node.depth), \
+                span('tree.node', node_id=node.id, depth=node.depth):
+            self._generate_tree_node(node, client, brave_api_key, on_token, budget, on_node, shape)
+            annotate(children=len(node.children))
+        
+        node.spend = budget.node_spend(node.id)
+        if parent is None:
+            node.timed_out = budget.timed_out
+            node.budget = budget.summary()
+            logger.info("Research budget", budget=node.budget)
+        if on_node:
+            on_node(node)
+        return node
+    
+    def _generate_tree_node(self, node: TreeNode, client, brave_api_key: str,
+                            on_token: Optional[Callable[[str], None]], budget: ResearchBudget,
+                            on_node: Optional[Callable[[TreeNode], None]], shape: TreeShape):
+        """Build one node of the question tree, in place (see generate_answer_with_tree)."""
+        question, depth = node.question, node.depth
+        logger.info("Generating tree node", question=question[:50])
         
         start_time = time.time()
         
         try:
-            # Create node for current question
-            node = {
-                'id': str(uuid.uuid4()),
-                'question': question,
-                'depth': depth,
-                'children': []
-            }
-            
-            # For deeper levels or if question is specific enough, don't generate sub-questions
-            if depth >= 2:
-                print(f"  Reached max depth ({depth}). Generating answer without breakdown.")
-                node['needs_breakdown'] = False
-                
-                try:
-                    # First retrieve relevant documents to get sources
-                    relevant_docs = self.retrieve_with_fallback(question, depth)
-                    
-                    sources = []
-                    for doc in relevant_docs:
-                        if 'metadata' in doc and 'source' in doc['metadata']:
-                            source_url = doc['metadata']['source']
-                            source_title = doc['metadata'].get('title', 'Untitled Source')
-                            sources.append({
-                                'url': source_url,
-                                'title': source_title
-                            })
-                    
-                    # If no sources found, add a placeholder source
-                    if not sources:
-                        print(f"  WARNING: No sources found for node at depth {depth}. Adding a placeholder source.")
-                        sources.append({
-                            'url': "https://example.com/no-sources-found",
-                            'title': "No specific sources found for this question"
-                        })
-                    
-                    # Deduplicate sources
-                    sources = deduplicate_sources(sources)
-                    print(f"  Found {len(sources)} unique sources for node at depth {depth}")
-                    
-                    # Add sources to the node
-                    node['sources'] = sources
-                except Exception as e:
-                    print(f"ERROR retrieving sources at depth {depth}: {str(e)}")
-                    node['sources_error'] = str(e)
-                
-                try:
-                    # Generate answer with sources - use concise mode for leaf nodes
-                    print(f"  Generating answer for leaf node at depth {depth}...")
-                    answer = self.generate_answer(question, client, brave_api_key, depth, concise=True)
-                    print(f"  Generated answer of length {len(answer)} characters.")
-                    node['answer'] = answer
-                except Exception as e:
-                    print(f"ERROR generating answer at depth {depth}: {str(e)}")
-                    node['answer_error'] = str(e)
-                    # Provide a fallback answer
-                    node['answer'] = f"Error generating answer: {str(e)}"
-                
-                return node
+            # At the shape's max depth, or once the budget or the time before the deadline runs low,
+            # don't generate sub-questions
+            if not shape.should_expand(depth) or not budget.can_expand() or not budget.deadline_allows(depth, nodes=2):
+                if not shape.should_expand(depth):
+                    logger.debug("Reached max depth; answering without breakdown")
+                elif not budget.can_expand():
+                    logger.info("Research budget low; collapsing subtree into a leaf answer")
+                    budget.record_collapse()
+                    node.budget_limited = True
+                else:
+                    logger.info("Deadline near; collapsing subtree into a leaf answer")
+                    budget.record_collapse()
+                    budget.record_timeout()
+                    node.timed_out = True
+                self._answer_as_leaf(node, client, brave_api_key, on_token)
+                return
             
             try:
                 # Generate sub-questions using dynamic knowledge base
-                print(f"  Generating sub-questions for depth {depth}...")
-                sub_questions = self.generate_sub_questions(question, client, brave_api_key)
-                print(f"  Generated {len(sub_questions)} sub-questions.")
+                plan = self.node_executor.plan_node(question, client, brave_api_key)
+                sub_questions = shape.limit_sub_questions(plan['complexity'], plan['sub_questions'])
+                answer_style = plan['answer_style']
+                node.complexity = plan['complexity']
+                logger.debug("Generated sub-questions", generated=len(plan['sub_questions']),
+                             kept=len(sub_questions))
+                
+                # Only expand into as many children as the budget can still pay for
+                affordable = budget.affordable_children(len(sub_questions))
+                if affordable < len(sub_questions):
+                    logger.info("Research budget limits the sub-questions", affordable=affordable,
+                                sub_questions=len(sub_questions))
+                    sub_questions = sub_questions[:affordable]
+                    node.budget_limited = True
             except Exception as e:
-                print(f"ERROR generating sub-questions at depth {depth}: {str(e)}")
                 # If we can't generate sub-questions, treat as leaf node
-                node['needs_breakdown'] = False
-                node['sub_questions_error'] = str(e)
-                
-                try:
-                    # First retrieve relevant documents to get sources
-                    relevant_docs = self.retrieve_with_fallback(question, depth)
-                    
-                    sources = []
-                    for doc in relevant_docs:
-                        if 'metadata' in doc and 'source' in doc['metadata']:
-                            source_url = doc['metadata']['source']
-                            source_title = doc['metadata'].get('title', 'Untitled Source')
-                            sources.append({
-                                'url': source_url,
-                                'title': source_title
-                            })
-                    
-                    # If no sources found, add a placeholder source
-                    if not sources:
-                        print(f"  WARNING: No sources found for node at depth {depth}. Adding a placeholder source.")
-                        sources.append({
-                            'url': "https://example.com/no-sources-found",
-                            'title': "No specific sources found for this question"
-                        })
-                    
-                    # Deduplicate sources
-                    sources = deduplicate_sources(sources)
-                    print(f"  Found {len(sources)} unique sources for node at depth {depth}")
-                    
-                    # Add sources to the node
-                    node['sources'] = sources
-                except Exception as e:
-                    print(f"ERROR retrieving sources at depth {depth}: {str(e)}")
-                    node['sources_error'] = str(e)
-                
-                try:
-                    # Generate answer with sources - use concise mode for leaf nodes
-                    print(f"  Generating answer for node with insufficient sub-questions at depth {depth}...")
-                    answer = self.generate_answer(question, client, brave_api_key, depth, concise=True)
-                    print(f"  Generated answer of length {len(answer)} characters.")
-                    node['answer'] = answer
-                except Exception as e:
-                    print(f"ERROR generating answer at depth {depth}: {str(e)}")
-                    node['answer_error'] = str(e)
-                    node['answer'] = f"Error generating answer: {str(e)}"
-                
-                return node
+                logger.error("Error generating sub-questions", error=str(e))
+                node.sub_questions_error = str(e)
+                self._answer_as_leaf(node, client, brave_api_key, on_token)
+                return
             
             if len(sub_questions) <= 0:
                 # For simple questions that don't need breakdown
-                print(f"  Simple question detected. No breakdown needed.")
-                node['needs_breakdown'] = False
-                
-                try:
-                    # First retrieve relevant documents to get sources
-                    relevant_docs = self.retrieve_with_fallback(question, depth)
-                    
-                    sources = []
-                    for doc in relevant_docs:
-                        if 'metadata' in doc and 'source' in doc['metadata']:
-                            source_url = doc['metadata']['source']
-                            source_title = doc['metadata'].get('title', 'Untitled Source')
-                            sources.append({
-                                'url': source_url,
-                                'title': source_title
-                            })
-                    
-                    # If no sources found, add a placeholder source
-                    if not sources:
-                        print(f"  WARNING: No sources found for node at depth {depth}. Adding a placeholder source.")
-                        sources.append({
-                            'url': "https://example.com/no-sources-found",
-                            'title': "No specific sources found for this question"
-                        })
-                    
-                    # Deduplicate sources
-                    sources = deduplicate_sources(sources)
-                    print(f"  Found {len(sources)} unique sources for node at depth {depth}")
-                    
-                    # Add sources to the node
-                    node['sources'] = sources
-                except Exception as e:
-                    print(f"ERROR retrieving sources at depth {depth}: {str(e)}")
-                    node['sources_error'] = str(e)
-                
-                try:
-                    # Generate answer with sources - use concise mode for leaf nodes
-                    print(f"  Generating direct answer for simple question at depth {depth}...")
-                    answer = self.generate_answer(question, client, brave_api_key, depth, concise=False)
-                    print(f"  Generated answer of length {len(answer)} characters.")
-                    node['answer'] = answer
-                except Exception as e:
-                    print(f"ERROR generating answer at depth {depth}: {str(e)}")
-                    node['answer_error'] = str(e)
-                    node['answer'] = f"Error generating answer: {str(e)}"
-                
-                return node
+                logger.debug("Simple question; no breakdown needed")
+                self._answer_as_leaf(node, client, brave_api_key, on_token, concise=False, answer_style=answer_style)
             elif len(sub_questions) <= 1:
                 # If no meaningful breakdown, treat as leaf node
-                print(f"  Insufficient sub-questions ({len(sub_questions)}). Treating as leaf node.")
-                node['needs_breakdown'] = False
-                
-                try:
-                    # First retrieve relevant documents to get sources
-                    relevant_docs = self.retrieve_with_fallback(question, depth)
-                    
-                    sources = []
-                    for doc in relevant_docs:
-                        if 'metadata' in doc and 'source' in doc['metadata']:
-                            source_url = doc['metadata']['source']
-                            source_title = doc['metadata'].get('title', 'Untitled Source')
-                            sources.append({
-                                'url': source_url,
-                                'title': source_title
-                            })
-                    
-                    # If no sources found, add a placeholder source
-                    if not sources:
-                        print(f"  WARNING: No sources found for node at depth {depth}. Adding a placeholder source.")
-                        sources.append({
-                            'url': "https://example.com/no-sources-found",
-                            'title': "No specific sources found for this question"
-                        })
-                    
-                    # Deduplicate sources
-                    sources = deduplicate_sources(sources)
-                    print(f"  Found {len(sources)} unique sources for node at depth {depth}")
-                    
-                    # Add sources to the node
-                    node['sources'] = sources
-                except Exception as e:
-                    print(f"ERROR retrieving sources at depth {depth}: {str(e)}")
-                    node['sources_error'] = str(e)
-                
-                try:
-                    # Generate answer with sources - use concise mode for leaf nodes
-                    print(f"  Generating answer for node with insufficient sub-questions at depth {depth}...")
-                    answer = self.generate_answer(question, client, brave_api_key, depth, concise=True)
-                    print(f"  Generated answer of length {len(answer)} characters.")
-                    node['answer'] = answer
-                except Exception as e:
-                    print(f"ERROR generating answer at depth {depth}: {str(e)}")
-                    node['answer_error'] = str(e)
-                    node['answer'] = f"Error generating answer: {str(e)}"
+                logger.debug("Insufficient sub-questions; treating as a leaf node", sub_questions=len(sub_questions))
+                self._answer_as_leaf(node, client, brave_api_key, on_token)
             else:
                 # Process sub-questions recursively
-                print(f"  Processing {len(sub_questions)} sub-questions recursively.")
-                node['needs_breakdown'] = True
+                logger.debug("Processing sub-questions recursively", sub_questions=len(sub_questions))
+                node.needs_breakdown = True
                 
                 for i, sub_q in enumerate(sub_questions):
+                    # Leave the rest unanswered if they would not leave time for the syntheses above
+                    if not budget.deadline_allows(depth):
+                        logger.info("Deadline near; skipping the remaining sub-questions",
+                                    skipped=len(sub_questions) - i)
+                        node.skipped_sub_questions = sub_questions[i:]
+                        node.timed_out = True
+                        budget.record_timeout()
+                        break
                     try:
-                        print(f"  Processing sub-question {i+1}/{len(sub_questions)} at depth {depth+1}")
-                        # Ensure consistent depth by explicitly passing the expected depth
-                        sub_node = self.generate_answer_with_tree(sub_q, client, brave_api_key, depth + 1)
-                        
-                        # Validate and fix sub-node structure if needed
-                        if 'depth' not in sub_node or sub_node['depth'] != depth + 1:
-                            print(f"WARNING: Sub-node has incorrect depth. Expected {depth+1}, got {sub_node.get('depth')}. Fixing.")
-                            sub_node['depth'] = depth + 1
-                        
-                        sub_node['parent_question'] = question
-                        node['children'].append(sub_node)
+                        node.add_child(self.generate_answer_with_tree(sub_q, client, brave_api_key, budget=budget,
+                                                                      on_node=on_node, shape=shape, parent=node))
                     except Exception as e:
-                        print(f"ERROR processing sub-question {i+1} at depth {depth+1}: {str(e)}")
-                        # Create an error node
-                        error_node = {
-                            'id': str(uuid.uuid4()),
-                            'question': sub_q,
-                            'depth': depth + 1,
-                            'error': str(e),
-                            'parent_question': question,
-                            'answer': f"Error processing this question: {str(e)}",
-                            'children': [],  # Add empty children list
-                            'needs_breakdown': False  # Mark as not needing breakdown
-                        }
-                        node['children'].append(error_node)
+                        logger.error("Error processing sub-question", sub_question=i + 1, error=str(e))
+                        # Attach an error node in its place
+                        error_node = TreeNode(sub_q, depth + 1, parent=node)
+                        error_node.error = str(e)
+                        error_node.answer = f"Error processing this question: {str(e)}"
+                        error_node.needs_breakdown = False
+                        node.add_child(error_node)
                 
                 # Generate a summary answer for the parent node
                 try:
-                    print(f"  Generating summary answer for parent node at depth {depth}...")
-                    # Check if we have any successful child nodes with answers
-                    has_successful_children = any('answer' in child and not child.get('answer', '').startswith('Error') 
-                                                for child in node['children'])
-                    
-                    if has_successful_children:
-                        # Generate a summary based on child answers
-                        child_answers = [f"Q: {child['question']}\nA: {child.get('answer', 'No answer')}" 
-                                        for child in node['children'] if 'answer' in child]
-                        
-                        # Use the generate_answer method to create a summary
-                        summary_prompt = f"Based on the following information about {question}, provide a comprehensive summary:\n\n"
-                        summary_prompt += "\n\n".join(child_answers)
-                        
-                        answer = self.generate_answer(summary_prompt, client, brave_api_key, depth, concise=False)
-                        node['answer'] = answer
+                    if any(child.has_usable_answer() for child in node.children):
+                        # Synthesize the children's answers directly, without another retrieval
+                        node.answer = self.synthesize_answer(question, node.children, client, depth,
+                                                             answer_style=answer_style, on_token=on_token)
                     else:
                         # If all children failed, generate a direct answer
-                        print("  All child nodes failed. Generating direct answer.")
-                        answer = self.generate_answer(question, client, brave_api_key, depth, concise=False)
-                        node['answer'] = answer
+                        logger.warning("All child nodes failed; generating a direct answer")
+                        node.answer = self.generate_answer(question, client, brave_api_key, depth, concise=False,
+                                                           answer_style=answer_style, on_token=on_token)
+                except DeadlineExceeded as e:
+                    # No time for a synthesis: return the children's answers as they are
+                    logger.info("Deadline reached before the summary", error=str(e))
+                    node.answer = self._answer_from_children(node.children)
+                    node.timed_out = True
+                    budget.record_timeout()
                 except Exception as e:
-                    print(f"ERROR generating summary answer at depth {depth}: {str(e)}")
-                    node['answer_error'] = str(e)
+                    logger.error("Error generating summary answer", error=str(e))
+                    node.answer_error = str(e)
                     # Provide a fallback answer
-                    node['answer'] = f"Error generating summary: {str(e)}"
-            
-            # Final validation of node structure
-            print(f"Completed node at depth {depth} with {len(node.get('children', []))} children.")
+                    node.answer = f"Error generating summary: {str(e)}"
             
             # Ensure the node has an answer
-            if 'answer' not in node:
-                print(f"WARNING: Node at depth {depth} is missing an answer. Adding a placeholder.")
-                node['answer'] = "No answer was generated for this question."
+            if node.answer is None:
+                logger.warning("Node is missing an answer; adding a placeholder")
+                node.answer = "No answer was generated for this question."
             
-            processing_time = time.time() - start_time
-            print(f"Node at depth {depth} completed in {processing_time:.2f} seconds.")
-            
-            return node
+            logger.info("Completed tree node", children=len(node.children),
+                        seconds=round(time.time() - start_time, 2))
             
         except Exception as e:
-            print(f"CRITICAL ERROR in generate_answer_with_tree at depth {depth}: {str(e)}")
-            print(f"Exception traceback: {traceback.format_exc()}")
+            logger.exception("Critical error in generate_answer_with_tree", error=str(e))
             
-            # Return a minimal error node
-            error_node = {
-                'id': str(uuid.uuid4()),
-                'question': question,
-                'depth': depth,
-                'error': str(e),
-                'answer': f"Error processing this question: {str(e)}"
-            }
-            return error_node
+            # Leave a minimal error node
+            node.error = str(e)
+            node.answer = f"Error processing this question: {str(e)}"
     
-    def generate_answer(self, query: str, client, brave_api_key: str, depth: int = 0, concise: bool = False) -> str:
-        """Generate an answer using RAG with dynamic knowledge base."""
-        print(f"Generating answer for query at depth {depth}: {query[:50]}...")
+    def _answer_as_leaf(self, node: TreeNode, client, brave_api_key: str,
+                        on_token: Optional[Callable[[str], None]], concise: bool = True,
+                        answer_style: Optional[str] = None):
+        """Answer a node directly, without breaking it down: its sources, then its answer."""
+        depth = node.depth
+        node.needs_breakdown = False
+        
+        try:
+            node.set_sources(self._retrieve_sources(node.question, depth))
+            logger.debug("Found sources", sources=len(node.sources))
+        except Exception as e:
+            logger.error("Error retrieving sources", error=str(e))
+            node.sources_error = str(e)
+        
+        try:
+            node.answer = self.generate_answer(node.question, client, brave_api_key, depth, concise=concise,
+                                               answer_style=answer_style, on_token=on_token)
+        except Exception as e:
+            logger.error("Error generating answer", error=str(e))
+            node.answer_error = str(e)
+            # Provide a fallback answer
+            node.answer = f"Error generating answer: {str(e)}"
+    
+    def _retrieve_sources(self, question: str, depth: int) -> List[Source]:
+        """Return the unique sources of the documents retrieved for a question (a placeholder if there are none)."""
+        sources = {}
+        for doc in self.retrieve_with_fallback(question, depth):
+            metadata = doc.get('metadata', {})
+            url = metadata.get('source')
+            if url and url not in sources:
+                sources[url] = Source(url, metadata.get('title', 'Untitled Source'))
+        
+        if not sources:
+            logger.warning("No sources found; adding a placeholder source")
+            return [Source("https://example.com/no-sources-found", "No specific sources found for this question")]
+        return list(sources.values())
+    
+    @staticmethod
+    def _answer_from_children(children: List[TreeNode]) -> str:
+        """Combine child answers into a parent answer without a Claude call (used past the deadline)."""
+        sections = [
+            f"<h3>{child.question}</h3>\n{child.answer}"
+            for child in children
+            if child.answer and not child.answer.startswith('Error')
+        ]
+        if not sections:
+            return "<p class=\"body-text\">The research could not be completed in time.</p>"
+        return "\n".join(sections)
+    
+    def synthesize_answer(self, question: str, children: List[TreeNode], client, depth: int,
+                          answer_style: Optional[str] = None,
+                          on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Answer a parent question from its children's answers.
+        
+        Unlike generate_answer, no retrieval or web search is done: the
+        children's answers are the context. Each is compacted into plain-text
+        notes of at most SYNTHESIS_NOTE_MAX_TOKENS. While the notes exceed
+        SYNTHESIS_MAX_INPUT_TOKENS they are condensed map-reduce style, in
+        groups of SYNTHESIS_GROUP_TOKENS with one fast-model call per group,
+        for at most SYNTHESIS_MAX_LEVELS rounds, so the final prompt stays
+        bounded however many children there are.
         
+        Args:
+            question: The parent question
+            children: The parent's child nodes
+            client: Anthropic client
+            depth: Depth of the parent in the tree
+            answer_style: 'simple' or 'comprehensive' from the parent's plan
+            on_token: Streams the final answer's deltas, as in generate_answer
+        """
+        start_time = time.time()
+        
+        notes = child_notes(children, SYNTHESIS_NOTE_MAX_TOKENS)
+        logger.info("Synthesizing answer from child answers", children=len(children), notes=len(notes),
+                    notes_tokens=notes_tokens(notes))
+        
+        level = 0
+        while notes_tokens(notes) > SYNTHESIS_MAX_INPUT_TOKENS and level < SYNTHESIS_MAX_LEVELS:
+            groups = group_notes(notes, SYNTHESIS_GROUP_TOKENS)
+            if len(groups) == len(notes):
+                # Nothing left to combine; condensing again would not shrink the notes
+                break
+            level += 1
+            notes = [self._condense_notes(question, group, client) for group in groups]
+            logger.info("Condensed synthesis notes", level=level, groups=len(groups), notes_tokens=notes_tokens(notes))
+        
+        context = "\n\n".join(notes)
+        if estimate_tokens(context) > SYNTHESIS_MAX_INPUT_TOKENS:
+            context = truncate_notes(context.split('\n'), SYNTHESIS_MAX_INPUT_TOKENS)
+        
+        try:
+            return self._answer_from_context(question, context, client, depth, False, answer_style,
+                                             on_token, start_time)
+        except DeadlineExceeded:
+            # Callers degrade the tree instead of reporting an error
+            raise
+        except Exception as e:
+            logger.exception("Critical error in synthesize_answer", error=str(e))
+            raise ValueError(f"Failed to synthesize answer: {str(e)}")
+    
+    def _condense_notes(self, question: str, notes: List[str], client) -> str:
+        """Condense one group of notes with a fast-model call (the map step of synthesize_answer)."""
+        joined = "\n\n".join(notes)
+        try:
+            response = self.gateway.create_message(
+                client,
+                **self._route('synthesis_map'),
+                system=self._system(self.synthesis_map_instructions, 'synthesis_map'),
+                messages=[
+                    {"role": "user", "content": f"Question: {question}\n\nNotes:\n{joined}"}
+                ]
+            )
+            return extract_content(response).strip()
+        except Exception as e:
+            # Keep the group, cut down to what a condensed group would have been
+            logger.error("Error condensing notes; truncating the group instead", error=str(e))
+            return truncate_notes(joined.split('\n'), MODEL_ROUTES['synthesis_map']['max_tokens'])
+    
+    def generate_answer(self, query: str, client, brave_api_key: str, depth: int = 0, concise: bool = False,
+                        answer_style: str = None, on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Generate an answer using RAG with dynamic knowledge base.
+        
+        Args:
+            query: The question (or summary prompt) to answer
+            client: Anthropic client
+            brave_api_key: Brave Search API key, used if retrieval finds nothing
+            depth: Depth of the question in the tree
+            concise: Whether to produce a short, leaf-style answer
+            answer_style: 'simple' or 'comprehensive' from the question's plan. If
+                None at the root, the style is classified with a separate call.
+            on_token: If given, the answer is streamed and each text delta is passed
+                to it as it arrives. The returned answer is the final, cleaned-up HTML,
+                which may differ from the streamed text (e.g. a sources section the
+                model wrote is removed).
+        """
         start_time = time.time()
         
         try:
             # First, try to retrieve relevant documents from the existing knowledge base
-            print(f"  Retrieving documents from existing knowledge base...")
             relevant_docs = self.retrieve_with_fallback(query, depth)
-            print(f"  Retrieved {len(relevant_docs)} documents from existing knowledge base.")
             
-            # If not enough relevant documents, populate knowledge base with web search results
-            if len(relevant_docs) < 1:
-                print(f"  Insufficient documents ({len(relevant_docs)}). Performing web search...")
+            # If not enough relevant documents, populate knowledge base with web search results,
+            # unless the request's deadline leaves no time for it
+            budget = current_budget()
+            if len(relevant_docs) < 1 and budget and not budget.deadline_allows(depth):
+                logger.info("No documents retrieved, and too close to the deadline for a web search")
+            elif len(relevant_docs) < 1:
                 try:
-                    # Initialize knowledge base manager
-                    kb_manager = KnowledgeBaseManager(self)
-                    
                     # Populate knowledge base with web search results
-                    search_docs = kb_manager.populate_from_brave_search(query, brave_api_key)
-                    print(f"  Added {len(search_docs)} documents from web search.")
+                    search_docs = self.kb_manager.populate_from_brave_search(query, brave_api_key)
                     
                     # Retrieve again with the updated knowledge base
                     relevant_docs = self.retrieve_with_fallback(query, depth)
-                    print(f"  Retrieved {len(relevant_docs)} documents after knowledge base update.")
+                    logger.info("No documents retrieved; searched the web", search_documents=len(search_docs),
+                                documents=len(relevant_docs))
                 except Exception as e:
-                    print(f"ERROR during web search: {str(e)}")
-                    print(f"Exception type: {type(e).__name__}")
-                    print(f"Exception traceback: {traceback.format_exc()}")
+                    logger.exception("Error during web search", error=str(e))
                     # Continue with whatever documents we have
             
-            # Extract content from relevant documents
-            context = ""
-            sources = []
+            # Send only chunk text, merged, deduplicated and packed to the context budget
+            context = assemble_context(relevant_docs)
+            logger.debug("Prepared context", documents=len(relevant_docs), characters=len(context))
             
-            print(f"  Processing {len(relevant_docs)} relevant documents...")
-            for i, doc in enumerate(relevant_docs):
-                try:
-                    # Extract content and add to context
-                    content = extract_content(doc)
-                    if content:
-                        # Add source to context without numbered references
-                        context += f"\n\nSource Information:\n{content}"
-                        
-                        # Add source information
-                        if 'metadata' in doc:
-                            source_url = doc['metadata'].get('source', 'Unknown source')
-                            source_title = doc['metadata'].get('title', 'Untitled')
-                            sources.append({
-                                'url': source_url,
-                                'title': source_title
-                            })
-                except Exception as e:
-                    print(f"ERROR processing document {i}: {str(e)}")
+            return self._answer_from_context(query, context, client, depth, concise, answer_style,
+                                             on_token, start_time)
+                
+        except DeadlineExceeded:
+            # Callers degrade the tree instead of reporting an error
+            raise
+        except Exception as e:
+            logger.exception("Critical error in generate_answer", error=str(e))
+            raise ValueError(f"Failed to generate answer: {str(e)}")
+    
+    def _answer_from_context(self, query: str, context: str, client, depth: int, concise: bool,
+                             answer_style: Optional[str], on_token: Optional[Callable[[str], None]],
+                             start_time: float) -> str:
+        """Answer a question from an already assembled context (see generate_answer)."""
+        # Adjust token limit based on depth
+        # The root answer is the user-facing synthesis; everything below it is a leaf-style answer
+        route = self._route('root_synthesis' if depth == 0 else 'leaf_answer')
+        token_limit = min(route['max_tokens'], get_token_limit_for_depth(route['max_tokens'], depth))
+        # Shrink the answer to what the request's budget has left
+        budget = current_budget()
+        if budget:
+            token_limit = budget.max_tokens_for(token_limit)
+ 
+        # First, check if this is a simple question at depth 0 (root level)
+        # For simple questions at root level, we want a direct but comprehensive answer
+        if depth == 0 and not concise:
+            # Reuse the planner's answer style when the caller has one
+            if answer_style is None:
+                answer_style = self._classify_answer_style(query, client)
+            
+            # For simple questions, use a more direct approach
+            if answer_style == "simple":
+                logger.debug("Using the direct answer approach for a simple question")
+                system_message = self.simple_answer_instructions
+            else:
+                # Use standard comprehensive prompt for non-simple questions
+                system_message = self.comprehensive_answer_instructions
+        # Determine which prompt to use based on depth and conciseness for non-root questions
+        elif concise or depth >= 1:
+            # Use a more concise prompt for leaf nodes
+            system_message = self.concise_answer_instructions
+        else:
+            # Use a more comprehensive prompt for root node
+            system_message = self.comprehensive_answer_instructions
+        
+        # Static instructions are in the system prompt, so the per-question context comes last
+        prompt = f"""Context:
+{context}
+
+Question: {query}"""
+        
+        try:
+            # Generate answer using Anthropic Claude through the gateway
+            request = {
+                **route,
+                'max_tokens': token_limit,
+                'system': self._system(system_message, route['stage']),
+                'messages': [
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ]
+            }
+            if on_token:
+                # Stream deltas to the caller; the assembled answer is still cleaned up below
+                response = self.gateway.stream_message(client, on_token, **request)
+            else:
+                response = self.gateway.create_message(client, **request)
             
-            # If we still have no sources, create a placeholder source
-            if not sources:
-                print("  WARNING: No sources found. Adding a placeholder source.")
-                sources.append({
-                    'number': 1,
-                    'url': "https://example.com/no-sources-found",
-                    'title': "No specific sources found for this query"
-                })
+            answer = response.content[0].text
             
-            print(f"  Prepared context with {len(sources)} sources and {len(context)} characters.")
+            # Check if the answer already has a sources section and remove it
+            if "<h2>Sources</h2>" in answer or "<h3>Sources</h3>" in answer:
+                answer = self._remove_sources_section(answer)
             
-            # Adjust token limit based on depth
-            token_limit = get_token_limit_for_depth(DEFAULT_ANSWER_MAX_TOKENS, depth)
-     
-            # First, check if this is a simple question at depth 0 (root level)
-            # For simple questions at root level, we want a direct but comprehensive answer
-            if depth == 0 and not concise:
-                # Assess if this is a simple question
-                system_message_complexity = self.system_message_complexity
-                
-                complexity_prompt = f"""Question: {query}
+            # We're no longer adding the sources section at the bottom
+            # The sources are still tracked and available in the node data
+            # but we don't append them to the HTML output
+            
+            logger.debug("Generated answer", prompt_characters=len(prompt), answer_characters=len(answer),
+                         seconds=round(time.time() - start_time, 2))
+            
+            return answer
+            
+        except DeadlineExceeded:
+            # Callers degrade the tree instead of reporting an error
+            raise
+        except Exception as e:
+            logger.exception("Error during Claude API call", error=str(e))
+            raise ValueError(f"Failed to generate answer with Claude: {str(e)}")
+    
+    def _classify_answer_style(self, query: str, client) -> str:
+        """
+        Classify a question as 'simple' or 'comprehensive' with a separate Claude call.
+        
+        Only used when no plan is available; falls back to 'comprehensive' on errors.
+        """
+        # Assess if this is a simple question
+        system_message_complexity = self.system_message_complexity
+        
+        complexity_prompt = f"""Question: {query}
 
 Analyze this question and determine if it is 'simple' or 'complex'.
 
@@ -1092,162 +1413,23 @@ A 'complex' question:
 
 Respond with ONLY ONE of these two words: 'simple' or 'complex'."""
 
-                # Get complexity assessment
-                try:
-                    @retry_with_exponential_backoff(
-                        initial_delay=2,
-                        exponential_base=2,
-                        jitter=True,
-                        max_retries=5,
-                        errors=(Exception,)
-                    )
-                    def assess_complexity_with_retry():
-                        return client.messages.create(
-                            model=DEFAULT_MODEL,
-                            max_tokens=10,  # Very short response needed
-                            temperature=0,
-                            system=system_message_complexity,
-                            messages=[
-                                {"role": "user", "content": complexity_prompt}
-                            ]
-                        )
-                    
-                    # Call the function with retry logic
-                    complexity_message = assess_complexity_with_retry()
-                    
-                    complexity = extract_content(complexity_message).strip().lower()
-                    print(f"  Question complexity assessed as: {complexity}")
-                    
-                    # For simple questions, use a more direct approach
-                    if complexity == "simple":
-                        print("  Using direct answer approach for simple question.")
-                        system_message = f"""You are a helpful research assistant that provides clear, direct answers to simple questions.
-{self.simple_format}"""
-                        prompt = f"""Context:
-{context}
-
-Question: {query}
-
-Please provide a direct, clear answer to this simple question based on the provided context.
-
-Guidelines:
-1. Be direct and to the point
-2. Provide a complete answer
-3. Use appropriate HTML formatting for readability"""
-                    else:
-                        # Use standard comprehensive prompt for non-simple questions
-                        system_message = f"""You are a helpful research assistant that provides comprehensive, well-structured answers based on provided context.
-{self.comprehensive_format}"""
-                        prompt = f"""Context:
-{context}
-
-Question: {query}
-
-Please provide a comprehensive answer to this question based on the provided context.
-
-Guidelines:
-1. Be thorough and well-structured
-2. Use appropriate HTML formatting for readability"""
-                except Exception as e:
-                    print(f"ERROR during complexity assessment: {str(e)}. Using standard comprehensive prompt.")
-                    # Fall back to standard comprehensive prompt
-                    system_message = f"""You are a helpful research assistant that provides comprehensive, well-structured answers based on provided context.
-{self.comprehensive_format}"""
-                    prompt = f"""Context:
-{context}
-
-Question: {query}
-
-Please provide a comprehensive answer to this question based on the provided context.
-
-Guidelines:
-1. Be thorough and well-structured
-2. Use appropriate HTML formatting for readability"""
-            # Determine which prompt to use based on depth and conciseness for non-root questions
-            elif concise or depth >= 1:
-                # Use a more concise prompt for leaf nodes
-                system_message = f"""You are a helpful research assistant that provides concise, focused answers to specific questions.
-{self.simple_format}"""
-                prompt = f"""Context:
-{context}
-
-Question: {query}
-
-Please provide a VERY CONCISE answer to this specific question. Focus only on the most relevant information.
-
-Guidelines:
-1. Keep your answer brief and to the point
-2. Use bullet points and short paragraphs
-3. Include only the most essential information"""
-            else:
-                # Use a more comprehensive prompt for root node
-                system_message = f"""You are a helpful research assistant that provides comprehensive, well-structured answers based on provided context.
-{self.comprehensive_format}"""
-                prompt = f"""Context:
-{context}
-
-Question: {query}
-
-Please provide a comprehensive answer to this question based on the provided context.
-
-Guidelines:
-1. Be thorough and well-structured
-2. Use appropriate HTML formatting for readability"""
-            
-            print(f"  Sending request to Anthropic Claude with prompt length {len(prompt)} characters...")
+        # Get complexity assessment
+        try:
+            complexity_message = self.gateway.create_message(
+                client,
+                **self._route('classifier'),
+                system=self._system(system_message_complexity, 'classifier'),
+                messages=[
+                    {"role": "user", "content": complexity_prompt}
+                ]
+            )
             
-            try:
-                # Generate answer using Anthropic Claude with retry logic
-                @retry_with_exponential_backoff(
-                    initial_delay=2,
-                    exponential_base=2,
-                    jitter=True,
-                    max_retries=5,
-                    errors=(Exception,)
-                )
-                def call_anthropic_with_retry():
-                    return client.messages.create(
-                        model=DEFAULT_MODEL,
-                        max_tokens=token_limit,
-                        system=system_message,
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": prompt
-                            }
-                        ]
-                    )
-                
-                # Call the function with retry logic
-                response = call_anthropic_with_retry()
-                
-                answer = response.content[0].text
-                print(f"  Received answer from Claude with length {len(answer)} characters.")
-                
-                # Check if the answer already has a sources section and remove it
-                if "<h2>Sources</h2>" in answer or "<h3>Sources</h3>" in answer:
-                    print("  Answer contains a sources section. Removing it...")
-                    answer = self._remove_sources_section(answer)
-                
-                # We're no longer adding the sources section at the bottom
-                # The sources are still tracked and available in the node data
-                # but we don't append them to the HTML output
-                
-                processing_time = time.time() - start_time
-                print(f"Answer generation completed in {processing_time:.2f} seconds.")
-                
-                return answer
-                
-            except Exception as e:
-                print(f"ERROR during Claude API call: {str(e)}")
-                print(f"Exception type: {type(e).__name__}")
-                print(f"Exception traceback: {traceback.format_exc()}")
-                raise ValueError(f"Failed to generate answer with Claude: {str(e)}")
-                
+            complexity = extract_content(complexity_message).strip().lower()
+            logger.debug("Classified answer style", complexity=complexity)
+            return "simple" if complexity == "simple" else "comprehensive"
         except Exception as e:
-            print(f"CRITICAL ERROR in generate_answer: {str(e)}")
-            print(f"Exception traceback: {traceback.format_exc()}")
-            raise ValueError(f"Failed to generate answer: {str(e)}")
+            logger.error("Error during answer style classification; using the comprehensive prompt", error=str(e))
+            return "comprehensive"
     
     def _generate_sources_html(self, sources: List[Dict[str, str]]) -> str:
         """Generate HTML for the sources section."""
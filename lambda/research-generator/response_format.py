@@ -0,0 +1,163 @@
+"""
+Compact research responses.
+
+The full response body carries the root answer, the whole question tree
+(every node's HTML answer and sources) and the tree's sources three times
+over. Clients that don't need all of it can ask for less:
+
+- fields: a comma-separated selection of response sections (RESPONSE_FIELDS),
+  e.g. fields=summary for just the answer and metadata, or fields=tree
+- compact: sources are listed once, in all_sources, and referenced everywhere
+  else (the tree's nodes and sources_metadata) by their index in it
+
+Bodies are encoded with orjson when it is installed (the standard json module
+otherwise) and compressed with brotli or gzip when the client accepts it
+(see utils.build_response).
+"""
+import gzip
+import json
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from config import RESPONSE_COMPRESSION_MIN_BYTES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Selectable response sections and the response keys each one includes
+RESPONSE_FIELDS = {
+    'answer': ('explanation',),
+    'metadata': ('metadata', 'parameters_used'),
+    'summary': ('explanation', 'metadata', 'parameters_used'),
+    'tree': ('question_tree',),
+    'sources': ('all_sources', 'sources_metadata'),
+}
+
+
+def dumps(body: Any) -> bytes:
+    """Serialize a response body to compact UTF-8 JSON, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(body, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(body, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def parse_fields(fields: Union[str, Iterable[str], None]) -> Optional[List[str]]:
+    """
+    Parse a field selection (a comma-separated string or a list of names).
+
+    Returns:
+        The selected fields, or None for the full response
+
+    Raises:
+        ValueError: If a field is not in RESPONSE_FIELDS
+    """
+    if fields is None:
+        return None
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    selected = [str(field).strip().lower() for field in fields if str(field).strip()]
+    unknown = [field for field in selected if field not in RESPONSE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown response fields {unknown}; choose from {sorted(RESPONSE_FIELDS)}")
+    return selected or None
+
+
+def select_fields(response: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """Return only the response keys of the selected fields (the whole response if fields is None)."""
+    if fields is None:
+        return response
+    keys = {key for field in fields for key in RESPONSE_FIELDS[field]}
+    return {key: value for key, value in response.items() if key in keys}
+
+
+def index_sources(response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a copy of a response whose sources are referenced by index into all_sources.
+
+    Tree nodes' 'sources' become lists of indexes (sources missing from
+    all_sources are kept as they are), and sources_metadata's rankings
+    become lists of indexes too. The response is marked 'sources_by_index'.
+    """
+    all_sources = response.get('all_sources') or []
+    positions = {source.get('url'): i for i, source in enumerate(all_sources) if source.get('url')}
+
+    def reference(source):
+        return positions.get(source.get('url'), source) if isinstance(source, dict) else source
+
+    def compact_node(node):
+        node = dict(node)
+        if isinstance(node.get('sources'), list):
+            node['sources'] = [reference(source) for source in node['sources']]
+        if isinstance(node.get('children'), list):
+            node['children'] = [compact_node(child) for child in node['children']]
+        return node
+
+    compact = dict(response)
+    if isinstance(response.get('question_tree'), dict):
+        compact['question_tree'] = compact_node(response['question_tree'])
+    if isinstance(response.get('sources_metadata'), dict):
+        compact['sources_metadata'] = {
+            key: [reference(source) for source in value] if isinstance(value, list) else value
+            for key, value in response['sources_metadata'].items()
+        }
+    compact['sources_by_index'] = True
+    return compact
+
+
+def format_response(response: Dict[str, Any], fields: Optional[List[str]] = None,
+                    compact: bool = False) -> Dict[str, Any]:
+    """Apply a request's compact and fields options to a research response."""
+    if compact:
+        response = index_sources(response)
+    selected = select_fields(response, fields)
+    if compact and fields is not None:
+        # The indexes are meaningless without the list they refer to
+        if 'question_tree' in selected or 'sources_metadata' in selected:
+            selected['all_sources'] = response.get('all_sources', [])
+        selected['sources_by_index'] = True
+    return selected
+
+
+def accepted_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Return the best supported content encoding in an Accept-Encoding header ('br', 'gzip' or None)."""
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.partition(';')
+        params = params.replace(' ', '')
+        try:
+            quality = float(params[2:]) if params.startswith('q=') else 1.0
+        except ValueError:
+            quality = 1.0
+        if quality > 0:
+            accepted.add(name.strip())
+    if brotli is not None and ('br' in accepted or '*' in accepted):
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+
+def encode_body(body: Any, accept_encoding: Optional[str] = None) -> Tuple[bytes, Optional[str]]:
+    """
+    Serialize a response body and compress it if the client accepts it.
+
+    Bodies smaller than RESPONSE_COMPRESSION_MIN_BYTES are not compressed.
+
+    Returns:
+        (payload, encoding): encoding is 'br', 'gzip' or None (uncompressed)
+    """
+    payload = dumps(body)
+    encoding = accepted_encoding(accept_encoding) if len(payload) >= RESPONSE_COMPRESSION_MIN_BYTES else None
+    if encoding == 'br':
+        return brotli.compress(payload, quality=5), encoding
+    if encoding == 'gzip':
+        return gzip.compress(payload, compresslevel=6), encoding
+    return payload, None
@@ -0,0 +1,203 @@
+"""
+Cache of whole research results for repeated questions.
+
+Responses are cached under a key derived from the normalized question and
+the tree parameters that shaped the answer, so a change of models, budget or
+tree shape never serves a result built with other settings. Entries are:
+
+- fresh for RESULT_CACHE_TTL_SECONDS: served as they are
+- stale until RESULT_CACHE_STALE_SECONDS: served, while one caller refreshes
+  them in the background (stale-while-revalidate)
+- expired after that: treated as a miss
+
+Caches are chosen by URL with create_result_cache:
+
+    sqlite:///tmp/result_cache.db  a SQLite table (per container, local runs)
+    s3://bucket/prefix             one S3 object per entry (shared by all containers)
+"""
+import os
+import re
+import abc
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from config import (
+    RESULT_CACHE_URL, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_STALE_SECONDS, RESULT_CACHE_REFRESH_TIMEOUT
+)
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Bump to invalidate every entry when the response format changes
+RESULT_CACHE_VERSION = 1
+
+
+def normalize_expression(expression: str) -> str:
+    """Normalize a question so trivially different spellings share a cache entry."""
+    text = unicodedata.normalize('NFKC', expression).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?.! ')
+
+
+def result_cache_key(expression: str, tree_params: Dict[str, Any]) -> str:
+    """Return the cache key for a question researched with the given tree parameters."""
+    payload = json.dumps({
+        'version': RESULT_CACHE_VERSION,
+        'expression': normalize_expression(expression),
+        'tree_params': tree_params
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache(abc.ABC):
+    """Base class for result caches; subclasses implement _read and _write."""
+
+    @abc.abstractmethod
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the entry stored under key, or None if there is none."""
+
+    @abc.abstractmethod
+    def _write(self, key: str, entry: Dict[str, Any]):
+        """Store an entry under key, replacing any older one."""
+
+    def lookup(self, key: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Look up a cached result.
+
+        Returns:
+            (state, entry): state is 'fresh', 'stale' or 'miss'. The entry has
+            'response', 'cached_at' and 'age_seconds', and is None on a miss.
+        """
+        try:
+            entry = self._read(key)
+        except Exception as e:
+            logger.error("Error reading result cache", error=str(e))
+            return 'miss', None
+        if entry is None:
+            return 'miss', None
+
+        entry['age_seconds'] = max(0.0, time.time() - entry['cached_at'])
+        if entry['age_seconds'] < RESULT_CACHE_TTL_SECONDS:
+            return 'fresh', entry
+        if entry['age_seconds'] < RESULT_CACHE_STALE_SECONDS:
+            return 'stale', entry
+        return 'miss', None
+
+    def put(self, key: str, response: Dict[str, Any]):
+        """Cache a response, replacing any older entry (and clearing its refresh claim)."""
+        try:
+            self._write(key, {'response': response, 'cached_at': time.time()})
+        except Exception as e:
+            logger.error("Error writing result cache", error=str(e))
+
+    def claim_refresh(self, key: str) -> bool:
+        """
+        Claim the background refresh of a stale entry.
+
+        Returns False if another caller started a refresh less than
+        RESULT_CACHE_REFRESH_TIMEOUT seconds ago. Claims are best effort, so
+        concurrent callers may occasionally both refresh.
+        """
+        try:
+            entry = self._read(key)
+            if entry is None:
+                return False
+            refreshing_at = entry.get('refreshing_at')
+            if refreshing_at and time.time() - refreshing_at < RESULT_CACHE_REFRESH_TIMEOUT:
+                return False
+            entry['refreshing_at'] = time.time()
+            self._write(key, entry)
+            return True
+        except Exception as e:
+            logger.error("Error claiming result cache refresh", error=str(e))
+            return False
+
+
+class SQLiteResultCache(ResultCache):
+    """Entries as JSON rows of a SQLite table."""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, entry TEXT NOT NULL, cached_at REAL NOT NULL)"
+        )
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT entry FROM results WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, key: str, entry: Dict[str, Any]):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, entry, cached_at) VALUES (?, ?, ?)",
+                (key, json.dumps(entry, default=str), entry['cached_at'])
+            )
+
+
+class S3ResultCache(ResultCache):
+    """One JSON object per entry under an S3 prefix."""
+
+    def __init__(self, bucket: str, prefix: str = ''):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self._s3 = boto3.client('s3')
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}.json" if self.prefix else f"{key}.json"
+
+    def _read(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            response = self._s3.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self._s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    def _write(self, key: str, entry: Dict[str, Any]):
+        self._s3.put_object(
+            Bucket=self.bucket,
+            Key=self._key(key),
+            Body=json.dumps(entry, default=str).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+
+def create_result_cache(url: str) -> ResultCache:
+    """
+    Create a result cache from a URL (see the module docstring).
+
+    Raises:
+        ValueError: If the URL scheme is not sqlite or s3
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        return SQLiteResultCache(parsed.netloc + parsed.path)
+    if parsed.scheme == 's3':
+        return S3ResultCache(parsed.netloc, parsed.path)
+    raise ValueError(f"Unsupported result cache URL: {url}")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Return the process-wide result cache for RESULT_CACHE_URL, creating it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = create_result_cache(RESULT_CACHE_URL)
+        return _cache
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Long-running HTTP server for the research API.
+
+Lambda serves one request at a time per container, and every container
+warms its own clients and knowledge base. This serves the same API (the
+lambda_handler logic, unchanged) from one process to many concurrent
+clients. Every request shares the process's warm RAGEngine and its
+knowledge base, the Anthropic and OpenAI clients' connection pools, the
+pooled Brave Search session and the LLM gateway's rate limits.
+
+- `app` is an ASGI application. Research requests run on a bounded thread
+  pool (SERVER_WORKERS), so the event loop only moves bytes; requests
+  beyond the pool's size wait for a worker.
+- `python server.py` serves `app` with uvicorn when it is installed, and
+  with the standard library's ThreadingHTTPServer otherwise.
+- GET /health reports readiness: 503 until the engine is warm and while
+  shutting down.
+- On shutdown (SIGTERM or SIGINT, or the ASGI lifespan's shutdown) new
+  requests get 503, in-flight ones get SERVER_SHUTDOWN_GRACE_SECONDS to
+  finish, and the knowledge base is written to disk.
+
+API keys are read as in Lambda, or from ANTHROPIC_API_KEY, OPENAI_API_KEY
+and BRAVE_API_KEY (see lambda_function.load_api_keys). Asynchronous jobs
+run in background threads of the server (JOB_WORKER_MODE 'thread').
+
+Usage:
+    python server.py --port 8080
+    uvicorn server:app --port 8080 --workers 1
+"""
+
+import json
+import time
+import uuid
+import base64
+import signal
+import asyncio
+import argparse
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import lambda_function
+import singleflight
+from log import get_logger
+from config import (
+    SERVER_HOST, SERVER_PORT, SERVER_WORKERS, SERVER_REQUEST_TIMEOUT_SECONDS, SERVER_SHUTDOWN_GRACE_SECONDS
+)
+
+logger = get_logger(__name__)
+
+HEALTH_PATH = '/health'
+
+
+class RequestContext:
+    """The parts of a Lambda context the handler uses: a request id and the time remaining."""
+
+    def __init__(self, timeout_seconds: float):
+        self.aws_request_id = uuid.uuid4().hex
+        self._deadline = time.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._deadline - time.time()) * 1000))
+
+
+class ResearchServer:
+    """
+    Runs research requests through lambda_function on a shared thread pool.
+
+    Args:
+        workers: Requests handled at once
+        request_timeout: Seconds each request's tree may take (its deadline)
+    """
+
+    def __init__(self, workers: int = SERVER_WORKERS, request_timeout: float = SERVER_REQUEST_TIMEOUT_SECONDS):
+        self.workers = workers
+        self.request_timeout = request_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='research-request')
+        self.started_at = time.time()
+        self.ready = False
+        self.draining = False
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    def start(self):
+        """Warm the engine, so the first request doesn't pay for it. A failure is retried by the first request."""
+        self.ready = lambda_function.preload()
+
+    def health(self) -> Tuple[int, Dict[str, Any]]:
+        """Return the health check's status code and body."""
+        if self.draining:
+            status = 'draining'
+        else:
+            status = 'ok' if self.ready else 'starting'
+        with self._idle:
+            in_flight = self._in_flight
+        return (200 if status == 'ok' else 503), {
+            'status': status,
+            'in_flight': in_flight,
+            'workers': self.workers,
+            'coalescing': singleflight.stats(),
+            'uptime_seconds': round(time.time() - self.started_at, 1)
+        }
+
+    def submit(self, method: str, path: str, query_string: str, headers: Dict[str, str],
+               body: bytes) -> Future:
+        """Handle a request on the thread pool; the future's result is (status, headers, body)."""
+        return self.executor.submit(self.handle, method, path, query_string, headers, body)
+
+    def handle(self, method: str, path: str, query_string: str, headers: Dict[str, str],
+               body: bytes) -> Tuple[int, Dict[str, str], bytes]:
+        """Handle one HTTP request with lambda_handler, as API Gateway would invoke it."""
+        if path == HEALTH_PATH:
+            status, health = self.health()
+            return status, {'Content-Type': 'application/json'}, json.dumps(health).encode('utf-8')
+        if self.draining:
+            return 503, {'Content-Type': 'application/json', 'Retry-After': '5'}, \
+                json.dumps({'error': 'Server is shutting down'}).encode('utf-8')
+
+        with self._idle:
+            self._in_flight += 1
+        try:
+            event = {
+                'httpMethod': method,
+                'path': path,
+                'headers': headers,
+                'queryStringParameters': dict(parse_qsl(query_string)) or None,
+                'body': body.decode('utf-8') if body else None,
+                'isBase64Encoded': False,
+                'requestContext': {'stage': lambda_function.LOCAL_SERVER_STAGE}
+            }
+            response = lambda_function.lambda_handler(event, RequestContext(self.request_timeout))
+        finally:
+            with self._idle:
+                self._in_flight -= 1
+                self._idle.notify_all()
+
+        payload = response.get('body') or ''
+        payload = base64.b64decode(payload) if response.get('isBase64Encoded') else payload.encode('utf-8')
+        return response['statusCode'], dict(response.get('headers') or {}), payload
+
+    def shutdown(self, grace_seconds: float = SERVER_SHUTDOWN_GRACE_SECONDS):
+        """
+        Stop taking requests, wait up to grace_seconds for in-flight ones, then persist the knowledge base.
+        """
+        self.draining = True
+        deadline = time.time() + grace_seconds
+        with self._idle:
+            while self._in_flight and time.time() < deadline:
+                self._idle.wait(deadline - time.time())
+            abandoned = self._in_flight
+        if abandoned:
+            logger.warning("Shutting down with requests still in flight", in_flight=abandoned)
+        self.executor.shutdown(wait=False)
+        try:
+            lambda_function.flush_knowledge_base()
+        except Exception as e:
+            logger.error("Error persisting the knowledge base on shutdown", error=str(e))
+        logger.info("Server stopped", uptime_seconds=round(time.time() - self.started_at, 1))
+
+
+# The process's server, shared by the ASGI app and the standard library fallback
+research_server = ResearchServer()
+
+
+async def app(scope, receive, send):
+    """ASGI application: HTTP requests and the lifespan protocol."""
+    loop = asyncio.get_running_loop()
+
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await loop.run_in_executor(None, research_server.start)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await loop.run_in_executor(None, research_server.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    headers = {}
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    query_string = scope.get('query_string', b'').decode('latin-1')
+
+    if scope['path'] == HEALTH_PATH:
+        # Answered on the loop, so it responds even when every worker is busy
+        status, response_headers, payload = research_server.handle(scope['method'], scope['path'], query_string,
+                                                                   headers, body)
+    else:
+        status, response_headers, payload = await asyncio.wrap_future(
+            research_server.submit(scope['method'], scope['path'], query_string, headers, body)
+        )
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                    for name, value in response_headers.items()]
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+class ResearchRequestHandler(BaseHTTPRequestHandler):
+    """Standard library fallback: hands each request to research_server's thread pool."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _serve(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = urlsplit(self.path)
+        headers = {name: value for name, value in self.headers.items()}
+        if url.path == HEALTH_PATH:
+            status, response_headers, payload = research_server.handle(self.command, url.path, url.query,
+                                                                       headers, body)
+        else:
+            status, response_headers, payload = research_server.submit(self.command, url.path, url.query,
+                                                                       headers, body).result()
+
+        self.send_response(status)
+        for name, value in response_headers.items():
+            self.send_header(name, str(value))
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_OPTIONS = _serve
+
+    def log_message(self, format, *args):
+        logger.debug("HTTP request", client=self.client_address[0], request=format % args)
+
+
+def serve_stdlib(host: str, port: int):
+    """Serve with ThreadingHTTPServer until SIGTERM or SIGINT, then shut down gracefully."""
+    research_server.start()
+    httpd = ThreadingHTTPServer((host, port), ResearchRequestHandler)
+    httpd.daemon_threads = True
+
+    def stop(signum, frame):
+        logger.info("Shutting down", signal=signal.Signals(signum).name)
+        research_server.draining = True
+        # shutdown() blocks until serve_forever returns, so it can't run on serve_forever's thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("Serving research API", host=host, port=port, server='stdlib', workers=research_server.workers)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        research_server.shutdown()
+
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, use_uvicorn: Optional[bool] = None):
+    """Serve the research API, with uvicorn if it is installed (or use_uvicorn is True)."""
+    uvicorn = None
+    if use_uvicorn is not False:
+        try:
+            import uvicorn
+        except ImportError:
+            if use_uvicorn:
+                raise
+    if uvicorn is None:
+        serve_stdlib(host, port)
+        return
+    logger.info("Serving research API", host=host, port=port, server='uvicorn', workers=research_server.workers)
+    # One process: the point is that every request shares the warm engine
+    uvicorn.run(app, host=host, port=port, lifespan='on', log_level='warning',
+                timeout_graceful_shutdown=SERVER_SHUTDOWN_GRACE_SECONDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the research API from one long-running process.')
+    parser.add_argument('--host', default=SERVER_HOST, help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help='Port to listen on')
+    parser.add_argument('--stdlib', action='store_true', help="Use the standard library server even if uvicorn is installed")
+    args = parser.parse_args()
+    serve(args.host, args.port, use_uvicorn=False if args.stdlib else None)
+
+
+if __name__ == '__main__':
+    main()
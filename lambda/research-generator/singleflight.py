@@ -0,0 +1,157 @@
+"""
+In-flight coalescing ("singleflight") of identical work.
+
+When several callers start the same work at once, for example users asking
+the same trending question, or tree nodes issuing the same Brave query,
+embedding the same text or sending the same Claude prompt, a SingleFlight
+runs it once. The first caller for a key (the leader) does the work, and
+callers arriving while it runs wait for it and share its result, or its
+exception. Nothing is kept once the work finishes: this coalesces
+concurrent work and is not a cache.
+
+Groups used by the research generator:
+
+- research: whole research responses, keyed on the result cache key
+  (lambda_function.run_research)
+- brave_search: Brave searches and their ingestion, keyed on the
+  normalized query (KnowledgeBaseManager.populate_from_brave_search)
+- embedding: retrieval query embeddings, keyed on the text
+  (RAGEngine.embed_query)
+- claude: non-streamed Claude calls, keyed on the whole request
+  (LLMGateway.create_message)
+
+Shared results are the same object for every caller, so callers must not
+mutate them. A waiting caller can bound its wait (wait_seconds), and run the
+work itself when the leader failed for a reason of its own, such as its
+deadline (retry_on).
+"""
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, Type
+
+from config import SINGLEFLIGHT_ENABLED
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Every group created, for stats()
+_groups = []
+_groups_lock = threading.Lock()
+
+
+def request_key(*parts: Any) -> str:
+    """Return a stable key for JSON-serializable work descriptions (e.g. a Claude request's arguments)."""
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a query for coalescing: lower case, with runs of whitespace collapsed."""
+    return ' '.join(text.lower().split())
+
+
+class SingleFlight:
+    """
+    Runs concurrent calls with the same key once, sharing the result.
+
+    Args:
+        name: Group name, reported by stats()
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {'leaders': 0, 'shared': 0}
+        self._waiting = 0
+        with _groups_lock:
+            _groups.append(self)
+
+    def do(self, key: Hashable, fn: Callable, *args, wait_seconds: Optional[float] = None,
+           retry_on: Tuple[Type[BaseException], ...] = (), **kwargs) -> Tuple[Any, bool]:
+        """
+        Run fn(*args, **kwargs), or wait for the call already running for key.
+
+        Args:
+            key: Identifies the work; calls with equal keys are coalesced
+            fn: The work
+            wait_seconds: Longest wait for another caller's call, if limited
+            retry_on: Exceptions of another caller's call that this caller
+                does not share: it runs the work again (coalesced with any
+                other caller doing the same) instead of raising them
+
+        Returns:
+            (result, shared): shared is True if the result came from another
+            caller's call
+
+        Raises:
+            concurrent.futures.TimeoutError: If wait_seconds pass before the
+                call this caller waits for finishes
+            Exception: The exception raised by fn, in every caller that waited
+                for it (unless it is one of retry_on)
+        """
+        if not SINGLEFLIGHT_ENABLED:
+            return fn(*args, **kwargs), False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._calls[key] = call
+                self._stats['leaders'] += 1
+            else:
+                self._stats['shared'] += 1
+                self._waiting += 1
+
+        if not leader:
+            logger.debug("Waiting for in-flight call", group=self.name)
+            start_time = time.monotonic()
+            try:
+                return call.result(timeout=wait_seconds), True
+            except retry_on as e:
+                logger.debug("In-flight call failed; running it again", group=self.name, error_type=type(e).__name__)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+            if wait_seconds is not None:
+                wait_seconds = max(0.0, wait_seconds - (time.monotonic() - start_time))
+            return self.do(key, fn, *args, wait_seconds=wait_seconds, retry_on=retry_on, **kwargs)
+
+        # The call is forgotten before its waiters wake, so any that run it again start a new one
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._forget(key)
+            call.set_exception(e)
+            raise
+        self._forget(key)
+        call.set_result(result)
+        return result, False
+
+    def _forget(self, key: Hashable):
+        with self._lock:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the calls run ('leaders'), the calls that shared one ('shared'),
+        the calls running now ('in_flight') and the callers waiting for them now ('waiting').
+        """
+        with self._lock:
+            return {**self._stats, 'in_flight': len(self._calls), 'waiting': self._waiting}
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Return the stats of every group, summed by group name."""
+    totals = {}
+    with _groups_lock:
+        groups = list(_groups)
+    for group in groups:
+        group_totals = totals.setdefault(group.name, {'leaders': 0, 'shared': 0, 'in_flight': 0, 'waiting': 0})
+        for key, value in group.stats().items():
+            group_totals[key] += value
+    return totals
@@ -0,0 +1,165 @@
+"""
+Append-only ledger of knowledge base sources for the research generator.
+
+Every document added to the knowledge base appends one row to a SQLite table
+with indexes on URL and type, so recording a source costs the same no matter
+how many came before, and lookups, filtering and pagination do not load the
+whole ledger. Fetch timestamps are stored as epoch seconds so components can
+check freshness with a single indexed query.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from log import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL,
+    title TEXT,
+    type TEXT,
+    query TEXT,
+    fetched_at REAL NOT NULL,
+    added_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sources_source ON sources (source, fetched_at);
+CREATE INDEX IF NOT EXISTS idx_sources_type ON sources (type, id);
+"""
+
+COLUMNS = ['id', 'source', 'title', 'type', 'query', 'fetched_at', 'added_at']
+
+
+def _to_epoch(value: Any) -> Optional[float]:
+    """Convert a fetched_at value (epoch seconds or datetime string) to epoch seconds."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return None
+
+
+class SourcesLedger:
+    """SQLite-backed, append-only record of every source added to the knowledge base."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def append(self, documents: List[Dict[str, Any]]):
+        """Append one ledger row per document."""
+        now = time.time()
+        added_at = str(datetime.now())
+        rows = []
+        for doc in documents:
+            metadata = doc.get('metadata', {})
+            rows.append((
+                metadata.get('source', ''),
+                metadata.get('title', ''),
+                metadata.get('type', ''),
+                metadata.get('query'),
+                _to_epoch(metadata.get('fetched_at')) or now,
+                added_at
+            ))
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO sources (source, title, type, query, fetched_at, added_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+
+    def list_sources(self, source_type: str = None, limit: int = None, offset: int = 0) -> List[Dict[str, Any]]:
+        """
+        List ledger entries in the order they were added.
+
+        Args:
+            source_type: Only return entries of this type (e.g. 'web', 'pdf')
+            limit: Maximum number of entries to return (all if None)
+            offset: Number of matching entries to skip, for pagination
+
+        Returns:
+            A list of ledger entries as dictionaries
+        """
+        query = f"SELECT {', '.join(COLUMNS)} FROM sources"
+        params = []
+        if source_type:
+            query += " WHERE type = ?"
+            params.append(source_type)
+        query += " ORDER BY id LIMIT ? OFFSET ?"
+        params.extend([limit if limit is not None else -1, offset])
+        return self._fetch(query, params)
+
+    def count(self, source_type: str = None) -> int:
+        """Count ledger entries, optionally of a single type."""
+        with self._lock:
+            if source_type:
+                row = self._conn.execute("SELECT COUNT(*) FROM sources WHERE type = ?", (source_type,)).fetchone()
+            else:
+                row = self._conn.execute("SELECT COUNT(*) FROM sources").fetchone()
+        return row[0]
+
+    def get_by_url(self, url: str) -> List[Dict[str, Any]]:
+        """Return every ledger entry for a URL, oldest first."""
+        return self._fetch(f"SELECT {', '.join(COLUMNS)} FROM sources WHERE source = ? ORDER BY id", [url])
+
+    def last_fetched(self, url: str) -> Optional[float]:
+        """Return when url was last fetched (epoch seconds), or None if it never was."""
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(fetched_at) FROM sources WHERE source = ?", (url,)).fetchone()
+        return row[0]
+
+    def is_fresh(self, url: str, max_age_seconds: float) -> bool:
+        """Check whether url was fetched within the last max_age_seconds."""
+        fetched_at = self.last_fetched(url)
+        return fetched_at is not None and time.time() - fetched_at <= max_age_seconds
+
+    def import_json(self, json_path: str):
+        """Import a legacy sources.json file, then rename it so it is only imported once."""
+        with open(json_path, 'r') as f:
+            legacy_sources = json.load(f)
+        self.append([
+            {'metadata': {**entry, 'fetched_at': entry.get('added_at')}}
+            for entry in legacy_sources
+        ])
+        os.replace(json_path, f"{json_path}.imported")
+        logger.info("Imported legacy sources", sources=len(legacy_sources), path=json_path)
+
+    def clear(self):
+        """Remove every entry. Used when the whole knowledge base is cleared."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sources")
+
+    def backup(self, path: str):
+        """Write a consistent copy of the ledger to path."""
+        target = sqlite3.connect(path)
+        try:
+            with self._lock:
+                self._conn.backup(target)
+        finally:
+            target.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _fetch(self, query: str, params: List[Any]) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
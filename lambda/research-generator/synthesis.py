@@ -0,0 +1,126 @@
+"""
+Helpers for synthesizing a parent answer from its children's answers.
+
+Child answers are HTML written for display. compact_answer reduces one to
+plain-text notes (headings, bullet points and sentences, without markup),
+truncate_notes caps notes at a token budget, and group_notes splits a list
+of notes into groups that each fit a token budget, for the map step of
+RAGEngine.synthesize_answer's map-reduce.
+"""
+import re
+from html.parser import HTMLParser
+from typing import List
+
+from llm_gateway import estimate_tokens
+from tree_model import TreeNode
+
+_BLOCK_TAGS = {'p', 'div', 'section', 'article', 'blockquote', 'tr', 'br', 'ul', 'ol', 'table'}
+_HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+_SKIPPED_TAGS = {'script', 'style'}
+
+
+class _NotesParser(HTMLParser):
+    """Collects an HTML answer's text as lines, marking headings and list items."""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self._current = []
+        self._prefix = ''
+        self._skipping = 0
+
+    def _flush(self):
+        text = re.sub(r'\s+', ' ', ''.join(self._current)).strip()
+        if text:
+            self.lines.append(f"{self._prefix}{text}")
+        self._current = []
+        self._prefix = ''
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in _HEADING_TAGS:
+            self._flush()
+            self._prefix = '# '
+        elif tag == 'li':
+            self._flush()
+            self._prefix = '- '
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in _HEADING_TAGS or tag == 'li' or tag in _BLOCK_TAGS:
+            self._flush()
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self._current.append(data)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def truncate_notes(lines: List[str], max_tokens: int) -> str:
+    """
+    Join lines of notes, keeping them in order until about max_tokens.
+
+    The line that crosses the budget is cut at a sentence (or word) boundary.
+    """
+    notes = []
+    used = 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if used + tokens > max_tokens:
+            cut = line[:(max_tokens - used) * 4]
+            boundary = max(cut.rfind('. '), cut.rfind(' '))
+            if boundary > 0:
+                notes.append(cut[:boundary + 1].rstrip() + ' ...')
+            break
+        notes.append(line)
+        used += tokens
+    return "\n".join(notes)
+
+
+def compact_answer(html: str, max_tokens: int) -> str:
+    """Reduce an HTML answer to plain-text notes of at most about max_tokens."""
+    parser = _NotesParser()
+    parser.feed(html or '')
+    parser.close()
+    return truncate_notes(parser.lines, max_tokens)
+
+
+def child_notes(children: List[TreeNode], max_tokens: int) -> List[str]:
+    """Return one compacted note per child that has a usable answer."""
+    notes = []
+    for child in children:
+        if not child.has_usable_answer():
+            continue
+        compacted = compact_answer(child.answer, max_tokens)
+        if compacted:
+            notes.append(f"## {child.question}\n{compacted}")
+    return notes
+
+
+def notes_tokens(notes: List[str]) -> int:
+    return sum(estimate_tokens(note) for note in notes)
+
+
+def group_notes(notes: List[str], max_tokens: int) -> List[List[str]]:
+    """Split notes, in order, into groups of at most max_tokens (a larger note gets its own group)."""
+    groups = []
+    current = []
+    used = 0
+    for note in notes:
+        tokens = estimate_tokens(note)
+        if current and used + tokens > max_tokens:
+            groups.append(current)
+            current = []
+            used = 0
+        current.append(note)
+        used += tokens
+    if current:
+        groups.append(current)
+    return groups
@@ -5,6 +5,7 @@ This allows you to test the function before deploying to AWS Lambda.
 
 Usage:
     python test_locally.py "What is the current state of quantum computing?"
+    python test_locally.py "What is the current state of quantum computing?" --trace output/trace.json
 """
 
 import os
@@ -15,6 +16,7 @@ from anthropic import Anthropic
 import openai
 from rag_engine import RAGEngine
 from tree_visualizer import validate_tree_structure
+from tracing import Trace
 import logging
 
 # Set up logging
@@ -88,6 +90,8 @@ def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Test the RAG-based research generator locally.')
     parser.add_argument('question', type=str, help='The research question to process')
+    parser.add_argument('--trace', metavar='PATH',
+                        help='Write a Chrome trace of the tree build to PATH (open it in ui.perfetto.dev)')
     args = parser.parse_args()
     
     # Start timing
@@ -108,8 +112,10 @@ def main():
         
         # Generate answer with question tree
         print("\nGenerating question tree and answers...")
+        trace = Trace(args.question)
         try:
-            question_tree = rag.generate_answer_with_tree(args.question, client, brave_key)
+            with trace.activate():
+                question_tree = rag.generate_answer_with_tree(args.question, client, brave_key).to_dict()
 
             print("Generated question tree structure:")
             print(json.dumps(question_tree, indent=2, default=str))
@@ -146,7 +152,8 @@ def main():
         metadata = {
             'total_nodes': count_nodes(question_tree),
             'max_depth': get_max_depth(question_tree),
-            'processing_time': f"{execution_time:.2f} seconds"
+            'processing_time': f"{execution_time:.2f} seconds",
+            'timings': trace.summary()
         }
         
         # Print results
@@ -165,6 +172,12 @@ def main():
         print(f"Maximum depth: {metadata['max_depth']}")
         print(f"Processing time: {metadata['processing_time']}")
         
+        print("\n=== Timings (tree build) ===")
+        for stage, timing in metadata['timings']['stages'].items():
+            print(f"{stage:<24} {timing['calls']:>4} calls {timing['seconds']:>9.2f}s")
+        if args.trace:
+            print(f"Trace written to {trace.export_chrome(args.trace)}")
+        
         # Save output
         output = {
             'explanation': final_answer,
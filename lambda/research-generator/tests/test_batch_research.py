@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from batch_research import (
+    BatchCollector, BatchingClient, BatchRequestError, LocalBatchBackend, completed_questions
+)
+
+
+class EchoClient:
+    """Messages API client answering with the upper-cased prompt; 'fail' is overloaded."""
+
+    def __init__(self):
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, **params):
+        text = params['messages'][0]['content']
+        if text == 'fail':
+            raise BatchRequestError('Overloaded', 529)
+        return SimpleNamespace(
+            id='msg_1', model=params['model'], stop_reason='end_turn',
+            content=[SimpleNamespace(type='text', text=text.upper())],
+            usage=SimpleNamespace(input_tokens=3, output_tokens=1)
+        )
+
+
+def run_trees(collector, prompts, stream=False, idle_trees=0):
+    """
+    Send one request per prompt from concurrently running trees; returns each tree's outcome.
+
+    idle_trees more trees are running but send nothing until the others finish.
+    """
+    client = BatchingClient(collector)
+    outcomes = {}
+
+    def tree(i, prompt):
+        params = {'model': 'test-model', 'max_tokens': 10, 'messages': [{'role': 'user', 'content': prompt}]}
+        try:
+            if stream:
+                with client.messages.stream(**params) as message_stream:
+                    outcomes[i] = (list(message_stream.text_stream), message_stream.get_final_message())
+            else:
+                outcomes[i] = client.messages.create(**params)
+        except BatchRequestError as e:
+            outcomes[i] = e
+        finally:
+            collector.tree_finished()
+
+    # Every tree is running before any request is queued, so they all go out in one batch
+    for _ in range(len(prompts) + idle_trees):
+        collector.tree_started()
+    threads = [threading.Thread(target=tree, args=(i, prompt)) for i, prompt in enumerate(prompts)]
+    for thread in threads:
+        thread.start()
+
+    def finish_when_done():
+        for thread in threads:
+            thread.join()
+        for _ in range(idle_trees):
+            collector.tree_finished()
+        collector.finish()
+
+    threading.Thread(target=finish_when_done).start()
+    collector.run()
+    return outcomes
+
+
+def make_collector(**options):
+    return BatchCollector(LocalBatchBackend(EchoClient()), poll_seconds=0.01, collect_seconds=10, **options)
+
+
+def test_collector_sends_one_batch_once_every_tree_waits():
+    collector = make_collector()
+    outcomes = run_trees(collector, ['first', 'second', 'third'])
+
+    assert collector.batches_submitted == 1
+    assert collector.requests_submitted == 3
+    assert [outcomes[i].content[0].text for i in range(3)] == ['FIRST', 'SECOND', 'THIRD']
+    assert outcomes[0].usage.input_tokens == 3
+
+
+def test_collector_counts_trees_waiting_on_a_shared_call_as_blocked():
+    collector = make_collector(shared_waiters=lambda: 1)
+    start_time = time.time()
+    outcomes = run_trees(collector, ['first', 'second'], idle_trees=1)
+
+    assert time.time() - start_time < collector.collect_seconds
+    assert collector.batches_submitted == 1
+    assert [outcomes[i].content[0].text for i in range(2)] == ['FIRST', 'SECOND']
+
+
+def test_collector_waits_for_busy_trees_until_collect_seconds():
+    collector = BatchCollector(LocalBatchBackend(EchoClient()), poll_seconds=0.01, collect_seconds=0.3)
+    start_time = time.time()
+    run_trees(collector, ['first'], idle_trees=1)
+
+    assert time.time() - start_time >= 0.3
+    assert collector.batches_submitted == 1
+
+
+def test_collector_raises_failed_requests_with_their_status():
+    outcomes = run_trees(make_collector(), ['ok', 'fail'])
+
+    assert outcomes[0].content[0].text == 'OK'
+    assert isinstance(outcomes[1], BatchRequestError)
+    assert outcomes[1].status_code == 529
+
+
+def test_collector_finishes_without_requests():
+    collector = make_collector()
+    collector.finish()
+    collector.run()
+
+    assert collector.batches_submitted == 0
+
+
+def test_streamed_request_delivers_the_whole_text_at_once():
+    outcomes = run_trees(make_collector(), ['streamed'], stream=True)
+
+    deltas, message = outcomes[0]
+    assert deltas == ['STREAMED']
+    assert message.content[0].text == 'STREAMED'
+
+
+def write_records(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        for question, error in records:
+            f.write(json.dumps({'question': question, 'tree': None, 'error': error}) + '\n')
+
+
+def test_completed_questions_without_output_file(tmp_path):
+    assert completed_questions(str(tmp_path / 'missing.jsonl')) == set()
+
+
+def test_completed_questions_skips_failed_and_takes_the_last_record(tmp_path):
+    path = tmp_path / 'results.jsonl'
+    write_records(path, [
+        ('answered', None),
+        ('failed', 'Failed to generate answer'),
+        ('retried', 'Overloaded'),
+        ('retried', None),
+        ('failed on retry', None),
+        ('failed on retry', 'Overloaded'),
+        ('empty error', ''),
+    ])
+
+    assert completed_questions(str(path)) == {'answered', 'retried', 'empty error'}
@@ -0,0 +1,120 @@
+from types import SimpleNamespace
+
+import pytest
+
+from budget import ResearchBudget, record_usage
+from config import BUDGET_LOW_FRACTION, BUDGET_MIN_ANSWER_TOKENS
+from deadline import Deadline
+
+# Not in MODEL_PRICING, so calls cost nothing and only tokens and time count
+MODEL = 'test-model'
+
+
+def spend_output_tokens(budget, output_tokens):
+    budget.record('node', MODEL, input_tokens=0, output_tokens=output_tokens)
+
+
+def make_budget(**limits):
+    return ResearchBudget(**{'max_input_tokens': 100000, 'max_output_tokens': 10000, 'max_seconds': 600,
+                             'max_cost_usd': 1.0, **limits})
+
+
+def test_fresh_budget_is_not_low():
+    budget = make_budget()
+
+    assert not budget.is_low()
+    assert budget.can_expand()
+
+
+def test_budget_is_low_once_a_limit_is_into_the_reserve():
+    budget = make_budget()
+    spend_output_tokens(budget, int(10000 * (1 - BUDGET_LOW_FRACTION)) - 100)
+    assert not budget.is_low()
+
+    spend_output_tokens(budget, 200)
+    assert budget.is_low()
+    assert not budget.can_expand()
+
+
+def test_budget_is_low_when_time_runs_out():
+    budget = make_budget(max_seconds=100)
+    budget.start_time -= 90
+
+    assert budget.is_low()
+
+
+def test_budget_without_a_seconds_limit_ignores_time():
+    budget = make_budget(max_seconds=None)
+    budget.start_time -= 100000
+
+    assert not budget.is_low()
+    assert 'seconds' not in budget.remaining()
+    assert budget.affordable_children(3) == 3
+    assert budget.summary()['limits']['seconds'] is None
+
+
+def test_seconds_limit_is_capped_by_the_deadline():
+    assert make_budget(max_seconds=600, deadline=Deadline(30)).limits['seconds'] <= 30
+    assert make_budget(max_seconds=None, deadline=Deadline(30)).limits['seconds'] <= 30
+
+
+def test_max_tokens_unchanged_while_budget_is_healthy():
+    assert make_budget().max_tokens_for(1000) == 1000
+
+
+def test_max_tokens_never_exceeds_the_output_tokens_left():
+    budget = make_budget()
+    spend_output_tokens(budget, 5000)
+
+    assert budget.max_tokens_for(8000) == 5000
+
+
+def test_max_tokens_shrink_with_a_low_budget():
+    budget = make_budget()
+    spend_output_tokens(budget, 9000)
+
+    # A tenth of the limit is left, half of the low-budget share
+    assert budget.max_tokens_for(1000) == 500
+
+
+def test_max_tokens_never_shrink_below_the_minimum():
+    budget = make_budget()
+    spend_output_tokens(budget, 9990)
+
+    assert budget.max_tokens_for(1000) == BUDGET_MIN_ANSWER_TOKENS
+
+
+def test_record_usage_charges_the_active_budget_and_node():
+    budget = make_budget()
+    usage = SimpleNamespace(input_tokens=100, output_tokens=20, cache_creation_input_tokens=0,
+                            cache_read_input_tokens=50)
+
+    record_usage(MODEL, usage)
+    assert budget.calls == 0
+
+    with budget.track('node'):
+        record_usage(MODEL, usage)
+
+    assert budget.calls == 1
+    assert budget.spent['input_tokens'] == 150
+    assert budget.node_spend('node')['output_tokens'] == 20
+
+
+def test_node_estimate_leaves_out_the_childrens_seconds(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('budget.time.time', lambda: now[0])
+    budget = make_budget()
+
+    with budget.track('root'):
+        now[0] += 2
+        with budget.track('child'):
+            now[0] += 3
+            with budget.track('grandchild'):
+                now[0] += 1
+        now[0] += 4
+
+    assert budget.node_spend('root')['seconds'] == 10
+    assert budget.node_spend('root')['own_seconds'] == 6
+    assert budget.node_spend('child')['own_seconds'] == 3
+    # (6 + 3 + 1) / 3 nodes
+    assert budget.node_estimate()['seconds'] == pytest.approx(10 / 3)
@@ -0,0 +1,152 @@
+from email.utils import formatdate
+from types import SimpleNamespace
+import time
+
+import pytest
+
+import llm_gateway
+from llm_gateway import CircuitBreaker, CircuitOpenError, LLMGateway, get_retry_after
+
+MODEL = 'test-model'
+
+
+class APIError(Exception):
+    """An API error with a status code and response headers, like the SDK's APIStatusError."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+class ScriptedClient:
+    """Messages API client that raises the scripted errors in turn, then answers."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, **params):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(content=[SimpleNamespace(type='text', text='answer')],
+                               usage=SimpleNamespace(input_tokens=1, output_tokens=1))
+
+
+def open_breaker():
+    """A breaker that has opened and whose cool-down has passed."""
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    breaker.opened_at -= 31
+    return breaker
+
+
+def test_breaker_opens_after_the_failure_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.check(MODEL)
+
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.check(MODEL)
+
+
+def test_half_open_breaker_admits_a_single_trial_call():
+    breaker = open_breaker()
+    assert breaker.state == 'half_open'
+
+    breaker.check(MODEL)
+    with pytest.raises(CircuitOpenError):
+        breaker.check(MODEL)
+    with pytest.raises(CircuitOpenError):
+        breaker.check(MODEL)
+
+
+def test_successful_trial_closes_the_breaker():
+    breaker = open_breaker()
+    breaker.check(MODEL)
+    breaker.record_success()
+
+    assert breaker.state == 'closed'
+    breaker.check(MODEL)
+    breaker.check(MODEL)
+
+
+def test_failed_trial_reopens_the_breaker():
+    breaker = open_breaker()
+    breaker.check(MODEL)
+    breaker.record_failure()
+
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.check(MODEL)
+
+
+def test_released_trial_lets_the_next_caller_try():
+    breaker = open_breaker()
+    breaker.check(MODEL)
+    breaker.release_trial()
+
+    breaker.check(MODEL)
+    assert breaker.state == 'half_open'
+
+
+def test_rate_limited_trial_is_released_by_the_gateway():
+    gateway = LLMGateway(max_retries=0)
+    _, breaker = gateway._limits_for(MODEL)
+    breaker.opened_at = time.monotonic() - breaker.reset_seconds - 1
+
+    with pytest.raises(APIError):
+        gateway.create_message(ScriptedClient(APIError(429)), model=MODEL, max_tokens=10, messages=[])
+
+    assert not breaker.trial_in_flight
+    gateway.create_message(ScriptedClient(), model=MODEL, max_tokens=10, messages=[])
+    assert breaker.state == 'closed'
+
+
+@pytest.mark.parametrize('headers, expected', [
+    ({'retry-after': '3'}, 3.0),
+    ({'retry-after-ms': '1500', 'retry-after': '3'}, 1.5),
+    ({'retry-after-ms': 'soon', 'retry-after': '2'}, 2.0),
+    ({'retry-after': 'never'}, None),
+    ({}, None),
+])
+def test_get_retry_after_reads_the_headers(headers, expected):
+    assert get_retry_after(APIError(429, headers)) == expected
+
+
+def test_get_retry_after_reads_an_http_date():
+    retry_after = get_retry_after(APIError(429, {'retry-after': formatdate(time.time() + 60, usegmt=True)}))
+
+    assert 55 <= retry_after <= 60
+
+
+def test_get_retry_after_without_a_response():
+    assert get_retry_after(ValueError('no response')) is None
+
+
+def test_gateway_waits_for_retry_after_before_retrying(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(llm_gateway.time, 'sleep', sleeps.append)
+    gateway = LLMGateway(max_retries=2, max_delay=10)
+    client = ScriptedClient(APIError(429, {'retry-after': '4'}), APIError(529, {'retry-after': '60'}))
+
+    response = gateway.create_message(client, model=MODEL, max_tokens=10, messages=[])
+
+    assert response.content[0].text == 'answer'
+    assert client.calls == 3
+    # The second wait is capped at max_delay
+    assert sleeps == [4.0, 10]
+    assert gateway.metrics.snapshot()[MODEL]['retries'] == 2
+
+
+def test_gateway_does_not_retry_client_errors(monkeypatch):
+    monkeypatch.setattr(llm_gateway.time, 'sleep', lambda seconds: pytest.fail('retried a client error'))
+    client = ScriptedClient(APIError(400, {'retry-after': '1'}))
+
+    with pytest.raises(APIError):
+        LLMGateway().create_message(client, model=MODEL, max_tokens=10, messages=[])
+    assert client.calls == 1
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from planner import PlanValidationError, max_sub_questions_for, parse_plan
+
+SUB_QUESTIONS = ['What is A?', ' What is B? ', '', 'What is C?', 'What is D?']
+
+
+def plan_text(**fields):
+    return json.dumps({'answer_style': 'comprehensive', 'sub_questions': SUB_QUESTIONS, **fields})
+
+
+def test_plan_is_trimmed_to_its_complexity():
+    plan = parse_plan(f"```json\n{plan_text(complexity=2)}\n```")
+
+    assert plan == {'complexity': 2, 'answer_style': 'comprehensive', 'sub_questions': ['What is A?', 'What is B?']}
+
+
+def test_unrated_plan_needs_a_complexity():
+    with pytest.raises(PlanValidationError, match='complexity'):
+        parse_plan(plan_text())
+    with pytest.raises(PlanValidationError, match='complexity'):
+        parse_plan(plan_text(complexity=9))
+
+
+def test_rated_plan_takes_the_given_complexity():
+    assert parse_plan(plan_text(), complexity=3)['complexity'] == 3
+    assert len(parse_plan(plan_text(), complexity=3)['sub_questions']) == 3
+    # A complexity in the response is ignored
+    assert parse_plan(plan_text(complexity=5), complexity=2)['complexity'] == 2
+
+
+def test_rated_plan_still_needs_its_other_fields():
+    with pytest.raises(PlanValidationError, match='answer_style'):
+        parse_plan(json.dumps({'sub_questions': []}), complexity=3)
+
+
+def test_max_sub_questions_for():
+    assert [max_sub_questions_for(level) for level in range(0, 7)] == [0, 0, 2, 3, 4, 5, 5]
@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+import singleflight
+from singleflight import SingleFlight, normalize_text, request_key
+
+
+class Blocking:
+    """Work that runs until released, counting its runs."""
+
+    def __init__(self, result='result', error=None):
+        self.result = result
+        self.error = error
+        self.runs = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.runs += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def start_callers(group, key, work, count, **options):
+    """Start count callers of group.do(key, work); returns their threads and outcomes."""
+    outcomes = []
+    lock = threading.Lock()
+
+    def caller():
+        try:
+            outcome = group.do(key, work, **options)
+        except Exception as e:
+            outcome = e
+        with lock:
+            outcomes.append(outcome)
+
+    threads = [threading.Thread(target=caller) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def wait_for_followers(group, count):
+    deadline = time.time() + 5
+    while group.stats()['shared'] < count and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def test_concurrent_callers_share_one_call():
+    group = SingleFlight('test')
+    work = Blocking()
+    threads, outcomes = start_callers(group, 'key', work, 1)
+    work.started.wait(5)
+    followers, follower_outcomes = start_callers(group, 'key', work, 3)
+    wait_for_followers(group, 3)
+    assert group.stats()['waiting'] == 3
+    work.release.set()
+    for thread in threads + followers:
+        thread.join()
+
+    assert work.runs == 1
+    assert outcomes == [('result', False)]
+    assert follower_outcomes == [('result', True)] * 3
+    assert group.stats() == {'leaders': 1, 'shared': 3, 'in_flight': 0, 'waiting': 0}
+
+
+def test_exception_propagates_to_every_waiting_caller():
+    group = SingleFlight('test')
+    work = Blocking(error=ValueError('failed'))
+    threads, outcomes = start_callers(group, 'key', work, 1)
+    work.started.wait(5)
+    followers, follower_outcomes = start_callers(group, 'key', work, 2)
+    wait_for_followers(group, 2)
+    work.release.set()
+    for thread in threads + followers:
+        thread.join()
+
+    assert work.runs == 1
+    assert all(isinstance(outcome, ValueError) for outcome in outcomes + follower_outcomes)
+    assert group.stats()['in_flight'] == 0
+
+
+def test_calls_after_the_first_finishes_run_again():
+    group = SingleFlight('test')
+    calls = []
+
+    assert group.do('key', calls.append, 1) == (None, False)
+    assert group.do('key', calls.append, 2) == (None, False)
+    assert calls == [1, 2]
+
+
+def test_waiting_caller_gives_up_after_wait_seconds():
+    group = SingleFlight('test')
+    work = Blocking()
+    threads, _ = start_callers(group, 'key', work, 1)
+    work.started.wait(5)
+
+    with pytest.raises(FutureTimeoutError):
+        group.do('key', work, wait_seconds=0.05)
+
+    work.release.set()
+    threads[0].join()
+    assert work.runs == 1
+
+
+def test_waiting_caller_reruns_on_retry_on_errors():
+    group = SingleFlight('test')
+    failing = Blocking(error=TimeoutError('leader ran out of time'))
+    threads, outcomes = start_callers(group, 'key', failing, 1)
+    failing.started.wait(5)
+    followers, follower_outcomes = start_callers(group, 'key', lambda: 'rerun', 1, retry_on=(TimeoutError,))
+    wait_for_followers(group, 1)
+    failing.release.set()
+    for thread in threads + followers:
+        thread.join()
+
+    assert isinstance(outcomes[0], TimeoutError)
+    assert follower_outcomes == [('rerun', False)]
+    assert group.stats()['waiting'] == 0
+
+
+def test_disabled_group_runs_every_call(monkeypatch):
+    monkeypatch.setattr(singleflight, 'SINGLEFLIGHT_ENABLED', False)
+    group = SingleFlight('test')
+    work = Blocking()
+    work.release.set()
+
+    assert group.do('key', work) == ('result', False)
+    assert group.do('key', work) == ('result', False)
+    assert group.stats()['leaders'] == 0
+
+
+def test_request_key_ignores_dict_order():
+    assert request_key({'a': 1, 'b': [1, 2]}) == request_key({'b': [1, 2], 'a': 1})
+    assert request_key({'a': 1}) != request_key({'a': 2})
+
+
+def test_normalize_text():
+    assert normalize_text('  How   does\tSOLAR work? ') == 'how does solar work?'
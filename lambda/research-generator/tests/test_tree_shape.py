@@ -0,0 +1,102 @@
+import pytest
+
+import tree_shape
+from config import (
+    DEFAULT_RECURSION_DEPTH, DEFAULT_SUB_QUESTIONS, DEFAULT_RECURSION_THRESHOLD,
+    MAX_ALLOWED_RECURSION_DEPTH, MAX_ALLOWED_SUB_QUESTIONS, MAX_ALLOWED_RECURSION_THRESHOLD
+)
+from tree_shape import TreeShape, adaptive_shape, estimate_tree_seconds, shape_from_request, stage_latencies
+
+
+def test_defaults_without_parameters():
+    shape = shape_from_request({}, {})
+
+    assert shape.as_dict() == {
+        'max_recursion_depth': DEFAULT_RECURSION_DEPTH,
+        'max_sub_questions': DEFAULT_SUB_QUESTIONS,
+        'recursion_threshold': DEFAULT_RECURSION_THRESHOLD
+    }
+
+
+def test_parameters_are_clamped_to_the_allowed_limits():
+    shape = shape_from_request({'max_recursion_depth': 99, 'max_sub_questions': '99',
+                                'recursion_threshold': -3}, {})
+
+    assert shape.max_depth == MAX_ALLOWED_RECURSION_DEPTH
+    assert shape.max_sub_questions == MAX_ALLOWED_SUB_QUESTIONS
+    assert shape.recursion_threshold == 0
+
+    assert shape_from_request({'recursion_threshold': 99}, {}).recursion_threshold == MAX_ALLOWED_RECURSION_THRESHOLD
+
+
+@pytest.mark.parametrize('value', [1, 0, -2, '1'])
+def test_fewer_than_two_sub_questions_are_rejected(value):
+    with pytest.raises(ValueError, match='max_sub_questions must be at least 2'):
+        shape_from_request({'max_sub_questions': value}, {})
+
+
+def test_fewer_than_two_sub_questions_are_rejected_for_adaptive_shapes():
+    with pytest.raises(ValueError, match='max_sub_questions must be at least 2'):
+        shape_from_request({'max_sub_questions': 1, 'target_latency_seconds': 60}, {})
+
+
+@pytest.mark.parametrize('body', [
+    {'max_recursion_depth': 'deep'},
+    {'max_sub_questions': True},
+    {'target_latency_seconds': 'soon'},
+])
+def test_non_numeric_parameters_are_rejected(body):
+    with pytest.raises(ValueError):
+        shape_from_request(body, {})
+
+
+def test_should_expand_stops_at_max_depth():
+    shape = TreeShape(max_depth=2)
+
+    assert shape.should_expand(1)
+    assert not shape.should_expand(2)
+
+
+def test_limit_sub_questions_applies_threshold_and_breadth():
+    shape = TreeShape(max_sub_questions=2, recursion_threshold=2)
+    sub_questions = ['a', 'b', 'c']
+
+    assert shape.limit_sub_questions(2, sub_questions) == []
+    assert shape.limit_sub_questions(3, sub_questions) == ['a', 'b']
+
+
+def test_adaptive_shape_answers_directly_when_nothing_deeper_fits():
+    shape = adaptive_shape(0.1, {})
+
+    assert shape.max_depth == 0
+    assert shape.estimate['target_latency_seconds'] == 0.1
+
+
+def test_estimate_plans_each_node_after_its_search():
+    latencies = {'classifier': 1.0, 'planner': 2.0, 'leaf_answer': 4.0, 'root_synthesis': 10.0}
+    search = tree_shape.ADAPTIVE_SEARCH_SECONDS
+
+    assert estimate_tree_seconds(0, 3, latencies) == 10.0
+    assert estimate_tree_seconds(1, 3, latencies) == search + 2.0 + 3 * 4.0 + 10.0
+    assert estimate_tree_seconds(2, 2, latencies) == (search + 2.0) * 3 + 4 * 4.0 + 2 * 4.0 + 10.0
+
+
+def test_estimate_counts_a_classifier_slower_than_the_search(monkeypatch):
+    monkeypatch.setattr(tree_shape, 'ADAPTIVE_SEARCH_SECONDS', 1.0)
+    latencies = {'classifier': 3.0, 'planner': 2.0, 'leaf_answer': 4.0, 'root_synthesis': 10.0}
+
+    assert estimate_tree_seconds(1, 1, latencies) == 3.0 + 2.0 + 4.0 + 10.0
+
+    monkeypatch.setattr(tree_shape, 'SPECULATIVE_PLANNING', False)
+    assert estimate_tree_seconds(1, 1, latencies) == 1.0 + 2.0 + 4.0 + 10.0
+
+
+def test_adaptive_shape_fits_the_target_within_the_upper_bounds():
+    latencies = stage_latencies({})
+    target = estimate_tree_seconds(1, 3, latencies)
+
+    shape = shape_from_request({'target_latency_seconds': target, 'max_sub_questions': 3}, {})
+
+    assert shape.max_sub_questions <= 3
+    assert shape.estimate['estimated_seconds'] <= target
+    assert shape.max_depth >= 1
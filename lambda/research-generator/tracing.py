@@ -0,0 +1,244 @@
+"""
+Span-based timing of a research request.
+
+A Trace is created for each request and activated around the tree build.
+While it is active (a context variable, copied into NodeExecutor's and
+the ingestion pipeline's threads), every external call and index operation
+records a span:
+
+    with span('faiss.search', top_k=top_k):
+        ...
+
+Spans are named '<component>.<operation>', e.g. 'claude.planner',
+'openai.embeddings', 'brave.search', 'faiss.search' or
+'persist.vector_db'. Each tree node is a 'tree.node' span; the spans inside
+it are attributed to that node. Counts such as tokens are added to the
+current span with record().
+
+The trace keeps per-stage (span name) and per-node aggregates up to date as
+spans finish, and summary() returns them for metadata.timings. The spans
+themselves (up to TRACE_MAX_SPANS) can be exported as a Chrome trace file
+(chrome://tracing or https://ui.perfetto.dev). Without an active trace,
+span() only checks the context variable.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from config import TRACE_MAX_SPANS
+
+# Span attributes summed into the stage and node aggregates
+COUNTED_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens',
+                  'retries', 'throttle_wait_seconds', 'texts', 'chunks', 'documents')
+
+# (trace, current span) of the code running in this context
+_active = contextvars.ContextVar('trace', default=None)
+
+
+class Span:
+    """One timed operation of a trace."""
+
+    __slots__ = ('id', 'name', 'parent_id', 'node_id', 'thread', 'start', 'end', 'attributes')
+
+    def __init__(self, name: str, parent: Optional['Span'], node_id: Optional[str], attributes: Dict[str, Any]):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.parent_id = parent.id if parent else None
+        self.node_id = node_id
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+
+
+def record(**counts):
+    """Add counts (e.g. tokens) to the current span, if a trace is active."""
+    active = _active.get()
+    if active is None or active[1] is None:
+        return
+    attributes = active[1].attributes
+    for key, value in counts.items():
+        attributes[key] = attributes.get(key, 0) + value
+
+
+def annotate(**attributes):
+    """Set attributes of the current span, if a trace is active."""
+    active = _active.get()
+    if active is not None and active[1] is not None:
+        active[1].attributes.update(attributes)
+
+
+@contextmanager
+def span(name: str, node_id: Optional[str] = None, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Time the block as a span of the active trace; yields None without one.
+
+    Args:
+        name: '<component>.<operation>'
+        node_id: Set for a tree node's span: the spans inside it are
+            attributed to that node (they inherit the enclosing node otherwise)
+        **attributes: Recorded with the span and in the trace file
+    """
+    active = _active.get()
+    if active is None:
+        yield None
+        return
+    trace, parent = active
+    current = Span(name, parent, node_id or (parent.node_id if parent else None), attributes)
+    token = _active.set((trace, current))
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        _active.reset(token)
+        current.end = time.time()
+        trace._finish(current)
+
+
+class Trace:
+    """
+    The spans of one research request, and their per-stage and per-node aggregates.
+
+    Args:
+        name: What is traced, e.g. the query
+    """
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.time()
+        self.spans = []
+        self.dropped_spans = 0
+        # When the first streamed Claude token arrived (see LLMGateway.stream_message), if one was
+        self.first_token_time = None
+        # Span name -> calls, seconds and counted fields
+        self._stages = {}
+        # Node id -> depth, seconds of its tree.node span, and its own spans' stages
+        self._nodes = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self) -> Iterator['Trace']:
+        """Record the spans started in the block (and in contexts copied from it) in this trace."""
+        token = _active.set((self, None))
+        try:
+            yield self
+        finally:
+            _active.reset(token)
+
+    def _finish(self, finished: Span):
+        seconds = finished.end - finished.start
+        with self._lock:
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append(finished)
+            else:
+                self.dropped_spans += 1
+            _add_to_stage(self._stages, finished, seconds)
+            first_token_seconds = finished.attributes.get('first_token_seconds')
+            if first_token_seconds is not None:
+                first_token_time = finished.start + first_token_seconds
+                if self.first_token_time is None or first_token_time < self.first_token_time:
+                    self.first_token_time = first_token_time
+            if finished.node_id is None:
+                return
+            node = self._nodes.setdefault(finished.node_id, {'depth': None, 'seconds': 0.0, 'stages': {}})
+            if finished.name == 'tree.node':
+                node['depth'] = finished.attributes.get('depth')
+                node['seconds'] = seconds
+            else:
+                _add_to_stage(node['stages'], finished, seconds)
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Return the aggregates for metadata.timings.
+
+        'stages' has the calls, total seconds and counts (tokens, texts, ...)
+        of each span name, and 'nodes' the same for each tree node's own spans,
+        with its wall time (including its children). Spans overlap (nested and
+        concurrent ones), so stage seconds can add up to more than
+        'total_seconds'.
+        """
+        with self._lock:
+            stages = {name: _rounded(stage) for name, stage in sorted(self._stages.items())}
+            nodes = [
+                {
+                    'node_id': node_id,
+                    'depth': node['depth'],
+                    'seconds': round(node['seconds'], 3),
+                    'stages': {name: _rounded(stage) for name, stage in sorted(node['stages'].items())}
+                }
+                for node_id, node in self._nodes.items()
+            ]
+            spans = len(self.spans) + self.dropped_spans
+        return {
+            'trace_id': self.id,
+            'total_seconds': round(time.time() - self.start, 3),
+            'spans': spans,
+            'stages': stages,
+            'nodes': nodes
+        }
+
+    def chrome_trace(self) -> Dict[str, Any]:
+        """Return the spans in the Chrome trace event format (complete events, one row per thread)."""
+        with self._lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for finished in sorted(spans, key=lambda s: s.start):
+            tid = threads.setdefault(finished.thread, len(threads) + 1)
+            events.append({
+                'name': finished.name,
+                'cat': finished.name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': round((finished.start - self.start) * 1e6),
+                'dur': round((finished.end - finished.start) * 1e6),
+                'pid': 1,
+                'tid': tid,
+                'args': {'span_id': finished.id, 'parent_id': finished.parent_id, 'node_id': finished.node_id,
+                         **finished.attributes}
+            })
+        for thread, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}})
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {'trace_id': self.id, 'name': self.name, 'dropped_spans': self.dropped_spans}
+        }
+
+    def export_chrome(self, path: str) -> str:
+        """Write the Chrome trace to a file, creating its directory; returns the path."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+        return path
+
+
+def _add_to_stage(stages: Dict[str, Dict[str, Any]], finished: Span, seconds: float):
+    stage = stages.setdefault(finished.name, {'calls': 0, 'seconds': 0.0})
+    stage['calls'] += 1
+    stage['seconds'] += seconds
+    for field in COUNTED_FIELDS:
+        value = finished.attributes.get(field)
+        if isinstance(value, (int, float)):
+            stage[field] = stage.get(field, 0) + value
+    if 'error' in finished.attributes:
+        stage['errors'] = stage.get('errors', 0) + 1
+
+
+def _rounded(stage: Dict[str, Any]) -> Dict[str, Any]:
+    return {**stage, 'seconds': round(stage['seconds'], 3)}
+
+
+def current_trace() -> Optional[Trace]:
+    """Return the trace active in this context, if any."""
+    active = _active.get()
+    return active[0] if active else None
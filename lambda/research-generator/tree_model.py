@@ -0,0 +1,148 @@
+"""
+Typed model of a research question tree.
+
+RAGEngine.generate_answer_with_tree builds TreeNodes. Every node of a tree
+shares one ResearchTree, which keeps the tree's aggregates up to date as
+nodes attach and sources are added: the node count, the maximum depth, and
+each source's frequency and shallowest occurrence. The response metadata
+and source lists are read from it directly instead of walking the finished
+tree, and the tree is converted to the response's plain dictionaries once,
+by TreeNode.to_dict, when the response is built.
+"""
+import uuid
+import threading
+from typing import Any, Dict, Iterable, List, Optional
+
+# Node fields that are only serialized when set
+_OPTIONAL_FIELDS = (
+    'needs_breakdown', 'complexity', 'answer', 'error', 'answer_error', 'sources_error',
+    'sub_questions_error', 'budget_limited', 'timed_out', 'skipped_sub_questions', 'spend', 'budget'
+)
+
+
+class Source:
+    """A document a node's answer was built from."""
+
+    __slots__ = ('url', 'title')
+
+    def __init__(self, url: str, title: str):
+        self.url = url
+        self.title = title
+
+    def to_dict(self) -> Dict[str, str]:
+        return {'url': self.url, 'title': self.title}
+
+
+class ResearchTree:
+    """Aggregates over the nodes of one question tree, updated as it grows."""
+
+    __slots__ = ('node_count', 'max_depth', '_sources', '_lock')
+
+    def __init__(self):
+        self.node_count = 0
+        self.max_depth = 0
+        # URL -> [Source, frequency, depth and question of its shallowest node], in first-seen order
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def _add_node(self, node: 'TreeNode'):
+        with self._lock:
+            self.node_count += 1
+            self.max_depth = max(self.max_depth, node.depth)
+
+    def _add_sources(self, node: 'TreeNode', sources: Iterable[Source]):
+        with self._lock:
+            for source in sources:
+                entry = self._sources.get(source.url)
+                if entry is None:
+                    self._sources[source.url] = [source, 1, node.depth, node.question]
+                    continue
+                entry[1] += 1
+                if node.depth < entry[2]:
+                    entry[0], entry[2], entry[3] = source, node.depth, node.question
+
+    def all_sources(self) -> List[Dict[str, Any]]:
+        """
+        Return each source of the tree once, most frequently used first (then shallowest).
+
+        Each source has its 'frequency' (the nodes using it), the 'depth' and
+        'node_question' of its shallowest node, and a 'relevance' score
+        (frequency * 10 / (depth + 1)).
+        """
+        with self._lock:
+            entries = list(self._sources.values())
+        entries.sort(key=lambda entry: (-entry[1], entry[2]))
+        return [
+            {
+                **source.to_dict(),
+                'depth': depth,
+                'node_question': question,
+                'frequency': frequency,
+                'relevance': (frequency * 10) / (depth + 1)
+            }
+            for source, frequency, depth, question in entries
+        ]
+
+
+class TreeNode:
+    """
+    One question of a research tree.
+
+    Args:
+        question: The node's question
+        depth: Depth in the tree (a child's is its parent's plus one)
+        node_id: The node's id (a new UUID if not given)
+        parent: The node this one will be attached to; it shares the parent's
+            ResearchTree. A root (no parent) starts a new tree.
+    """
+
+    __slots__ = ('id', 'question', 'depth', 'tree', 'parent', 'children', 'sources') + _OPTIONAL_FIELDS
+
+    def __init__(self, question: str, depth: int = 0, node_id: Optional[str] = None,
+                 parent: Optional['TreeNode'] = None):
+        self.id = node_id or str(uuid.uuid4())
+        self.question = question
+        self.depth = depth
+        self.parent = parent
+        self.children = []
+        self.sources = None
+        for name in _OPTIONAL_FIELDS:
+            setattr(self, name, None)
+        if parent is None:
+            self.tree = ResearchTree()
+            self.tree._add_node(self)
+        else:
+            self.tree = parent.tree
+
+    def add_child(self, child: 'TreeNode'):
+        """Attach a finished child node, counting it in the tree's aggregates."""
+        child.parent = self
+        self.children.append(child)
+        self.tree._add_node(child)
+
+    def set_sources(self, sources: List[Source]):
+        """Set the node's sources, counting them in the tree's source frequencies."""
+        self.sources = sources
+        self.tree._add_sources(self, sources)
+
+    def has_usable_answer(self) -> bool:
+        """Check whether the node has an answer that isn't an error message."""
+        return bool(self.answer) and not self.answer.startswith('Error') and not self.error
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialize the node and its subtree to the plain dictionaries of the API response."""
+        node = {
+            'id': self.id,
+            'question': self.question,
+            'depth': self.depth,
+            'children': [child.to_dict() for child in self.children]
+        }
+        if self.parent is not None:
+            node['parent_question'] = self.parent.question
+        if self.sources is not None:
+            node['sources'] = [source.to_dict() for source in self.sources]
+        for name in _OPTIONAL_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                node[name] = value
+        return node
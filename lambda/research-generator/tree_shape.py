@@ -0,0 +1,198 @@
+"""
+Shape of a research tree: how deep it may go and how wide each level may be.
+
+Requests set the shape with max_recursion_depth, max_sub_questions and
+recursion_threshold, clamped to the MAX_ALLOWED_* limits in config.py
+(max_sub_questions below MIN_ALLOWED_SUB_QUESTIONS is rejected). With
+target_latency_seconds the shape is chosen adaptively instead: the widest,
+deepest tree whose estimated build time, from the gateway's measured
+per-call latencies, fits the target (the explicit parameters, if also given,
+are upper bounds).
+"""
+from typing import Any, Dict, Optional
+
+from config import (
+    DEFAULT_RECURSION_DEPTH, DEFAULT_SUB_QUESTIONS, DEFAULT_RECURSION_THRESHOLD,
+    MAX_ALLOWED_RECURSION_DEPTH, MAX_ALLOWED_SUB_QUESTIONS, MAX_ALLOWED_RECURSION_THRESHOLD, MIN_ALLOWED_SUB_QUESTIONS,
+    MODEL_ROUTES, ADAPTIVE_DEFAULT_LATENCIES, ADAPTIVE_SEARCH_SECONDS, ADAPTIVE_MIN_SAMPLES, SPECULATIVE_PLANNING
+)
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Request body fields that shape the tree (kept with asynchronous jobs)
+SHAPE_PARAMETERS = ('max_recursion_depth', 'max_sub_questions', 'recursion_threshold', 'target_latency_seconds')
+
+
+def _int_parameter(body: Dict[str, Any], name: str, default: int, low: int, high: int,
+                   minimum: Optional[int] = None) -> int:
+    """Read an integer request parameter, clamped to [low, high]; values below minimum are rejected."""
+    value = body.get(name)
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        raise ValueError(f"{name} must be an integer")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}, got {value}")
+    return max(low, min(high, value))
+
+
+class TreeShape:
+    """
+    Limits on a research tree.
+
+    Args:
+        max_depth: Depth at which nodes are answered without breaking them down
+        max_sub_questions: Most sub-questions a node is broken into
+        recursion_threshold: Planned complexity a question must exceed to be
+            broken down (higher is more conservative)
+        estimate: How an adaptive shape was chosen, if it was
+    """
+
+    def __init__(self, max_depth: int = DEFAULT_RECURSION_DEPTH,
+                 max_sub_questions: int = DEFAULT_SUB_QUESTIONS,
+                 recursion_threshold: int = DEFAULT_RECURSION_THRESHOLD,
+                 estimate: Optional[Dict[str, Any]] = None):
+        self.max_depth = max_depth
+        self.max_sub_questions = max_sub_questions
+        self.recursion_threshold = recursion_threshold
+        self.estimate = estimate
+
+    def should_expand(self, depth: int) -> bool:
+        """Check whether a node at depth may be broken down into sub-questions."""
+        return depth < self.max_depth
+
+    def limit_sub_questions(self, complexity: int, sub_questions: list) -> list:
+        """Apply the recursion threshold and breadth limit to a plan's sub-questions."""
+        if complexity <= self.recursion_threshold:
+            return []
+        return sub_questions[:self.max_sub_questions]
+
+    def as_dict(self) -> Dict[str, int]:
+        """Return the shape as request parameters (shape_from_request rebuilds it from them)."""
+        return {
+            'max_recursion_depth': self.max_depth,
+            'max_sub_questions': self.max_sub_questions,
+            'recursion_threshold': self.recursion_threshold
+        }
+
+
+def stage_latencies(metrics: Dict[str, Dict[str, Any]]) -> Dict[str, float]:
+    """
+    Return the expected seconds per call of each stage.
+
+    A stage's latency is the median latency measured for its model, plus the
+    model's average rate-limit wait per call, once the model has
+    ADAPTIVE_MIN_SAMPLES calls, and ADAPTIVE_DEFAULT_LATENCIES before.
+    """
+    latencies = {}
+    for stage, default in ADAPTIVE_DEFAULT_LATENCIES.items():
+        stats = metrics.get(MODEL_ROUTES[stage]['model'], {})
+        calls = stats.get('calls', 0)
+        if calls >= ADAPTIVE_MIN_SAMPLES and stats.get('latency_p50') is not None:
+            latencies[stage] = round(stats['latency_p50'] + stats['throttle_wait_seconds'] / calls, 3)
+        else:
+            latencies[stage] = default
+    return latencies
+
+
+def estimate_tree_seconds(depth: int, breadth: int, latencies: Dict[str, float]) -> float:
+    """
+    Estimate how long a full tree of the given depth and breadth takes to build.
+
+    Children are built one after another. A node is planned once its search
+    is done (with SPECULATIVE_PLANNING, the classifier call overlaps the
+    search), then its children are built, then its answer is synthesized.
+    """
+    def node_seconds(level: int) -> float:
+        answer = latencies['root_synthesis'] if level == 0 else latencies['leaf_answer']
+        if level >= depth:
+            return answer
+        search = ADAPTIVE_SEARCH_SECONDS
+        if SPECULATIVE_PLANNING:
+            search = max(latencies['classifier'], search)
+        planning = search + latencies['planner']
+        return planning + breadth * node_seconds(level + 1) + answer
+
+    return node_seconds(0)
+
+
+def adaptive_shape(target_seconds: float, metrics: Dict[str, Dict[str, Any]],
+                   max_depth: int = MAX_ALLOWED_RECURSION_DEPTH,
+                   max_sub_questions: int = MAX_ALLOWED_SUB_QUESTIONS,
+                   recursion_threshold: int = DEFAULT_RECURSION_THRESHOLD) -> TreeShape:
+    """
+    Choose the tree shape with the most nodes whose estimated build time fits target_seconds.
+
+    Args:
+        target_seconds: Target latency of the whole request
+        metrics: The gateway's metrics snapshot (per-model latencies)
+        max_depth: Deepest tree to consider
+        max_sub_questions: Widest level to consider
+        recursion_threshold: Passed through to the shape
+
+    Returns:
+        The shape, with the estimate it was chosen by. A depth-0 shape (a
+        direct answer) if nothing deeper fits.
+    """
+    latencies = stage_latencies(metrics)
+    best = (0, max_sub_questions, estimate_tree_seconds(0, 1, latencies))
+    for depth in range(1, max_depth + 1):
+        for breadth in range(2, max_sub_questions + 1):
+            seconds = estimate_tree_seconds(depth, breadth, latencies)
+            if seconds > target_seconds:
+                continue
+            nodes = sum(breadth ** level for level in range(depth + 1))
+            best_nodes = sum(best[1] ** level for level in range(best[0] + 1))
+            if nodes > best_nodes or (nodes == best_nodes and seconds < best[2]):
+                best = (depth, breadth, seconds)
+
+    depth, breadth, seconds = best
+    logger.info("Chose adaptive tree shape", target_seconds=target_seconds, max_depth=depth,
+                max_sub_questions=breadth, estimated_seconds=round(seconds, 1))
+    return TreeShape(depth, breadth, recursion_threshold, estimate={
+        'target_latency_seconds': target_seconds,
+        'estimated_seconds': round(seconds, 1),
+        'stage_latencies': latencies
+    })
+
+
+def shape_from_request(body: Dict[str, Any], metrics: Dict[str, Dict[str, Any]]) -> TreeShape:
+    """
+    Build the tree shape for a request body.
+
+    Raises:
+        ValueError: If a parameter is not a number, or max_sub_questions is
+            below MIN_ALLOWED_SUB_QUESTIONS (a node is only broken down into
+            at least that many sub-questions)
+    """
+    recursion_threshold = _int_parameter(body, 'recursion_threshold', DEFAULT_RECURSION_THRESHOLD,
+                                         0, MAX_ALLOWED_RECURSION_THRESHOLD)
+    target = body.get('target_latency_seconds')
+    if target is not None:
+        try:
+            target = float(target)
+        except (TypeError, ValueError):
+            raise ValueError(f"target_latency_seconds must be a number, got {target!r}")
+        return adaptive_shape(
+            target, metrics,
+            max_depth=_int_parameter(body, 'max_recursion_depth', MAX_ALLOWED_RECURSION_DEPTH,
+                                     0, MAX_ALLOWED_RECURSION_DEPTH),
+            max_sub_questions=_int_parameter(body, 'max_sub_questions', MAX_ALLOWED_SUB_QUESTIONS,
+                                             MIN_ALLOWED_SUB_QUESTIONS, MAX_ALLOWED_SUB_QUESTIONS,
+                                             minimum=MIN_ALLOWED_SUB_QUESTIONS),
+            recursion_threshold=recursion_threshold
+        )
+
+    return TreeShape(
+        max_depth=_int_parameter(body, 'max_recursion_depth', DEFAULT_RECURSION_DEPTH,
+                                 0, MAX_ALLOWED_RECURSION_DEPTH),
+        max_sub_questions=_int_parameter(body, 'max_sub_questions', DEFAULT_SUB_QUESTIONS,
+                                         MIN_ALLOWED_SUB_QUESTIONS, MAX_ALLOWED_SUB_QUESTIONS,
+                                         minimum=MIN_ALLOWED_SUB_QUESTIONS),
+        recursion_threshold=recursion_threshold
+    )
@@ -1,7 +1,8 @@
 """
 Utility functions for the research generator.
 """
-import json
+import base64
+from response_format import encode_body
 
 def extract_content(message):
     """
@@ -29,16 +30,30 @@ def extract_content(message):
     else:
         return str(message)
 
-def build_response(status_code, body, include_cors=True):
-    """Helper function to build responses, optionally with CORS headers."""
+def build_response(status_code, body, include_cors=True, accept_encoding=None):
+    """
+    Helper function to build responses, optionally with CORS headers.
+    
+    The body is serialized with response_format.dumps and, when the request's
+    Accept-Encoding header (accept_encoding) allows it, compressed and
+    base64-encoded, as Lambda requires for binary bodies.
+    """
+    payload, encoding = encode_body(body, accept_encoding)
     response = {
         'statusCode': status_code,
         'headers': {
             'Content-Type': 'application/json',
         },
-        'body': json.dumps(body)
     }
     
+    if encoding:
+        response['headers']['Content-Encoding'] = encoding
+        response['headers']['Vary'] = 'Accept-Encoding'
+        response['body'] = base64.b64encode(payload).decode('ascii')
+        response['isBase64Encoded'] = True
+    else:
+        response['body'] = payload.decode('utf-8')
+    
     # Add CORS headers only if needed (not for Function URL invocations)
     if include_cors:
         response['headers'].update({